@@ -0,0 +1,203 @@
+"""
+Benchmark for the Phase 4 join (process_contractor_input_result).
+
+Times the indexed join in scrape_muasamcong against the previous implementation
+(linear scans of lotResultItems / lotResultDTO per contractor and per goods row),
+checks that both produce the same rows, and prints one line per payload.
+
+Payloads are either generated (framework tenders: N lots, 3 contractors per lot,
+shuffled lot items, some invalid formValue) or a recorded contractor-input-result
+body saved from the API:
+
+    python bench/bench_phase4_join.py                      # lots=200, 2000, 5000
+    python bench/bench_phase4_join.py --lots 1000 --save payload.json
+    python bench/bench_phase4_join.py --payload payload.json
+"""
+import argparse
+import json
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scrape_muasamcong as sm  # noqa: E402
+
+
+def make_payload(lots, contractors_per_lot=3, seed=1):
+    """Synthetic contractor-input-result body shaped like a large framework tender."""
+    rnd = random.Random(seed)
+    lot_results, lot_items = [], []
+    for i in range(lots):
+        lot_id = f"LR{i}"
+        contractors = []
+        for j in range(contractors_per_lot):
+            cid = f"C{i}-{j}"
+            won = j == 0
+            contractors.append({
+                "id": cid, "orgCode": f"vn{rnd.randrange(10**9):09d}", "taxCode": f"{rnd.randrange(10**10):010d}",
+                "orgFullname": f"Công ty {i}-{j}", "bidResult": 1 if won else 0,
+                "lotOpenPrice": rnd.randrange(10**6, 10**9), "lotFinalPrice": rnd.randrange(10**6, 10**9),
+                "reason": None if won else "Không đáp ứng", "cperiodText": "12 Tháng", "bidExecutionTime": "12 Tháng",
+            })
+            goods = [{
+                "medicineCode": f"M{i}-{k}", "name": f"Thuốc {i}-{k}", "tenHoatChat": "Paracetamol",
+                "nongDo": "500mg", "duongDung": "Uống", "dangBaoChe": "Viên nén", "quyCach": "Hộp 10 vỉ",
+                "uom": "Viên", "quantity": rnd.randrange(1, 10**5), "donGia": rnd.randrange(100, 10**5),
+                "subTotal": rnd.randrange(10**5, 10**9), "nuocSanXuat": "Việt Nam", "contractorName": f"Công ty {i}-{j}",
+                # Half of the goods rows leave lotNo to the lot result id lookup
+                **({"lotNo": f"PP{i}"} if k % 2 else {}),
+            } for k in range(rnd.randint(1, 3))] if won else []
+            form_value = json.dumps(goods, ensure_ascii=False) if goods else None
+            if rnd.random() < 0.02:
+                form_value = "{not json"
+            lot_items.append({"listLotResultId": cid, "lotResultId": lot_id, "formValue": form_value})
+        lot_results.append({"id": lot_id, "lotNo": f"PP{i}", "lotName": f"Phần {i}", "contractorList": contractors})
+    rnd.shuffle(lot_items)
+    return {"bideContractorInputResultDTO": {
+        "notifyNo": "IB2500000000", "lotResultDTO": lot_results, "lotResultItems": lot_items,
+    }}
+
+
+def process_contractor_input_result_scan(res):
+    """The join before the indexes: same rows, found by scanning the lists."""
+    fmt = sm.api_number
+    root_dto = res.get("bideContractorInputResultDTO", {})
+    if not root_dto:
+        return None
+    notify_no = root_dto.get("notifyNo")
+    lot_results = root_dto.get("lotResultDTO") or []
+    lot_items = root_dto.get("lotResultItems") or []
+    if not lot_items:
+        for v in reversed(root_dto.get("decisionVersions") or []):
+            if v.get("lotResultItems"):
+                lot_items = v.get("lotResultItems")
+                break
+
+    nt_rows, hh_rows = [], []
+    for lot in lot_results:
+        for cntr in lot.get("contractorList") or []:
+            linked_item = None
+            for it in lot_items:
+                if it.get("listLotResultId") == cntr.get("id"):
+                    linked_item = it
+                    break
+            don_gia = qty = None
+            if linked_item and linked_item.get("formValue"):
+                try:
+                    fv_json = json.loads(linked_item.get("formValue"))
+                    if fv_json and isinstance(fv_json, list):
+                        first = fv_json[0]
+                        don_gia = first.get("donGia") or first.get("unitPrice")
+                        qty = first.get("quantity")
+                except Exception:
+                    pass
+            won = str(cntr.get("bidResult")) == "1"
+            nt_rows.append({
+                "Mã TBMT": notify_no,
+                "Mã phần (lô)": lot.get("lotNo"),
+                "Tên hoạt chất/ Tên thành phần thuốc": lot.get("lotName"),
+                "Mã định danh": cntr.get("orgCode"),
+                "Mã số thuế": cntr.get("taxCode"),
+                "Tên nhà thầu": cntr.get("orgFullname"),
+                "Giá Dự thầu": fmt(cntr.get("lotOpenPrice") or cntr.get("lotPrice")),
+                "Đơn giá trúng thầu (VND)": fmt(don_gia),
+                "Giá trúng thầu của từng phần đã bao gồm giảm giá (VND) (đã bao gồm các hạng mục của phần đó)": fmt(cntr.get("lotFinalPrice") if won else ""),
+                "Số lượng trúng thầu": fmt(qty),
+                "Kết quả": "Trúng thầu" if won else "Không trúng thầu",
+                "Lý do không đáp ứng": cntr.get("reason"),
+                "Thời gian thực hiện gói thầu": cntr.get("cperiodText"),
+                "Thời gian thực hiện hợp đồng": cntr.get("bidExecutionTime"),
+            })
+
+    for it in lot_items:
+        if not it.get("formValue"):
+            continue
+        try:
+            goods = json.loads(it.get("formValue"))
+        except Exception:
+            continue
+        if not goods or not isinstance(goods, list):
+            continue
+        for g in goods:
+            lot_no = g.get("lotNo")
+            if not lot_no and it.get("lotResultId"):
+                for lr in lot_results:
+                    if lr.get("id") == it.get("lotResultId"):
+                        lot_no = lr.get("lotNo")
+                        break
+            hh_rows.append({
+                "Mã TBMT": notify_no,
+                "Mã Phần/lô": lot_no,
+                "Mã thuốc": g.get("medicineCode"),
+                "Tên thuốc": g.get("name"),
+                "Tên hoạt chất/ Tên thành phần của thuốc": g.get("tenHoatChat"),
+                "Nồng độ, hàm lượng": g.get("nongDo"),
+                "Đường dùng": g.get("duongDung"),
+                "Dạng bào chế": g.get("dangBaoChe"),
+                "Quy cách": g.get("quyCach"),
+                "Nhóm thuốc": g.get("groupMedicine"),
+                "Hạn dùng (Tuổi thọ)": g.get("hanDung"),
+                "GĐKLH hoặc GPNK": g.get("gdklh"),
+                "Cơ sở sản xuất": g.get("csSanXuat"),
+                "Xuất xứ": g.get("nuocSanXuat") or g.get("origin"),
+                "Thông số kỹ thuật": g.get("feature"),
+                "Đơn vị tính": g.get("uom"),
+                "Số lượng": fmt(g.get("quantity")),
+                "Khối lượng": fmt(g.get("qty")),
+                "Đơn giá trúng thầu (VND)": fmt(g.get("donGia") or g.get("unitPrice")),
+                "Thành tiền": fmt(g.get("subTotal") or g.get("amount")),
+                "Nhà thầu trúng thầu": g.get("contractorName") or it.get("contractorName"),
+                "Tiến độ cung cấp": g.get("tienDo"),
+            })
+    return nt_rows, hh_rows
+
+
+def best_of(func, payload, repeat):
+    best, result = None, None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = func(payload)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+def bench(label, payload, repeat):
+    old_s, old_rows = best_of(process_contractor_input_result_scan, payload, repeat)
+    new_s, new_rows = best_of(sm.process_contractor_input_result, payload, repeat)
+    same = "identical" if old_rows == new_rows else "DIFFERENT"
+    goods = len(new_rows[1]) if new_rows else 0
+    print(f"{label:<28} {goods:>7} goods rows   scan {old_s:8.3f}s   indexed {new_s:8.3f}s   "
+          f"x{old_s / max(new_s, 1e-9):6.1f}   output {same}")
+    return old_rows == new_rows
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--lots", type=int, nargs="+", default=[200, 2000, 5000], help="generated payload sizes")
+    parser.add_argument("--payload", help="recorded contractor-input-result body (JSON file) instead of generated ones")
+    parser.add_argument("--save", help="write the (last) generated payload to this file and exit")
+    parser.add_argument("--repeat", type=int, default=3, help="runs per implementation, best time is reported")
+    args = parser.parse_args()
+
+    if args.save:
+        with open(args.save, "w", encoding="utf-8") as f:
+            json.dump(make_payload(args.lots[-1]), f, ensure_ascii=False)
+        print(f"Saved a {args.lots[-1]}-lot payload to {args.save}")
+        return 0
+
+    if args.payload:
+        with open(args.payload, "r", encoding="utf-8") as f:
+            cases = [(os.path.basename(args.payload), json.load(f))]
+    else:
+        cases = [(f"generated lots={n}", make_payload(n)) for n in args.lots]
+
+    ok = True
+    for label, payload in cases:
+        ok = bench(label, payload, args.repeat) and ok
+    return 0 if ok else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
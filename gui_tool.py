@@ -50,6 +50,32 @@ def resource_path(relative_path):
         base_path = os.path.abspath(".")
     return os.path.join(base_path, relative_path)
 
+# Chế độ chạy tab Kết Quả Đấu Thầu (resume/sync/refresh cần dùng lại cùng thư mục output)
+RUN_NEW = "Lần chạy mới"
+RUN_RESUME = "Tiếp tục lần chạy trước"
+RUN_SYNC = "Đồng bộ tin mới"
+RUN_REFRESH = "Cập nhật trạng thái"
+CONTRACTOR_RUN_MODES = (RUN_NEW, RUN_RESUME, RUN_SYNC, RUN_REFRESH)
+CONTRACTOR_SYNC_FOLDER = "Ket Qua Dau Thau - Dong Bo"
+CONTRACTOR_FILE_NAME = "Danh Sach Thong Bao Moi Thau.xlsx"
+
+def find_resumable_folder(parent):
+    """
+    Newest "Ket Qua Dau Thau <time>" folder under parent whose run still has work left
+    (scrape_muasamcong.contractor_run_pending), or None. The sync folder is never
+    resumed: it belongs to Đồng bộ / Cập nhật and their watermarks.
+    """
+    try:
+        names = [n for n in os.listdir(parent)
+                 if n.startswith("Ket Qua Dau Thau ") and n != CONTRACTOR_SYNC_FOLDER
+                 and os.path.isdir(os.path.join(parent, n))]
+    except OSError:
+        return None
+    for name in sorted(names, key=lambda n: os.path.getmtime(os.path.join(parent, n)), reverse=True):
+        if scrape_muasamcong.contractor_run_pending(os.path.join(parent, name, CONTRACTOR_FILE_NAME)):
+            return name
+    return None
+
 # Sửa mỗi khi release
 CURRENT_VERSION = "v2.1.2"
 REPO_OWNER = "scottnguyen0412"
@@ -381,6 +407,21 @@ class ScraperApp(ctk.CTk):
         self.contractor_mode_seg = ctk.CTkSegmentedButton(top_bar, values=["Tìm theo bộ lọc", "Tìm theo danh sách IB (Excel/Nhập)"], command=self.on_contractor_mode_change)
         self.contractor_mode_seg.pack(fill="x")
 
+        # Run Mode: resume / sync / refresh reuse an existing output folder
+        run_section = ctk.CTkFrame(self.contractor_frame, fg_color=COLORS["surface"], corner_radius=8)
+        run_section.pack(fill="x", padx=12, pady=(5, 0))
+        ctk.CTkLabel(run_section, text="Chế độ chạy:", font=ctk.CTkFont(size=12, weight="bold"), text_color=COLORS["text"]).pack(side="left", padx=12, pady=10)
+        self.contractor_run_combo = ctk.CTkComboBox(
+            run_section,
+            values=list(CONTRACTOR_RUN_MODES),
+            state="readonly", width=260, height=32, corner_radius=6,
+            fg_color=COLORS["card"], border_color=COLORS["border"], button_color=COLORS["primary"]
+        )
+        self.contractor_run_combo.pack(side="left", pady=10)
+        self.contractor_run_combo.set(RUN_NEW)
+        ctk.CTkLabel(run_section, text=f"* Đồng bộ / Cập nhật ghi vào thư mục cố định \"{CONTRACTOR_SYNC_FOLDER}\"",
+                     text_color=COLORS["text_secondary"], font=ctk.CTkFont(size=11)).pack(side="left", padx=12)
+
         # --- Mode 1: Filter Frame ---
         self.filter_frame = ctk.CTkFrame(self.contractor_frame, fg_color="transparent")
         
@@ -928,7 +969,18 @@ class ScraperApp(ctk.CTk):
              now_str = datetime.datetime.now().strftime("%d_%m_%Y %H_%M_%S")
              if current_tab == "Kết Quả Đấu Thầu":
                  folder_name = f"Ket Qua Dau Thau {now_str}"
-                 file_name = "Danh Sach Thong Bao Moi Thau.xlsx"
+                 file_name = CONTRACTOR_FILE_NAME
+                 run_mode = self.contractor_run_combo.get()
+                 if run_mode in (RUN_SYNC, RUN_REFRESH):
+                     folder_name = CONTRACTOR_SYNC_FOLDER
+                 elif run_mode == RUN_RESUME:
+                     # Continue the most recent run: same folder -> same temp/ journal
+                     parent = output_path if os.path.isdir(output_path) else os.path.dirname(output_path)
+                     previous = find_resumable_folder(parent)
+                     if not previous:
+                         messagebox.showinfo("Không có lần chạy dở dang", f"Không có thư mục 'Ket Qua Dau Thau ...' nào còn việc chưa xong trong:\n{parent}\n\nHãy chọn \"{RUN_NEW}\".")
+                         return
+                     folder_name = previous
              else:
                  folder_name = f"YCBG_{now_str}"
                  file_name = "Yeu Cau Bao Gia.xlsx"
@@ -1061,11 +1113,12 @@ class ScraperApp(ctk.CTk):
         # Threading
         use_default_kw = use_default_keywords if mode == "CONTRACTOR" else True
         use_default_ex = use_default_exclude if mode == "CONTRACTOR" else True
-        t = threading.Thread(target=self.run_process, args=(output_path, start_ministry, is_sequential, mode, kw, exclude, from_date, to_date, search_type, use_default_kw, use_default_ex))
+        run_mode = self.contractor_run_combo.get() if mode in ("CONTRACTOR", "CONTRACTOR_IB") else RUN_NEW
+        t = threading.Thread(target=self.run_process, args=(output_path, start_ministry, is_sequential, mode, kw, exclude, from_date, to_date, search_type, use_default_kw, use_default_ex, run_mode))
         t.daemon = True
         t.start()
     
-    def run_process(self, output_path, start_ministry, is_sequential, mode="NORMAL", kw="", exclude="", from_date="", to_date="", search_type="", use_default_keywords=True, use_default_exclude=True):
+    def run_process(self, output_path, start_ministry, is_sequential, mode="NORMAL", kw="", exclude="", from_date="", to_date="", search_type="", use_default_keywords=True, use_default_exclude=True, run_mode=RUN_NEW):
         start_time = time.time()
         try:
             print(">>> INITIALIZING SCRAPER...")
@@ -1082,7 +1135,9 @@ class ScraperApp(ctk.CTk):
                     use_default_keywords=use_default_keywords,
                     use_default_exclude=use_default_exclude,
                     pause_event=self.pause_event,
-                    stop_event=self.stop_event
+                    stop_event=self.stop_event,
+                    incremental=(run_mode == RUN_SYNC),
+                    refresh=(run_mode == RUN_REFRESH)
                 )
                 print("\n>>> COMPLETED SUCCESSFULLY!")
                 self.timer_running = False
@@ -1095,7 +1150,9 @@ class ScraperApp(ctk.CTk):
                     output_path=output_path,
                     ib_list=kw,
                     pause_event=self.pause_event,
-                    stop_event=self.stop_event
+                    stop_event=self.stop_event,
+                    incremental=(run_mode == RUN_SYNC),
+                    refresh=(run_mode == RUN_REFRESH)
                 )
                 print("\n>>> COMPLETED SUCCESSFULLY!")
                 self.timer_running = False
@@ -1288,6 +1345,7 @@ class ScraperApp(ctk.CTk):
         
         self.combo_ministry.set("Bộ Y tế")
         self.chk_sequential.select()
+        self.contractor_run_combo.set(RUN_NEW)
         
         # 4. Clear Logs
         self.log_area.configure(state="normal")
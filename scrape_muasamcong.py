@@ -1,7 +1,8 @@
 import json
 import time
 import sys
-from datetime import datetime
+from datetime import datetime, timedelta, date
+from decimal import Decimal, InvalidOperation
 import random
 import pandas as pd
 import urllib.parse
@@ -10,13 +11,195 @@ from playwright.sync_api import sync_playwright
 import os
 import requests
 import ssl
+import concurrent.futures
+import threading
+import queue
+import urllib3
+import hashlib
+import copy
+import shutil
+import sqlite3
+import collections
+import functools
+import email.utils
+import warnings
 from requests.adapters import HTTPAdapter
 from urllib3.util.ssl_ import create_urllib3_context
 from urllib3.poolmanager import PoolManager
 from bs4 import BeautifulSoup  # type: ignore
+from openpyxl import Workbook
 
 os.environ["PLAYWRIGHT_BROWSERS_PATH"] = "0"
 
+# Phase 2 (detail) concurrency used by run_contractor_selection
+DEFAULT_DETAIL_WORKERS = 4
+
+# Phase 1 (search pagination) concurrency and optional fixed request budget
+# (requests/second, 0 = leave pacing to the adaptive host controller)
+DEFAULT_PAGE_WORKERS = 4
+DEFAULT_SEARCH_RATE = 0
+
+# IB-list mode: codes per smart/search query
+IB_CHUNK_SIZE = 50
+
+# Date sharding: ranges longer than SHARD_MIN_DAYS are searched as month windows;
+# windows with more than SHARD_MAX_RESULTS results are split into weeks, then days
+SHARD_MIN_DAYS = 31
+SHARD_MAX_RESULTS = 5000
+
+# Phase 3 (bid opening) concurrency and optional fixed request budget
+DEFAULT_PHASE3_WORKERS = 4
+DEFAULT_PHASE3_RATE = 0
+
+# Phase 4 (contractor input result): download workers, optional fixed request budget,
+# and the separate pool that decodes the (often huge) responses into rows
+DEFAULT_PHASE4_WORKERS = 4
+DEFAULT_PHASE4_RATE = 0
+DEFAULT_PARSE_WORKERS = 2
+
+# Phase 1 statuses that never change again: refresh mode keeps their stored details
+TERMINAL_STATUSES = {"Có nhà thầu trúng thầu", "Không có nhà thầu trúng thầu", "Đã hủy thầu", "Đã hủy TBMT"}
+
+# Incremental sync: syncs in a row a notice whose Phases 2-4 keep failing may hold the
+# watermark back; after that it is only retried from the run folder's journal
+SYNC_MAX_HOLDS = 3
+
+# Token refresh: empty 2xx bodies in a row that count as a rejected token, the
+# pause (seconds) after a failed re-harvest before trying the browser again, and how
+# long (seconds) a suspect empty response waits for other requests to judge the token
+TOKEN_FAILURE_THRESHOLD = 3
+TOKEN_REFRESH_COOLDOWN = 300
+TOKEN_VERDICT_WAIT = 5.0
+
+# Per-user state shared across runs (saved search sessions, ...)
+APP_DATA_DIR = os.path.join(os.path.expanduser("~"), ".tool_vneps")
+SEARCH_SESSION_FILE = os.path.join(APP_DATA_DIR, "search_sessions.json")
+SYNC_WATERMARK_FILE = os.path.join(APP_DATA_DIR, "sync_watermarks.json")
+DEFAULT_DB_PATH = os.path.join(APP_DATA_DIR, "vneps.sqlite3")
+
+# Local database, opt-in per run (db_path=DEFAULT_DB_PATH or any path; None = off):
+# output sheet -> (table, key columns rows are upserted on).
+# Rows whose key columns are all empty are keyed on their full content instead.
+STORE_TABLES = {
+    "Kết quả tìm kiếm": ("contractor_search", ("Mã TBMT",)),
+    "Thông tin chung": ("contractor_detail", ("Mã TBMT",)),
+    "Hồ sơ mời thầu": ("contractor_bid_docs", ("Mã TBMT", "Mã phần (Lô)", "Mã Thuốc")),
+    "Sheet1": ("bid_opening", ("Mã TBMT", "Mã phân/ lô", "Mã định danh")),
+    "Danh Sach Nha Thau": ("contractors", ("Mã TBMT", "Mã phần (lô)", "Mã định danh")),
+    "Danh Sach Hang Hoa": ("contractor_goods", ("Mã TBMT", "Mã Phần/lô", "Mã thuốc", "Tên thuốc", "Nhà thầu trúng thầu")),
+    "YeuCauBaoGia": ("rfq", ("Mã YCBG",)),
+    "Yeu Cau Bao Gia Detail": ("rfq_detail", ("Mã YCBG",)),
+    "Nội dung YCBG": ("rfq_items", ("Mã YCBG", "Mã thuốc", "Danh mục hàng hóa/ dịch vụ")),
+    "CongBoGiaThuoc": ("drug_prices", ("id",)),
+    "Thông Tin Nhà Đầu Tư": ("investors", ("Mã định danh",)),
+    "Danh Sách Bệnh Viện": ("hospitals", ("Tên bệnh viện", "Địa chỉ")),
+}
+
+# Adaptive pacing per host (AIMD): starting and maximum concurrent requests and
+# requests/second. Shared by every scraper in the process; other hosts are unpaced.
+HOST_PACING = {
+    "muasamcong.mpi.gov.vn": {"concurrency": 8, "max_concurrency": 16, "rate": 8, "max_rate": 20},
+    "dichvucong.dav.gov.vn": {"concurrency": 4, "max_concurrency": 12, "rate": 4, "max_rate": 12},
+    "benhandientu.moh.gov.vn": {"concurrency": 2, "max_concurrency": 4, "rate": 2, "max_rate": 6},
+}
+
+# Retries for every request: attempts, backoff base/cap (seconds, exponential with
+# jitter, or the server's Retry-After), and the per-endpoint circuit breaker that pauses
+# an endpoint after this many failures in a row, for a cooldown that doubles up to the cap
+RETRY_ATTEMPTS = 4
+RETRY_BASE_DELAY = 1.0
+RETRY_MAX_DELAY = 30.0
+RETRY_STATUSES = {408, 429, 500, 502, 503, 504}
+RETRY_ERRORS = (requests.Timeout, requests.ConnectionError, requests.exceptions.ChunkedEncodingError)
+BREAKER_THRESHOLD = 5
+BREAKER_COOLDOWN = 15.0
+BREAKER_MAX_COOLDOWN = 240.0
+
+# Latency-derived timeouts and hedging: once an endpoint has LATENCY_MIN_SAMPLES answers,
+# a first attempt times out at LATENCY_TIMEOUT_FACTOR x its p99 (never below the floor),
+# and a request still running at the p95 gets a duplicate, for at most HEDGE_BUDGET of
+# the endpoint's requests (0 disables hedging)
+LATENCY_WINDOW = 200
+LATENCY_MIN_SAMPLES = 20
+LATENCY_TIMEOUT_FACTOR = 3
+LATENCY_MIN_TIMEOUT = 10.0
+CONNECT_TIMEOUT = 10.0
+HEDGE_BUDGET = 0.05
+
+# Run-scoped memo of detail responses, kept as raw (undecoded) bodies: entries
+# kept, and the byte budget (bodies can be several MB each)
+MEMO_MAX_ENTRIES = 2000
+MEMO_MAX_BYTES = 64 * 1024 * 1024
+
+# Excel export: CSV rows read per chunk, data rows per sheet (Excel's 1,048,576 minus
+# the header) and per workbook before rolling over, and the control characters Excel rejects
+EXCEL_CHUNK_ROWS = 20000
+EXCEL_MAX_ROWS = 1048575
+EXCEL_MAX_BOOK_ROWS = 3000000
+EXCEL_ILLEGAL_CHARS = r"[\x00-\x08\x0b\x0c\x0e-\x1f]"
+
+# Columnar output (output_format="parquet"/"arrow", needs pyarrow): rows are partitioned
+# by the month of the first of these columns the sheet has, else by the run date
+PUBLISH_DATE_COLUMNS = ("Ngày đăng tải", "Ngày Công bố")
+COLUMNAR_KIND_PATTERNS = {
+    "int": r"-?(0|[1-9]\d{0,17})",
+    "float": r"-?(0|[1-9]\d*)(\.\d+)?(e[-+]?\d+)?",
+    "bool": r"True|False",
+    "date": r"\d{1,2}/\d{1,2}/\d{4}( \d{1,2}:\d{2}(:\d{2})?)?|\d{4}-\d{2}-\d{2}([ T]\d{2}:\d{2}(:\d{2}(\.\d+)?)?)?",
+}
+
+# Excel display formats, applied per sheet at export (rows keep int/Decimal/datetime
+# values until then): "vnd" = 9.422.000 VNĐ, "number" = 13.545.000, "number_comma" =
+# 999,900, anything else is a strftime pattern
+DT_ISO = "%Y-%m-%d %H:%M:%S"
+DATE_ISO = "%Y-%m-%d"
+DT_VN = "%d/%m/%Y %H:%M"
+DT_VN_S = "%d/%m/%Y %H:%M:%S"
+DATE_VN = "%d/%m/%Y"
+DISPLAY_FORMATS = {
+    "Kết quả tìm kiếm": {
+        "Thời điểm đóng thầu": DT_VN, "Thời điểm mở thầu": DT_VN,
+        "Giá trúng thầu (VND)": "number", "Ngày phê duyệt KQLCNT": DATE_VN,
+    },
+    "Thông tin chung": {
+        "Ngày đăng tải": DT_ISO, "Thời điểm đóng thầu": DT_ISO, "Thời điểm mở thầu": DT_ISO,
+        "Số tiền bảo đảm dự thầu": "vnd", "Ngày phê duyệt": DATE_ISO,
+    },
+    "Hồ sơ mời thầu": {
+        "Số lượng": "number", "Giá trị ước tính từng phần (VND)": "number", "Giá kế hoạch": "number",
+        "Thời điểm mở thầu": DT_VN_S, "Thời điểm đóng thầu": DT_VN_S,
+    },
+    "Sheet1": {
+        "Bảo đảm dự thầu cho các phần tham dự (VND)": "number", "Giá dự thầu": "number",
+        "Giá dự thầu sau giảm giá (VND)": "number",
+    },
+    "Danh Sach Nha Thau": {
+        "Giá Dự thầu": "number", "Đơn giá trúng thầu (VND)": "number", "Số lượng trúng thầu": "number",
+        "Giá trúng thầu của từng phần đã bao gồm giảm giá (VND) (đã bao gồm các hạng mục của phần đó)": "number",
+    },
+    "Danh Sach Hang Hoa": {
+        "Số lượng": "number", "Khối lượng": "number", "Đơn giá trúng thầu (VND)": "number", "Thành tiền": "number",
+    },
+    "YeuCauBaoGia": {"Ngày đăng tải": DT_VN, "Ngày phê duyệt": DT_VN},
+    "Yeu Cau Bao Gia Detail": {"Ngày đăng tải": DATE_VN},
+    "Nội dung YCBG": {"Số lượng": "number"},
+    "CongBoGiaThuoc": {"Ngày Công bố": DATE_VN, "Giá Bán Buôn Dự Kiến (VNĐ) (VAT)": "number_comma"},
+    "Thông Tin Nhà Đầu Tư": {"Ngày cấp": DATE_VN, "Ngày phê duyệt yêu cầu đăng ký": DATE_VN},
+}
+
+# Keep-alive connection pool size per host for ApiSession
+HOST_POOL_SIZES = {
+    "muasamcong.mpi.gov.vn": 16,
+    "dichvucong.dav.gov.vn": 8,
+    "benhandientu.moh.gov.vn": 4,
+}
+
+# Hosts ApiSession talks to without TLS certificate checks (the procurement portal was
+# only ever reached through the browser with ignore_https_errors). Every other host is verified.
+HOST_SKIP_TLS_VERIFY = {"muasamcong.mpi.gov.vn"}
+for _host in HOST_SKIP_TLS_VERIFY:
+    warnings.filterwarnings("ignore", message=f".*host '{re.escape(_host)}'", category=urllib3.exceptions.InsecureRequestWarning)
+
 
 # --- CSV Helpers for Performance ---
 def save_batch_csv(data, path):
@@ -29,45 +212,1738 @@ def save_batch_csv(data, path):
     except Exception as e:
         print(f"Error appending to CSV {path}: {e}")
 
-def finalize_excel(csv_mapping, output_path):
+def rewrite_csv(data, path):
+    """Replaces a CSV with `data` (list of dicts), e.g. after rows were updated in place."""
+    tmp_path = path + ".tmp"
+    pd.DataFrame(data).to_csv(tmp_path, index=False, encoding='utf-8-sig')
+    os.replace(tmp_path, path)
+
+def drop_csv_rows(path, column, values):
+    """Removes rows whose `column` is in values from a CSV. Returns the number removed."""
+    if not values or not os.path.exists(path): return 0
+    df = pd.read_csv(path, dtype=str)
+    if column not in df.columns: return 0
+    keep = ~df[column].fillna("").str.strip().isin(values)
+    removed = int((~keep).sum())
+    if removed:
+        rewrite_csv(df[keep], path)
+    return removed
+
+# --- Typed Values ---
+def api_number(value):
+    """
+    Amount/quantity from the API as int (whole numbers) or Decimal; None when empty.
+    Lists are summed (some prices come per lot). Non-numeric values come back unchanged.
+    """
+    if value is None or value == "":
+        return None
+    if isinstance(value, list):
+        nums = [api_number(v) for v in value]
+        nums = [n for n in nums if isinstance(n, (int, Decimal))]
+        return sum(nums) if nums else (api_number(value[0]) if value else None)
+    if isinstance(value, (bool, int, Decimal)):
+        return value
+    try:
+        num = Decimal(str(value).strip())
+    except InvalidOperation:
+        return value
+    if not num.is_finite():
+        return value
+    return int(num) if num == num.to_integral_value() else num
+
+
+def api_datetime(value):
+    """
+    Timestamp from the API as a naive datetime (wall time as sent, zone dropped): ISO
+    strings, "dd/mm/yyyy[ HH:MM[:SS]]", epoch milliseconds or [y, m, d, h, mi, s] lists.
+    None when empty; anything unparsable comes back unchanged.
+    """
+    if value is None or value == "" or value == []:
+        return None
+    if isinstance(value, datetime):
+        return value.replace(tzinfo=None)
+    if isinstance(value, date):
+        return datetime(value.year, value.month, value.day)
+    try:
+        if isinstance(value, list):
+            return datetime(*[int(v) for v in value[:6]]) if len(value) >= 3 else None
+        if isinstance(value, (int, float)):
+            return datetime.fromtimestamp(value / 1000)
+        text = str(value).strip()
+        if "/" in text:
+            for fmt in (DT_VN_S, DT_VN, DATE_VN):
+                try:
+                    return datetime.strptime(text, fmt)
+                except ValueError:
+                    pass
+            return value
+        return datetime.fromisoformat(text.replace("Z", "+00:00")).replace(tzinfo=None)
+    except (ValueError, TypeError, OverflowError):
+        return value
+
+
+def api_date(value):
+    """api_datetime() without the time of day."""
+    dt = api_datetime(value)
+    return dt.date() if isinstance(dt, datetime) else dt
+
+
+def format_display(chunk, formats):
+    """
+    Vietnamese display text for the typed columns of an export chunk (in place),
+    one vectorized pass per column. Values that don't parse are left as they are,
+    so CSVs written before values were typed export unchanged.
+    """
+    for col, fmt in (formats or {}).items():
+        if col not in chunk.columns:
+            continue
+        values = chunk[col]
+        if fmt in ("vnd", "number", "number_comma"):
+            nums = pd.to_numeric(values, errors="coerce")
+            ok = nums.notna()
+            if not ok.any():
+                continue
+            text = nums[ok].map("{:,.0f}".format)
+            if fmt != "number_comma":
+                text = text.str.replace(",", ".", regex=False)
+            if fmt == "vnd":
+                text = text + " VNĐ"
+        else:
+            if pd.api.types.is_numeric_dtype(values):
+                continue
+            stamps = pd.to_datetime(values, errors="coerce", format="ISO8601")
+            ok = stamps.notna()
+            if not ok.any():
+                continue
+            text = stamps[ok].dt.strftime(fmt)
+        out = values.astype(object)
+        out[ok] = text
+        chunk[col] = out
+    return chunk
+
+
+def excel_part_name(name, part, limit):
+    """name for part 1, "name (2)", "name (3)", ... after, trimmed to `limit` characters."""
+    if part == 1:
+        return name[:limit]
+    suffix = f" ({part})"
+    return name[:limit - len(suffix)] + suffix
+
+
+def finalize_excel(csv_mapping, output_path, max_rows=EXCEL_MAX_ROWS, max_book_rows=EXCEL_MAX_BOOK_ROWS):
     """
     csv_mapping: { "SheetName": "path/to.csv" }
+    Streams each CSV into a write-only workbook EXCEL_CHUNK_ROWS rows at a time,
+    so memory stays flat however long the CSVs are. A sheet past max_rows continues
+    in "SheetName (2)", ...; a workbook past max_book_rows continues in
+    "output (2).xlsx", .... When anything was split, "<output>.manifest.json" lists
+    which rows went to which file and sheet, with the min/max of the first column
+    (rows are not sorted by it, so the key ranges of parts may overlap).
     """
-    def clean_excel_data(x):
-        if isinstance(x, str):
-            # Remove control characters illegal in Excel (ASCII < 32 except 0x09, 0x0A, 0x0D)
-            return re.sub(r'[\x00-\x08\x0b\x0c\x0e-\x1f]', '', x)
-        return x
+    base, ext = os.path.splitext(output_path)
+    book = {"part": 0, "wb": None, "path": None, "rows": 0}
+    parts = []
+
+    def next_book():
+        if book["wb"] is not None:
+            book["wb"].save(book["path"])
+            print(f"Converted CSVs to Excel: {book['path']}")
+        book["part"] += 1
+        book["wb"] = Workbook(write_only=True)
+        book["path"] = output_path if book["part"] == 1 else f"{base} ({book['part']}){ext}"
+        book["rows"] = 0
 
     try:
-        with pd.ExcelWriter(output_path) as writer:
-            has_data = False
-            for sheet, csv_f in csv_mapping.items():
-                if os.path.exists(csv_f):
+        next_book()
+        for sheet, csv_f in csv_mapping.items():
+            if not os.path.exists(csv_f):
+                continue
+            try:
+                sheet_state = {"ws": None, "part": 0, "rows": 0, "source_row": 0}
+
+                def open_sheet(columns):
+                    if book["rows"] >= max_book_rows:
+                        next_book()
+                    sheet_state["part"] += 1
+                    ws = book["wb"].create_sheet(title=excel_part_name(sheet, sheet_state["part"], 31))
+                    ws.append([str(c) for c in columns])
+                    sheet_state.update(ws=ws, rows=0)
+                    parts.append({
+                        "file": os.path.basename(book["path"]), "sheet": ws.title, "source": sheet,
+                        "key_column": str(columns[0]) if len(columns) else None,
+                        "first_row": sheet_state["source_row"] + 1, "last_row": sheet_state["source_row"],
+                        "min_key": None, "max_key": None,
+                    })
+                    return ws
+
+                def widen_key_range(part, keys):
+                    keys = [k for k in keys if k is not None]
+                    if part["min_key"] is not None:
+                        keys += [part["min_key"], part["max_key"]]
+                    if not keys:
+                        return
                     try:
-                        df = pd.read_csv(csv_f)
-                        # Sanitize
-                        df = df.map(clean_excel_data) # Use .map for latest pandas, or applymap for older
-                        
-                        df.to_excel(writer, sheet_name=sheet, index=False)
-                        has_data = True
-                    except AttributeError:
-                         # Fallback for older pandas (applymap)
-                         df = df.applymap(clean_excel_data)
-                         df.to_excel(writer, sheet_name=sheet, index=False)
-                         has_data = True
-                    except Exception as ex:
-                        print(f"Error reading/writing CSV {csv_f}: {ex}")
-            
-            if not has_data:
-                print("No data found in CSVs to write to Excel.")
-                return
+                        part["min_key"], part["max_key"] = min(keys), max(keys)
+                    except TypeError:
+                        # Mixed numbers and text: compare as text
+                        keys = [str(k) for k in keys]
+                        part["min_key"], part["max_key"] = min(keys), max(keys)
+
+                # low_memory=False: one dtype per column within a chunk (no mixed str/number columns)
+                for chunk in pd.read_csv(csv_f, chunksize=EXCEL_CHUNK_ROWS, low_memory=False):
+                    ws = sheet_state["ws"] or open_sheet(chunk.columns)
+                    format_display(chunk, DISPLAY_FORMATS.get(sheet))
+                    for col in chunk.columns:
+                        if not pd.api.types.is_numeric_dtype(chunk[col]):
+                            # Remove control characters illegal in Excel (ASCII < 32 except 0x09, 0x0A, 0x0D)
+                            chunk[col] = chunk[col].str.replace(EXCEL_ILLEGAL_CHARS, "", regex=True)
+                    chunk = chunk.astype(object).where(chunk.notna(), None)
+
+                    start = 0
+                    while start < len(chunk):
+                        if sheet_state["rows"] >= max_rows or book["rows"] >= max_book_rows:
+                            ws = open_sheet(chunk.columns)
+                        piece = chunk.iloc[start:start + min(max_rows - sheet_state["rows"], max_book_rows - book["rows"])]
+                        for row in piece.itertuples(index=False, name=None):
+                            ws.append(row)
+                        widen_key_range(parts[-1], piece.iloc[:, 0])
+                        sheet_state["source_row"] += len(piece)
+                        sheet_state["rows"] += len(piece)
+                        book["rows"] += len(piece)
+                        parts[-1]["last_row"] = sheet_state["source_row"]
+                        start += len(piece)
+            except Exception as ex:
+                print(f"Error reading/writing CSV {csv_f}: {ex}")
+
+        if not parts:
+            print("No data found in CSVs to write to Excel.")
+            return
 
-        print(f"Converted CSVs to Excel: {output_path}")
+        book["wb"].save(book["path"])
+        print(f"Converted CSVs to Excel: {book['path']}")
         # Optional: Delete CSVs? User didn't specify. Keeping them is safer for debug.
+
+        if len(parts) > len({p["source"] for p in parts}):
+            manifest_path = f"{base}.manifest.json"
+            with open(manifest_path, "w", encoding="utf-8") as f:
+                json.dump({"output": os.path.basename(output_path), "parts": parts}, f, ensure_ascii=False, indent=2, default=str)
+            print(f"Output split into {book['part']} file(s), {len(parts)} sheet(s). Manifest: {manifest_path}")
     except Exception as e:
         print(f"Error converting to Excel: {e}")
 
+
+def columnar_kinds(csv_f):
+    """
+    One streaming pass over a temp CSV: column -> "int", "float", "bool", "date" or
+    "string", whichever fits every value (codes with leading zeros stay strings).
+    """
+    order = ["int", "float", "bool", "date"]
+    kinds = {}
+    for chunk in pd.read_csv(csv_f, chunksize=EXCEL_CHUNK_ROWS, dtype=str, keep_default_na=False):
+        for col in chunk.columns:
+            values = chunk[col].str.strip()
+            values = values[values != ""]
+            if values.empty:
+                kinds.setdefault(col, None)
+                continue
+            fits = [k for k in order if values.str.fullmatch(COLUMNAR_KIND_PATTERNS[k], case=False).all()]
+            kind = fits[0] if fits else "string"
+            prev = kinds.get(col)
+            if prev is None or prev == kind:
+                kinds[col] = kind
+            elif {prev, kind} == {"int", "float"}:
+                kinds[col] = "float"
+            else:
+                kinds[col] = "string"
+    return {col: kind or "string" for col, kind in kinds.items()}
+
+
+def convert_columnar_chunk(chunk, kinds):
+    """Typed copy of a dtype=str chunk according to columnar_kinds()."""
+    out = {}
+    for col in chunk.columns:
+        values = chunk[col].str.strip().replace("", None)
+        kind = kinds[col]
+        if kind == "int":
+            out[col] = pd.to_numeric(values).astype("Int64")
+        elif kind == "float":
+            out[col] = pd.to_numeric(values)
+        elif kind == "bool":
+            out[col] = values.str.lower().map({"true": True, "false": False}).astype("boolean")
+        elif kind == "date":
+            # Old dd/mm/yyyy text and typed ISO values share a column in a resumed or
+            # synced output: each style is parsed with its own format, then combined
+            slash = values.str.contains("/", regex=False).fillna(False).astype(bool)
+            parsed = pd.to_datetime(values.where(~slash), format="ISO8601", errors="coerce")
+            for fmt in (DT_VN_S, DT_VN, DATE_VN):
+                parsed = parsed.fillna(pd.to_datetime(values.where(slash), format=fmt, errors="coerce"))
+            out[col] = parsed
+        else:
+            out[col] = values
+    return pd.DataFrame(out)
+
+
+def write_columnar(csv_mapping, output_path, output_format="parquet"):
+    """
+    Writes each temp CSV as a typed dataset next to output_path:
+    "<output>.parquet/<sheet>/publish_month=YYYY-MM/part-0.parquet" (or .arrow for
+    Arrow IPC), partitioned by publish month, or run_date=YYYY-MM-DD when the sheet
+    has no publish date column. Streams chunk by chunk; returns False when pyarrow
+    is not installed.
+    """
+    try:
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+    except ImportError:
+        print(f"{output_format} output needs pyarrow (pip install pyarrow).")
+        return False
+
+    arrow_types = {"int": pa.int64(), "float": pa.float64(), "bool": pa.bool_(),
+                   "date": pa.timestamp("us"), "string": pa.string()}
+    root = os.path.splitext(output_path)[0] + f".{output_format}"
+    run_date = datetime.now().strftime("%Y-%m-%d")
+
+    for sheet, csv_f in csv_mapping.items():
+        if not os.path.exists(csv_f):
+            continue
+        writers = {}
+        # Same output path again: replace the dataset rather than mixing in old partitions
+        shutil.rmtree(os.path.join(root, sheet), ignore_errors=True)
+        try:
+            kinds = columnar_kinds(csv_f)
+            schema = pa.schema([(col, arrow_types[kind]) for col, kind in kinds.items()])
+            date_col = next((c for c in PUBLISH_DATE_COLUMNS if kinds.get(c) == "date"), None)
+            for chunk in pd.read_csv(csv_f, chunksize=EXCEL_CHUNK_ROWS, dtype=str, keep_default_na=False):
+                typed = convert_columnar_chunk(chunk, kinds)
+                if date_col:
+                    keys = "publish_month=" + typed[date_col].dt.strftime("%Y-%m").fillna("unknown")
+                else:
+                    keys = pd.Series(f"run_date={run_date}", index=typed.index)
+                for key, part in typed.groupby(keys, sort=False):
+                    if key not in writers:
+                        part_dir = os.path.join(root, sheet, key)
+                        os.makedirs(part_dir, exist_ok=True)
+                        path = os.path.join(part_dir, f"part-0.{output_format}")
+                        writers[key] = (pq.ParquetWriter(path, schema) if output_format == "parquet"
+                                        else pa.ipc.new_file(path, schema))
+                    table = pa.Table.from_pandas(part, schema=schema, preserve_index=False)
+                    writers[key].write_table(table)
+        except Exception as ex:
+            print(f"Error writing {output_format} for {csv_f}: {ex}")
+        finally:
+            for writer in writers.values():
+                writer.close()
+        print(f"Wrote {output_format} dataset: {os.path.join(root, sheet)} ({len(writers)} partitions)")
+    return True
+
+
+class RowStore:
+    """
+    Embedded SQLite database that accumulates scraped rows across runs. Each table
+    has a _key primary key built from its STORE_TABLES key columns, so re-scraped
+    rows replace their earlier version, plus indexes on the key and publish date
+    columns. Columns are added as new ones appear. Whole numbers are stored as
+    INTEGER; decimal amounts keep their exact text (no REAL rounding).
+    """
+    def __init__(self, path=DEFAULT_DB_PATH):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def connect(self):
+        conn = sqlite3.connect(self.path, timeout=60)
+        conn.execute("PRAGMA journal_mode=WAL")
+        return conn
+
+    @staticmethod
+    def quote(name):
+        return '"' + str(name).replace('"', '""') + '"'
+
+    def ensure_table(self, conn, table, columns, keys):
+        q = self.quote
+        conn.execute(f"CREATE TABLE IF NOT EXISTS {q(table)} (_key TEXT PRIMARY KEY, _updated_at TEXT)")
+        existing = {r[1] for r in conn.execute(f"PRAGMA table_info({q(table)})")}
+        for col in columns:
+            if col not in existing:
+                conn.execute(f"ALTER TABLE {q(table)} ADD COLUMN {q(col)}")
+        for col in [c for c in keys if c in columns] + [c for c in PUBLISH_DATE_COLUMNS if c in columns]:
+            idx = f"idx_{table}_{hashlib.sha1(col.encode('utf-8')).hexdigest()[:8]}"
+            conn.execute(f"CREATE INDEX IF NOT EXISTS {q(idx)} ON {q(table)} ({q(col)})")
+
+    def upsert_csv(self, table, keys, csv_f):
+        """Upserts a temp CSV chunk by chunk (typed like the columnar output). Returns the row count."""
+        q = self.quote
+        kinds = columnar_kinds(csv_f)
+        columns = list(kinds)
+        key_cols = [c for c in keys if c in kinds]
+        now = datetime.now().isoformat(timespec="seconds")
+        placeholders = ", ".join(["?"] * (len(columns) + 2))
+        sql = (
+            f"INSERT INTO {q(table)} (_key, _updated_at, {', '.join(q(c) for c in columns)}) VALUES ({placeholders}) "
+            f"ON CONFLICT(_key) DO UPDATE SET _updated_at = excluded._updated_at, "
+            + ", ".join(f"{q(c)} = excluded.{q(c)}" for c in columns)
+        )
+        total = 0
+        conn = self.connect()
+        try:
+            with conn:
+                self.ensure_table(conn, table, columns, keys)
+                for chunk in pd.read_csv(csv_f, chunksize=EXCEL_CHUNK_ROWS, dtype=str, keep_default_na=False):
+                    typed = convert_columnar_chunk(chunk, kinds)
+                    raw = chunk.apply(lambda c: c.str.strip())
+                    for col, kind in kinds.items():
+                        if kind == "date":
+                            typed[col] = typed[col].dt.strftime("%Y-%m-%dT%H:%M:%S")
+                        elif kind == "float":
+                            typed[col] = raw[col].replace("", None)
+                    typed = typed.astype(object).where(typed.notna(), None)
+                    if key_cols:
+                        key_text = raw[key_cols].agg("|".join, axis=1)
+                        no_key = (raw[key_cols] == "").all(axis=1)
+                    else:
+                        key_text = pd.Series("", index=raw.index)
+                        no_key = pd.Series(True, index=raw.index)
+                    if no_key.any():
+                        # Content key from the non-empty cells only, so new (empty) columns don't change it
+                        content = raw[no_key].apply(
+                            lambda r: "|".join(f"{c}={v}" for c, v in r.items() if v), axis=1)
+                        key_text[no_key] = content.map(lambda t: "#" + hashlib.sha1(t.encode("utf-8")).hexdigest())
+                    conn.executemany(sql, (
+                        (k, now) + row for k, row in zip(key_text, typed.itertuples(index=False, name=None))
+                    ))
+                    total += len(chunk)
+        finally:
+            conn.close()
+        return total
+
+    def iter_rows(self, table, where="", params=(), chunksize=EXCEL_CHUNK_ROWS):
+        """DataFrames of stored rows (without the bookkeeping columns), oldest key first."""
+        conn = self.connect()
+        try:
+            sql = f"SELECT * FROM {self.quote(table)}" + (f" WHERE {where}" if where else "") + " ORDER BY _key"
+            for chunk in pd.read_sql_query(sql, conn, params=params, chunksize=chunksize):
+                yield chunk.drop(columns=["_key", "_updated_at"])
+        finally:
+            conn.close()
+
+
+def store_outputs(csv_mapping, db_path=DEFAULT_DB_PATH):
+    """Upserts every temp CSV whose sheet is listed in STORE_TABLES into the local database."""
+    store = RowStore(db_path)
+    for sheet, csv_f in csv_mapping.items():
+        if sheet not in STORE_TABLES or not os.path.exists(csv_f):
+            continue
+        table, keys = STORE_TABLES[sheet]
+        try:
+            count = store.upsert_csv(table, keys, csv_f)
+            print(f"Stored {count} rows in {table} ({db_path})")
+        except Exception as ex:
+            print(f"Error storing {csv_f} in the database: {ex}")
+
+
+def export_store(table, output_path, db_path=DEFAULT_DB_PATH, where="", params=(), output_format="xlsx", export_excel=None):
+    """
+    Exports a table of the local database (optionally filtered by a SQL `where`
+    clause) through the same writers as a scrape, e.g.
+    export_store("contractor_detail", "out.xlsx", where='"Ngày đăng tải" >= ?', params=("2025-01-01",)).
+    """
+    sheet = next((s for s, (t, _) in STORE_TABLES.items() if t == table), table)
+    tmp_csv = os.path.splitext(output_path)[0] + ".export.csv"
+    if os.path.exists(tmp_csv):
+        os.remove(tmp_csv)
+    try:
+        for chunk in RowStore(db_path).iter_rows(table, where, params):
+            chunk.to_csv(tmp_csv, mode="a", header=not os.path.exists(tmp_csv), index=False, encoding="utf-8-sig")
+        if not os.path.exists(tmp_csv):
+            print(f"No rows in {table}.")
+            return
+        export_outputs({sheet: tmp_csv}, output_path, output_format, export_excel)
+    finally:
+        if os.path.exists(tmp_csv):
+            os.remove(tmp_csv)
+
+
+def export_outputs(csv_mapping, output_path, output_format="xlsx", export_excel=None, db_path=None):
+    """
+    Final step of every scraper. output_format: "xlsx", "parquet" or "arrow".
+    export_excel: also write the Excel file (default: only for "xlsx"; Excel is
+    written anyway when the columnar writer is unavailable). db_path: also upsert
+    the rows into that local database (see STORE_TABLES).
+    """
+    if db_path:
+        store_outputs(csv_mapping, db_path)
+    if export_excel is None:
+        export_excel = output_format == "xlsx"
+    if output_format in ("parquet", "arrow"):
+        if not write_columnar(csv_mapping, output_path, output_format):
+            print("Falling back to Excel output.")
+            export_excel = True
+    if export_excel:
+        finalize_excel(csv_mapping, output_path)
+
+
+# --- Worker Pool Helpers ---
+class ApiResponse:
+    """Wraps requests.Response with the Playwright APIResponse attributes used by the fetch_* helpers."""
+    def __init__(self, resp):
+        self._resp = resp
+
+    @property
+    def ok(self):
+        return self._resp.ok
+
+    @property
+    def status(self):
+        return self._resp.status_code
+
+    @property
+    def status_text(self):
+        return self._resp.reason
+
+    @property
+    def headers(self):
+        return self._resp.headers
+
+    def json(self):
+        return self._resp.json()
+
+    def text(self):
+        return self._resp.text
+
+    def body(self):
+        return self._resp.content
+
+
+class HostPacer:
+    """
+    Adaptive concurrency and request rate for one host (additive increase,
+    multiplicative decrease). Each success adds about one slot per round of
+    in-flight requests and a little rate; a 429, 5xx or timeout halves both, at
+    most once per second so one burst of failures only counts once.
+    """
+    def __init__(self, host, concurrency, max_concurrency, rate, max_rate):
+        self.host = host
+        self.limit = float(concurrency)
+        self.max_limit = float(max_concurrency)
+        self.rate = float(rate)
+        self.max_rate = float(max_rate)
+        self.in_flight = 0
+        self.next_time = 0.0
+        self.last_decrease = 0.0
+        self.cond = threading.Condition()
+
+    def acquire(self):
+        with self.cond:
+            while self.in_flight >= int(self.limit):
+                self.cond.wait()
+            self.in_flight += 1
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + 1.0 / self.rate
+        if slot > now:
+            time.sleep(slot - now)
+
+    def release(self, ok=True):
+        """ok: True = success, False = server pushing back, None = neither (no change)."""
+        with self.cond:
+            self.in_flight -= 1
+            now = time.monotonic()
+            if ok:
+                self.limit = min(self.max_limit, self.limit + 1.0 / self.limit)
+                self.rate = min(self.max_rate, self.rate + 1.0 / self.rate)
+            elif ok is False and now - self.last_decrease >= 1.0:
+                self.last_decrease = now
+                self.limit = max(1.0, self.limit / 2)
+                self.rate = max(0.5, self.rate / 2)
+                print(f"  [{self.host}] Server is pushing back: slowing to {int(self.limit)} concurrent, {self.rate:.1f} req/s.")
+            self.cond.notify_all()
+
+
+_host_pacers = {}
+_host_pacers_lock = threading.Lock()
+
+
+def host_pacer(url):
+    """Process-wide HostPacer for the URL's host, or None for hosts without pacing."""
+    host = urllib.parse.urlparse(url).hostname or ""
+    if host not in HOST_PACING:
+        return None
+    with _host_pacers_lock:
+        if host not in _host_pacers:
+            _host_pacers[host] = HostPacer(host, **HOST_PACING[host])
+        return _host_pacers[host]
+
+
+def paced_request(session, method, url, **kwargs):
+    """session.request() under the host's adaptive pacer."""
+    pacer = host_pacer(url)
+    if not pacer:
+        return session.request(method, url, **kwargs)
+    pacer.acquire()
+    ok = None
+    try:
+        resp = session.request(method, url, **kwargs)
+        ok = not (resp.status_code == 429 or resp.status_code >= 500)
+        return resp
+    except (requests.Timeout, requests.ConnectionError):
+        ok = False
+        raise
+    finally:
+        pacer.release(ok)
+
+
+class CircuitBreaker:
+    """
+    Pauses one endpoint after BREAKER_THRESHOLD failed attempts in a row. While open,
+    callers wait out the cooldown instead of failing item after item; then a single
+    probe goes through, and its result closes the breaker or reopens it for twice as long.
+    Stopping the run (watch_stop) ends the wait with InterruptedError.
+    Every wait() must be followed by a record(), even when the attempt raised, or a
+    probe would hold the endpoint shut for good.
+    """
+    def __init__(self, name):
+        self.name = name
+        self.failures = 0
+        self.cooldown = BREAKER_COOLDOWN
+        self.open_until = 0.0
+        self.probing = False
+        self.cond = threading.Condition()
+
+    def wait(self):
+        with self.cond:
+            while True:
+                if _stop_event.is_set():
+                    raise InterruptedError("Stopped by user.")
+                now = time.monotonic()
+                if now < self.open_until:
+                    self.cond.wait(min(self.open_until - now, 0.5))
+                elif self.probing:
+                    self.cond.wait(0.5)
+                else:
+                    # First caller after an open period is the probe
+                    if self.open_until:
+                        self.probing = True
+                    return
+
+    def record(self, ok):
+        """ok: True = success, False = failure, None = no verdict (only frees the probe slot)."""
+        with self.cond:
+            was_probe = self.probing
+            self.probing = False
+            if ok is None:
+                pass
+            elif ok:
+                if self.open_until:
+                    print(f"  [{self.name}] Endpoint is back. Resuming.")
+                self.failures = 0
+                self.cooldown = BREAKER_COOLDOWN
+                self.open_until = 0.0
+            else:
+                self.failures += 1
+                if was_probe or self.failures >= BREAKER_THRESHOLD:
+                    if was_probe:
+                        self.cooldown = min(BREAKER_MAX_COOLDOWN, self.cooldown * 2)
+                    self.open_until = time.monotonic() + self.cooldown
+                    self.failures = 0
+                    print(f"  [{self.name}] Endpoint keeps failing. Pausing it for {int(self.cooldown)}s.")
+            self.cond.notify_all()
+
+
+_breakers = {}
+_breakers_lock = threading.Lock()
+
+# Stop signal of the running scrape: retry backoffs and breaker cooldowns wait on it
+_stop_event = threading.Event()
+
+
+def watch_stop(stop_event):
+    """Makes retry backoffs and breaker cooldowns end as soon as stop_event is set."""
+    global _stop_event
+    _stop_event = stop_event if stop_event is not None else threading.Event()
+
+
+def wait_or_stop(seconds):
+    """time.sleep() that raises InterruptedError once the run is stopped."""
+    if _stop_event.wait(seconds):
+        raise InterruptedError("Stopped by user.")
+
+
+def endpoint_breaker(url):
+    """Process-wide CircuitBreaker for the URL's host + path."""
+    parsed = urllib.parse.urlparse(url)
+    name = f"{parsed.hostname}{parsed.path}"
+    with _breakers_lock:
+        if name not in _breakers:
+            _breakers[name] = CircuitBreaker(name)
+        return _breakers[name]
+
+
+def retry_delay(attempt, resp=None):
+    """Server's Retry-After when given, else exponential backoff with jitter."""
+    retry_after = resp.headers.get("Retry-After") if resp is not None else None
+    if retry_after:
+        try:
+            return min(RETRY_MAX_DELAY, max(0.0, float(retry_after)))
+        except ValueError:
+            try:
+                when = email.utils.parsedate_to_datetime(retry_after)
+                return min(RETRY_MAX_DELAY, max(0.0, when.timestamp() - time.time()))
+            except (TypeError, ValueError):
+                pass
+    delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** attempt)
+    return delay / 2 + random.uniform(0, delay / 2)
+
+
+class LatencyTracker:
+    """Recent answer times of one endpoint, with the p95/p99 its timeouts and hedges use."""
+    def __init__(self):
+        self.samples = collections.deque(maxlen=LATENCY_WINDOW)
+        self.requests = 0
+        self.hedges = 0
+        self.p95 = None
+        self.p99 = None
+        self.lock = threading.Lock()
+
+    def record(self, seconds):
+        with self.lock:
+            self.samples.append(seconds)
+            # Re-sorting the window on every answer would be wasted work
+            if len(self.samples) >= LATENCY_MIN_SAMPLES and len(self.samples) % 10 == 0:
+                ordered = sorted(self.samples)
+                self.p95 = ordered[int(len(ordered) * 0.95) - 1]
+                self.p99 = ordered[int(len(ordered) * 0.99) - 1]
+
+    def timeout(self, default):
+        """Read timeout for a first attempt: a multiple of the p99, capped by the caller's."""
+        if self.p99 is None:
+            return default
+        derived = max(LATENCY_MIN_TIMEOUT, self.p99 * LATENCY_TIMEOUT_FACTOR)
+        return min(default, derived) if default else derived
+
+    def take_hedge(self):
+        with self.lock:
+            self.requests += 1
+            if self.p95 is None or self.hedges + 1 > HEDGE_BUDGET * self.requests:
+                return None
+            return self.p95
+
+    def spend_hedge(self):
+        with self.lock:
+            self.hedges += 1
+
+
+_latency = {}
+_latency_lock = threading.Lock()
+# Requests run here when they may be hedged, so the caller can take whichever answers first
+_hedge_executor = concurrent.futures.ThreadPoolExecutor(max_workers=64, thread_name_prefix="hedge")
+
+
+def endpoint_latency(url):
+    """Process-wide LatencyTracker for the URL's host + path."""
+    parsed = urllib.parse.urlparse(url)
+    name = f"{parsed.hostname}{parsed.path}"
+    with _latency_lock:
+        if name not in _latency:
+            _latency[name] = LatencyTracker()
+        return _latency[name]
+
+
+def timed_request(session, method, url, tracker, **kwargs):
+    start = time.monotonic()
+    resp = paced_request(session, method, url, **kwargs)
+    if resp.status_code < 400:
+        tracker.record(time.monotonic() - start)
+    return resp
+
+
+def hedged_request(session, method, url, first_attempt=True, **kwargs):
+    """
+    paced_request() with the endpoint's latency-derived timeout on first attempts.
+    When the answer is slower than the p95 and the hedge budget allows, a duplicate
+    is sent and the first good answer wins (the other is left to finish unused).
+    """
+    tracker = endpoint_latency(url)
+    timeout = kwargs.get("timeout")
+    if first_attempt and not isinstance(timeout, tuple):
+        kwargs["timeout"] = (CONNECT_TIMEOUT, tracker.timeout(timeout))
+    hedge_after = tracker.take_hedge() if HEDGE_BUDGET > 0 else None
+    if hedge_after is None:
+        return timed_request(session, method, url, tracker, **kwargs)
+
+    primary = _hedge_executor.submit(timed_request, session, method, url, tracker, **kwargs)
+    done, _ = concurrent.futures.wait([primary], timeout=hedge_after)
+    if done:
+        return primary.result()
+    tracker.spend_hedge()
+    pending = {primary, _hedge_executor.submit(timed_request, session, method, url, tracker, **kwargs)}
+    while True:
+        done, pending = concurrent.futures.wait(pending, return_when=concurrent.futures.FIRST_COMPLETED)
+        for future in done:
+            if future.exception() is None and future.result().status_code < 400:
+                return future.result()
+        if not pending:
+            # Both failed: hand back the primary's outcome
+            return primary.result()
+
+
+def send_with_retry(session, method, url, attempts=RETRY_ATTEMPTS, **kwargs):
+    """
+    hedged_request() retried on RETRY_ERRORS and RETRY_STATUSES, behind the endpoint's
+    circuit breaker. Returns the last response (possibly not ok), or re-raises the last
+    exception when no response came back at all. Other request errors count as a failed
+    attempt but are raised at once.
+    """
+    breaker = endpoint_breaker(url)
+    for attempt in range(attempts):
+        breaker.wait()
+        resp = None
+        ok = None # Stays None when the attempt was interrupted (stop): no verdict
+        try:
+            resp = hedged_request(session, method, url, first_attempt=attempt == 0, **kwargs)
+            ok = resp.status_code not in RETRY_STATUSES
+        except RETRY_ERRORS:
+            ok = False
+            if attempt == attempts - 1:
+                raise
+        except requests.RequestException:
+            ok = False
+            raise
+        finally:
+            breaker.record(ok)
+        if ok or attempt == attempts - 1:
+            return resp
+        wait_or_stop(retry_delay(attempt, resp))
+
+
+def url_token(url):
+    """Value of the token= query parameter, as it appears in the URL (or None)."""
+    m = re.search(r"[?&]token=([^&]*)", url or "")
+    return m.group(1) if m else None
+
+
+class TokenManager:
+    """
+    Keeps the smart/search token usable for a whole run. An ApiSession with a token
+    manager sends every token= request with the current token; a 401/403, or
+    TOKEN_FAILURE_THRESHOLD empty 2xx bodies in a row, makes one thread re-harvest a
+    token with refresh_func (() -> search session or None) while the others wait,
+    and the failed request is then replayed with the new token.
+    An empty body below the threshold is held until the token is judged: a good
+    response with the same token means the body really was empty, a refresh means
+    it is replayed. With no verdict after TOKEN_VERDICT_WAIT it is sent again with
+    the same token, which counts towards the threshold like any other suspect.
+    """
+    def __init__(self, token, refresh_func, threshold=TOKEN_FAILURE_THRESHOLD, verdict_wait=TOKEN_VERDICT_WAIT):
+        self.token = token
+        self.cookies = None
+        self.refresh_func = refresh_func
+        self.threshold = threshold
+        self.verdict_wait = verdict_wait
+        self.suspect_count = 0
+        self.ok_count = 0 # Good responses seen, so held suspects know the token still works
+        self.failed_refreshes = 0
+        self.next_refresh_time = 0.0
+        self.lock = threading.Lock()
+        self.verdict = threading.Condition(self.lock)
+        self.refresh_lock = threading.Lock()
+
+    def apply(self, url, token):
+        return re.sub(r"([?&]token=)[^&]*", lambda m: m.group(1) + token, url)
+
+    def check(self, sent_token, resp):
+        """True when resp may be an auth failure and the request should be replayed."""
+        definite = resp.status in (401, 403)
+        suspect = definite or (resp.ok and not resp.body().strip())
+        with self.lock:
+            if not suspect:
+                self.suspect_count = 0
+                if sent_token == self.token:
+                    self.ok_count += 1
+                    self.verdict.notify_all()
+                return False
+            if sent_token != self.token:
+                return True # Refreshed while this request was in flight
+            self.suspect_count += 1
+            if not definite and self.suspect_count < self.threshold:
+                ok_count, failed = self.ok_count, self.failed_refreshes
+                judged = self.verdict.wait_for(
+                    lambda: self.token != sent_token or self.ok_count != ok_count or self.failed_refreshes != failed,
+                    timeout=self.verdict_wait)
+                if not judged:
+                    return True # Nobody else to judge the token: look again
+                return self.token != sent_token
+        return self.refresh(sent_token)
+
+    def refresh(self, stale_token):
+        with self.refresh_lock:
+            if self.token != stale_token:
+                return True # Another worker already refreshed it
+            if time.monotonic() < self.next_refresh_time:
+                return False
+            print(">>> Token rejected by the server. Re-harvesting a search token...")
+            session = None
+            try:
+                session = self.refresh_func()
+            except Exception as e:
+                print(f"Token refresh error: {e}")
+            new_token = url_token(session.get("api_url")) if session else None
+            if not new_token:
+                print(f">>> Token refresh failed. Retrying in {TOKEN_REFRESH_COOLDOWN}s at the earliest.")
+                self.next_refresh_time = time.monotonic() + TOKEN_REFRESH_COOLDOWN
+                with self.lock:
+                    self.suspect_count = 0
+                    self.failed_refreshes += 1
+                    self.verdict.notify_all()
+                return False
+            with self.lock:
+                self.cookies = session.get("cookies")
+                self.token = new_token
+                self.suspect_count = 0
+                self.verdict.notify_all()
+            print(">>> Token refreshed. Resuming.")
+            return True
+
+
+class RequestMemo:
+    """
+    Run-scoped single-flight cache of response bodies (bytes). The first call for a
+    key does the request, concurrent callers for the same key wait for that answer,
+    and later callers get the stored one. Failures (None) are shared with the waiters
+    but not stored, so a later occurrence tries again. Oldest entries go first past
+    the limits.
+    """
+    def __init__(self, max_entries=MEMO_MAX_ENTRIES, max_bytes=MEMO_MAX_BYTES):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.entries = collections.OrderedDict()
+        self.bytes = 0
+        self.in_flight = {}
+        self.hits = 0
+        self.lock = threading.Lock()
+
+    def get(self, key, func):
+        with self.lock:
+            if key in self.entries:
+                self.entries.move_to_end(key)
+                self.hits += 1
+                return self.entries[key]
+            future = self.in_flight.get(key)
+            owner = future is None
+            if owner:
+                future = self.in_flight[key] = concurrent.futures.Future()
+            else:
+                self.hits += 1
+        if not owner:
+            return future.result()
+
+        try:
+            result = func()
+        except BaseException as e:
+            with self.lock:
+                self.in_flight.pop(key, None)
+            future.set_exception(e)
+            raise
+        with self.lock:
+            self.in_flight.pop(key, None)
+            if result is not None:
+                self.entries[key] = result
+                self.bytes += len(result)
+                while self.entries and (len(self.entries) > self.max_entries or self.bytes > self.max_bytes):
+                    _, old = self.entries.popitem(last=False)
+                    self.bytes -= len(old)
+        future.set_result(result)
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+            self.bytes = 0
+
+
+def run_memoized(key_func):
+    """
+    Collapses repeated fetches within one run through the session's RequestMemo.
+    func returns the raw response body (or None); the memo keeps only those bytes
+    and every caller gets its own parsed JSON, or the bytes with raw=True.
+    key_func gets the call's arguments after api_context and returns the memo key
+    (leave out anything that doesn't change the answer, like the token).
+    """
+    def decorate(func):
+        @functools.wraps(func)
+        def wrapper(api_context, *args, raw=False, **kwargs):
+            memo = getattr(api_context, "memo", None)
+            if memo is None:
+                body = func(api_context, *args, **kwargs)
+            else:
+                body = memo.get(key_func(*args, **kwargs), lambda: func(api_context, *args, **kwargs))
+            if raw or body is None:
+                return body
+            try:
+                return json.loads(body)
+            except ValueError as e:
+                print(f"Error decoding {func.__name__} response: {e}")
+                return None
+        return wrapper
+    return decorate
+
+
+class ApiSession:
+    """
+    Shared, thread-safe HTTP client for the scrapers (replaces Playwright's context.request).
+    Playwright's sync API only works on the thread that started it, so worker pools
+    post through one requests.Session seeded with the browser cookies. Connections are
+    kept alive and pooled per host; known hosts get their own bounded pool (HOST_POOL_SIZES)
+    so a burst of workers waits for a free connection instead of opening new ones.
+    """
+    default_headers = {
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
+        "Connection": "keep-alive",
+    }
+    # Extra headers the portals expect, by host
+    host_headers = {
+        "muasamcong.mpi.gov.vn": {
+            "Origin": "https://muasamcong.mpi.gov.vn",
+            "Referer": "https://muasamcong.mpi.gov.vn/",
+        },
+    }
+
+    def __init__(self, cookies=None, pool_size=10, host_pool_sizes=None, token_manager=None):
+        self.session = requests.Session()
+        self.token_manager = token_manager
+        self.memo = RequestMemo()
+        self.session.headers.update(self.default_headers)
+        self._cookie_lock = threading.Lock()
+
+        # Fallback pool for any other host
+        self.session.mount("https://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+        self.session.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=pool_size))
+
+        # Per-host pools: sized to at least the caller's concurrency, blocking when exhausted
+        sizes = dict(HOST_POOL_SIZES)
+        sizes.update(host_pool_sizes or {})
+        for host, size in sizes.items():
+            adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max(size, pool_size), pool_block=True)
+            self.session.mount(f"https://{host}/", adapter)
+
+        self.update_cookies(cookies)
+
+    def update_cookies(self, cookies):
+        """Loads Playwright-style cookie dicts ({name, value, domain, path}) into the shared jar."""
+        with self._cookie_lock:
+            for c in cookies or []:
+                self.session.cookies.set(c.get("name"), c.get("value"), domain=c.get("domain"), path=c.get("path", "/"))
+
+    def _headers_for(self, url, headers):
+        host = urllib.parse.urlparse(url).hostname or ""
+        merged = dict(self.host_headers.get(host, {}))
+        merged.update(headers or {})
+        return merged
+
+    def _send(self, method, url, headers=None, **kwargs):
+        tm = self.token_manager if url_token(url) is not None else None
+        # Suspect empty bodies are sent again until the threshold forces a refresh,
+        # then once more with the refreshed token
+        attempts = tm.threshold + 1 if tm else 1
+        for attempt in range(attempts):
+            sent_token = tm.token if tm else None
+            req_url = tm.apply(url, sent_token) if tm else url
+            resp = ApiResponse(send_with_retry(
+                self.session, method, req_url, headers=self._headers_for(req_url, headers),
+                verify=(urllib.parse.urlparse(req_url).hostname or "") not in HOST_SKIP_TLS_VERIFY, **kwargs
+            ))
+            if not tm or attempt == attempts - 1 or not tm.check(sent_token, resp):
+                return resp
+            self.update_cookies(tm.cookies)
+        return resp
+
+    def post(self, url, data=None, headers=None, timeout=60):
+        # Same call shape as APIRequestContext.post: `data` is JSON-encoded
+        return self._send("POST", url, json=data, headers=headers, timeout=timeout)
+
+    def get(self, url, params=None, headers=None, timeout=60):
+        return self._send("GET", url, params=params, headers=headers, timeout=timeout)
+
+    def close(self):
+        self.memo.clear()
+        self.session.close()
+
+
+def run_ordered_pool(func, items, workers=1, check_status=None):
+    """
+    Yields (index, item, func(item)) in input order while up to `workers` calls run
+    concurrently. check_status() is polled between submissions and while waiting,
+    so pause blocks new work and stop (InterruptedError) cancels what is queued.
+    """
+    if workers <= 1:
+        for idx, item in enumerate(items):
+            if check_status: check_status()
+            yield idx, item, func(item)
+        return
+
+    executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers)
+    pending = {}
+    source = enumerate(items)
+    next_idx = 0
+    exhausted = False
+    try:
+        while True:
+            # Keep the window bounded so huge inputs don't queue everything up-front
+            while not exhausted and len(pending) < workers * 2:
+                if check_status: check_status()
+                try:
+                    idx, item = next(source)
+                except StopIteration:
+                    exhausted = True
+                    break
+                pending[idx] = (item, executor.submit(func, item))
+
+            if next_idx not in pending:
+                break
+
+            item, future = pending.pop(next_idx)
+            while True:
+                try:
+                    result = future.result(timeout=1)
+                    break
+                except concurrent.futures.TimeoutError:
+                    if check_status: check_status()
+            yield next_idx, item, result
+            next_idx += 1
+    finally:
+        for _, future in pending.values():
+            future.cancel()
+        executor.shutdown(wait=True)
+
+
+class RateLimiter:
+    """
+    Spaces calls to wait() at least 1/rate seconds apart across all threads,
+    so concurrent workers stay within a fixed requests-per-second budget.
+    rate <= 0 disables the limit.
+    """
+    def __init__(self, rate):
+        self.interval = 1.0 / rate if rate and rate > 0 else 0
+        self.next_time = 0.0
+        self.lock = threading.Lock()
+
+    def wait(self):
+        if not self.interval: return
+        with self.lock:
+            now = time.monotonic()
+            slot = max(now, self.next_time)
+            self.next_time = slot + self.interval
+        if slot > now:
+            time.sleep(slot - now)
+
+
+class StagePipeline:
+    """
+    Streams items through a chain of stages joined by bounded queues, so an item
+    enters stage N+1 as soon as stage N is done with it.
+
+    stages: [(name, func, workers)] where func(payload) -> (outputs, next_payload).
+    on_output(name, index, outputs) runs on the calling thread, in input order per
+    stage. Every item passes every stage; a stage with nothing to do for an item
+    just returns empty outputs and forwards the payload. When a stage raises, the
+    error is logged once and the item goes on as FAILED: later stages are not
+    called for it and report no outputs.
+    check_status (pause/stop) runs on the calling thread and in every worker before
+    each func call, so a pause holds the requests of items already queued too.
+    """
+    FAILED = object()
+
+    def __init__(self, stages, queue_size=50):
+        self.stages = stages
+        self.queue_size = queue_size
+
+    def run(self, items, on_output, check_status=None):
+        queues = [queue.Queue(maxsize=self.queue_size) for _ in self.stages]
+        results = queue.Queue()
+        abort = threading.Event()
+        last = len(self.stages) - 1
+
+        def put(q, value):
+            # Blocking put that gives up once the pipeline is torn down
+            while not abort.is_set():
+                try:
+                    q.put(value, timeout=0.5)
+                    return
+                except queue.Full:
+                    pass
+
+        def worker(stage_idx):
+            name, func, _ = self.stages[stage_idx]
+            while not abort.is_set():
+                try:
+                    job = queues[stage_idx].get(timeout=0.5)
+                except queue.Empty:
+                    continue
+                if job is None:
+                    return
+                idx, payload = job
+                if payload is self.FAILED:
+                    outputs, next_payload = None, self.FAILED
+                else:
+                    try:
+                        if check_status: check_status()
+                    except InterruptedError:
+                        return # Stopped: the calling thread raises it too and tears down
+                    try:
+                        outputs, next_payload = func(payload)
+                    except Exception as e:
+                        print(f"  Error in stage '{name}' (item {idx + 1}): {e}. Later stages skip this item.")
+                        outputs, next_payload = None, self.FAILED
+                results.put((stage_idx, idx, outputs))
+                if stage_idx < last:
+                    put(queues[stage_idx + 1], (idx, next_payload))
+
+        threads = []
+        for stage_idx, (_, _, workers) in enumerate(self.stages):
+            for _ in range(max(1, workers)):
+                t = threading.Thread(target=worker, args=(stage_idx,), daemon=True)
+                t.start()
+                threads.append(t)
+
+        # Per-stage reorder buffers so sinks see items in input order
+        pending = [{} for _ in self.stages]
+        next_idx = [0] * len(self.stages)
+        source = iter(items)
+        staged = None
+        fed = 0
+        exhausted = False
+        try:
+            while True:
+                if check_status: check_status()
+
+                while not exhausted:
+                    if staged is None:
+                        try:
+                            staged = (fed, next(source))
+                        except StopIteration:
+                            exhausted = True
+                            break
+                    try:
+                        queues[0].put_nowait(staged)
+                    except queue.Full:
+                        break
+                    staged = None
+                    fed += 1
+
+                if exhausted and next_idx[last] >= fed:
+                    break
+
+                try:
+                    stage_idx, idx, outputs = results.get(timeout=0.5)
+                except queue.Empty:
+                    continue
+
+                pending[stage_idx][idx] = outputs
+                buf = pending[stage_idx]
+                while next_idx[stage_idx] in buf:
+                    i = next_idx[stage_idx]
+                    out = buf.pop(i)
+                    if out is not None:
+                        on_output(self.stages[stage_idx][0], i, out)
+                    next_idx[stage_idx] += 1
+        finally:
+            abort.set()
+            for t in threads:
+                t.join()
+
+
+# --- Search Session Cache (browserless mode) ---
+_search_session_lock = threading.Lock()
+
+def _read_json_file(path, default):
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return default
+
+def _write_json_file(path, data):
+    # Write to a temp file first so a crash never leaves a half-written file behind
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "w", encoding="utf-8") as f:
+        json.dump(data, f, ensure_ascii=False, indent=1)
+    os.replace(tmp_path, path)
+
+def search_session_key(kind, **params):
+    """Stable key for a saved search: same kind + same form inputs -> same key."""
+    raw = json.dumps({"kind": kind, **params}, sort_keys=True, ensure_ascii=False)
+    return hashlib.sha1(raw.encode("utf-8")).hexdigest()
+
+def load_search_session(key):
+    with _search_session_lock:
+        sessions = _read_json_file(SEARCH_SESSION_FILE, {})
+    session = sessions.get(key)
+    if session and session.get("api_url") and session.get("payload"):
+        return session
+    return None
+
+def save_search_session(key, session):
+    """Persists the captured smart/search URL (with token), payload template and cookies."""
+    try:
+        with _search_session_lock:
+            sessions = _read_json_file(SEARCH_SESSION_FILE, {})
+            sessions[key] = {
+                "api_url": session["api_url"],
+                "payload": session["payload"],
+                "cookies": session.get("cookies") or [],
+                "query_text": session.get("query_text"),
+                "exclude_text": session.get("exclude_text"),
+                "saved_at": datetime.now().isoformat(timespec="seconds"),
+            }
+            _write_json_file(SEARCH_SESSION_FILE, sessions)
+    except Exception as e:
+        print(f"Warning: Could not save search session: {e}")
+
+
+# --- Incremental Sync Watermarks ---
+_watermark_lock = threading.Lock()
+
+def load_sync_watermark(key):
+    """Latest notice seen by the last finished sync of a search: {"public_date", "notify_nos"} or None."""
+    with _watermark_lock:
+        return _read_json_file(SYNC_WATERMARK_FILE, {}).get(key)
+
+def save_sync_watermark(key, watermark):
+    try:
+        with _watermark_lock:
+            marks = _read_json_file(SYNC_WATERMARK_FILE, {})
+            marks[key] = dict(watermark, saved_at=datetime.now().isoformat(timespec="seconds"))
+            _write_json_file(SYNC_WATERMARK_FILE, marks)
+    except Exception as e:
+        print(f"Warning: Could not save sync watermark: {e}")
+
+def item_public_date(item):
+    """originalPublicDate of a search item as 'YYYY-MM-DD HH:MM:SS' (sortable), or ''."""
+    val = item.get("originalPublicDate") or item.get("publicDate") or ""
+    return str(val)[:19].replace("T", " ")
+
+def is_new_since(item, watermark):
+    """True if a search item was published after the watermark (ties broken by notifyNo)."""
+    pub = item_public_date(item)
+    if not pub or pub > watermark["public_date"]:
+        return True
+    return pub == watermark["public_date"] and item.get("notifyNo") not in watermark["notify_nos"]
+
+def advance_watermark(watermark, items):
+    """Returns the watermark moved forward to the newest of items (input is not modified)."""
+    wm = {"public_date": watermark.get("public_date", ""), "notify_nos": list(watermark.get("notify_nos", []))}
+    for item in items:
+        pub = item_public_date(item)
+        if not pub: continue
+        if pub > wm["public_date"]:
+            wm = {"public_date": pub, "notify_nos": []}
+        if pub == wm["public_date"] and item.get("notifyNo") and item.get("notifyNo") not in wm["notify_nos"]:
+            wm["notify_nos"].append(item.get("notifyNo"))
+    return wm
+
+def hold_watermark(watermark, seen_dates, unfinished):
+    """
+    Watermark pulled back so the notices in `unfinished` (keys whose Phases 2-4 did not
+    all succeed) count as new for the next sync. seen_dates: notifyNo -> item_public_date
+    of the notices found by this sync. None when an unfinished notice has no known date
+    (e.g. a resumed run): the watermark must then not move at all.
+    """
+    if not unfinished:
+        return watermark
+    if any(k not in seen_dates for k in unfinished):
+        return None
+    dates = [seen_dates[k] for k in unfinished if seen_dates[k]]
+    if not dates:
+        return watermark # Undated notices are always new
+    oldest = min(dates)
+    if oldest >= watermark.get("public_date", ""):
+        notify_nos = [n for n in watermark.get("notify_nos", []) if n not in unfinished]
+    else:
+        notify_nos = [k for k, d in seen_dates.items() if d == oldest and k not in unfinished]
+    return {"public_date": oldest, "notify_nos": notify_nos}
+
+def probe_search_session(session, timeout=30):
+    """True when the saved smart/search token still returns a result page."""
+    client = ApiSession(session.get("cookies"))
+    try:
+        payload = json.loads(json.dumps(session["payload"])) # deep copy, the template stays untouched
+        payload_obj = payload[0] if isinstance(payload, list) else payload
+        payload_obj["pageNumber"] = 0
+        payload_obj["pageSize"] = 1
+        resp = client.post(session["api_url"], data=payload, timeout=timeout)
+        if not resp.ok:
+            return False
+        data = resp.json()
+        return isinstance(data, list) or (isinstance(data, dict) and ("page" in data or "content" in data))
+    except Exception:
+        return False
+    finally:
+        client.close()
+
+
+# --- Resume Journal ---
+class RunJournal:
+    """
+    Append-only completion log (JSON lines) kept next to the run's temp CSVs.
+    Each line records that one notice finished one phase, optionally with a small
+    value the next phase needs (e.g. the Phase 3 input found by Phase 2), so a
+    restarted run can skip exactly what is already on disk.
+    """
+    def __init__(self, path):
+        self.path = path
+        self.entries = {}
+        self.lock = threading.Lock()
+        if os.path.exists(path):
+            with open(path, "r", encoding="utf-8") as f:
+                for line in f:
+                    try:
+                        rec = json.loads(line)
+                    except ValueError:
+                        continue # Torn last line after a crash
+                    phase_entries = self.entries.setdefault(rec["phase"], {})
+                    if rec.get("removed"):
+                        phase_entries.pop(rec["key"], None)
+                    else:
+                        phase_entries[rec["key"]] = rec.get("value")
+
+    def done(self, phase, key):
+        return key in self.entries.get(phase, {})
+
+    def get(self, phase, key):
+        return self.entries.get(phase, {}).get(key)
+
+    def count(self, phase):
+        return len(self.entries.get(phase, {}))
+
+    def _append(self, records):
+        if not records: return
+        with self.lock:
+            with open(self.path, "a", encoding="utf-8") as f:
+                for rec in records:
+                    f.write(json.dumps(rec, ensure_ascii=False) + "\n")
+                f.flush()
+                os.fsync(f.fileno())
+            for rec in records:
+                phase_entries = self.entries.setdefault(rec["phase"], {})
+                if rec.get("removed"):
+                    phase_entries.pop(rec["key"], None)
+                else:
+                    phase_entries[rec["key"]] = rec.get("value")
+
+    def mark(self, phase, key, value=None):
+        self.mark_many(phase, [(key, value)])
+
+    def mark_many(self, phase, items):
+        """items: iterable of (key, value). Call only after their outputs are saved."""
+        self._append([{"phase": phase, "key": k, "value": v} for k, v in items])
+
+    def remove(self, phase, key):
+        self.remove_many(phase, [key])
+
+    def remove_many(self, phase, keys):
+        self._append([{"phase": phase, "key": k, "removed": True} for k in keys if self.done(phase, k)])
+
+
+def contractor_run_pending(output_path):
+    """
+    True when the run_contractor_selection() run writing output_path left work behind:
+    it was stopped or crashed (no "finished" record in its resume journal), or it
+    finished with notices whose Phases 2-4 did not all succeed.
+    """
+    journal_path = os.path.join(os.path.dirname(os.path.abspath(output_path)), "temp",
+                                os.path.basename(output_path).replace(".xlsx", ".journal.jsonl"))
+    if not os.path.exists(journal_path):
+        return False
+    journal = RunJournal(journal_path)
+    return not journal.done("run", "finished") or bool(journal.get("run", "finished"))
+
+
+def notice_key(row):
+    """Stable key of a Phase 1 row for the resume journal (Mã TBMT, else the API id)."""
+    for col in ("Mã TBMT", "id"):
+        val = row.get(col)
+        if val is not None and not pd.isna(val) and str(val).strip():
+            return str(val).strip()
+    return None
+
+
+# --- Search Pagination Helpers ---
+def extract_search_items(response_json):
+    """Returns the result list of a smart/search response (handles the known shapes)."""
+    items = []
+    try:
+        # Handle possible structures
+        if "page" in response_json and "content" in response_json["page"]:
+            items = response_json["page"]["content"]
+        elif "content" in response_json:
+            items = response_json["content"]
+        elif isinstance(response_json, list):
+            items = response_json
+    except: pass
+    return items or []
+
+
+def search_total_count(response_json):
+    """totalElements of a search response, or None."""
+    try:
+        page = response_json["page"] if "page" in response_json else response_json
+        if page.get("totalElements") is not None:
+            return int(page["totalElements"])
+    except: pass
+    return None
+
+
+def search_page_count(response_json, page_size):
+    """Total number of pages reported by a search response, or None if it has no paging info."""
+    try:
+        page = response_json["page"] if "page" in response_json else response_json
+        if page.get("totalPages") is not None:
+            return int(page["totalPages"])
+        if page.get("totalElements") is not None:
+            return -(-int(page["totalElements"]) // page_size)
+    except: pass
+    return None
+
+
+def fetch_search_page(api_context, api_url, base_payload, page_num, page_size, limiter=None):
+    """
+    POSTs the captured search payload for one page (pageNumber/pageSize overridden).
+    Each call works on its own copy of the payload so pages can be fetched concurrently.
+    Returns the response JSON, or None once the session's retries are exhausted.
+    """
+    payload = copy.deepcopy(base_payload)
+    payload_obj = payload[0] if isinstance(payload, list) else payload
+    payload_obj["pageSize"] = page_size
+    payload_obj["pageNumber"] = page_num
+
+    if limiter: limiter.wait()
+    try:
+        resp = api_context.post(api_url, data=payload)
+        if resp.ok:
+            return resp.json()
+        print(f"API Error {resp.status} (page {page_num}): {resp.status_text}")
+    except Exception as e:
+        print(f"Request failed (page {page_num}): {e}")
+    return None
+
+
+def fetch_search_all(api_context, api_url, payload, page_size, limiter=None):
+    """All result items of one search (pages fetched in order). None if a page failed."""
+    items = []
+    page_num = 0
+    while True:
+        response_json = fetch_search_page(api_context, api_url, payload, page_num, page_size, limiter)
+        if not response_json:
+            return None
+        got = extract_search_items(response_json)
+        items.extend(got)
+        total_pages = search_page_count(response_json, page_size)
+        page_num += 1
+        if not got or (total_pages is not None and page_num >= total_pages):
+            return items
+
+
+def replace_payload_text(payload, old_text, new_text):
+    """
+    Copy of a captured search payload with every string equal to old_text (the text
+    typed into the search box) replaced by new_text. Returns (payload, replacements).
+    """
+    count = [0]
+    def walk(v):
+        if isinstance(v, dict):
+            return {k: walk(x) for k, x in v.items()}
+        if isinstance(v, list):
+            return [walk(x) for x in v]
+        if isinstance(v, str) and old_text and v.strip() == old_text.strip():
+            count[0] += 1
+            return new_text
+        return v
+    return walk(payload), count[0]
+
+
+# --- Date Range Sharding ---
+_ISO_DATE_RE = re.compile(r"^(\d{4})-(\d{2})-(\d{2})(?:([T ])(\d{2}):(\d{2})(?::(\d{2}))?(\.\d+)?)?(.*)$")
+_DMY_DATE_RE = re.compile(r"^(\d{2})/(\d{2})/(\d{4})(.*)$")
+_EPOCH = datetime(1970, 1, 1)
+
+def _parse_payload_date(v):
+    """(datetime, rebuild) for a date-looking payload value; rebuild(dt) writes dt back in the same format."""
+    if isinstance(v, bool):
+        return None
+    if isinstance(v, int) and 10**11 < v < 10**14:
+        # Epoch milliseconds
+        return _EPOCH + timedelta(milliseconds=v), lambda d: int((d - _EPOCH).total_seconds() * 1000)
+    if not isinstance(v, str):
+        return None
+    try:
+        m = _ISO_DATE_RE.match(v)
+        if m:
+            y, mo, d, sep, h, mi, sec, frac, tail = m.groups()
+            dt = datetime(int(y), int(mo), int(d), int(h or 0), int(mi or 0), int(sec or 0))
+            def rebuild(nd):
+                out = nd.strftime("%Y-%m-%d")
+                if sep:
+                    out += sep + nd.strftime("%H:%M") + (nd.strftime(":%S") if sec is not None else "") + (frac or "")
+                return out + tail
+            return dt, rebuild
+        m = _DMY_DATE_RE.match(v)
+        if m:
+            d, mo, y, tail = m.groups()
+            return datetime(int(y), int(mo), int(d)), lambda nd: nd.strftime("%d/%m/%Y") + tail
+    except ValueError:
+        pass
+    return None
+
+def locate_date_fields(payload, from_date, to_date):
+    """
+    Finds the values of a captured search payload that encode the form's from/to dates
+    (any of ISO, dd/mm/yyyy or epoch ms, possibly shifted by a timezone).
+    Returns [(path, role, offset, rebuild)] or None when either end is missing.
+    """
+    try:
+        start = datetime.strptime(from_date.strip(), "%d/%m/%Y")
+        end = datetime.strptime(to_date.strip(), "%d/%m/%Y")
+    except (ValueError, AttributeError):
+        return None
+
+    fields = []
+    def walk(v, path):
+        if isinstance(v, dict):
+            for k, x in v.items(): walk(x, path + (k,))
+        elif isinstance(v, list):
+            for i, x in enumerate(v): walk(x, path + (i,))
+        else:
+            parsed = _parse_payload_date(v)
+            if not parsed: return
+            dt, rebuild = parsed
+            d_from, d_to = dt - start, dt - end
+            # Within a day either way covers UTC shifts and end-of-day times
+            candidates = [(abs(d_from), "from", d_from), (abs(d_to), "to", d_to)]
+            best = min((c for c in candidates if c[0] <= timedelta(days=1)), default=None, key=lambda c: c[0])
+            if best:
+                fields.append((path, best[1], best[2], rebuild))
+    walk(payload, ())
+    roles = {f[1] for f in fields}
+    return fields if roles == {"from", "to"} else None
+
+def payload_for_window(payload, fields, window):
+    """Copy of payload with the located date fields moved to window = (start_date, end_date)."""
+    payload = copy.deepcopy(payload)
+    for path, role, offset, rebuild in fields:
+        day = window[0] if role == "from" else window[1]
+        target = payload
+        for key in path[:-1]:
+            target = target[key]
+        target[path[-1]] = rebuild(datetime(day.year, day.month, day.day) + offset)
+    return payload
+
+def month_windows(start, end):
+    """Calendar-month windows [(start, end)] covering start..end (dates, inclusive)."""
+    windows = []
+    cur = start
+    while cur <= end:
+        next_month = (cur.replace(day=1) + timedelta(days=32)).replace(day=1)
+        windows.append((cur, min(end, next_month - timedelta(days=1))))
+        cur = next_month
+    return windows
+
+def split_window(window):
+    """Month -> 7-day windows, week -> single days. Single days can't be split."""
+    start, end = window
+    step = 7 if (end - start).days >= 7 else 1
+    parts = []
+    cur = start
+    while cur <= end:
+        parts.append((cur, min(end, cur + timedelta(days=step - 1))))
+        cur += timedelta(days=step)
+    return parts
+
+def window_label(window):
+    return f"{window[0].strftime('%d/%m/%Y')}-{window[1].strftime('%d/%m/%Y')}"
+
+def plan_date_shards(payload, from_date, to_date):
+    """Date fields to shard on, or None when the range is short or the payload has no usable dates."""
+    fields = locate_date_fields(payload, from_date, to_date) if from_date and to_date else None
+    if not fields:
+        return None
+    start = datetime.strptime(from_date.strip(), "%d/%m/%Y")
+    end = datetime.strptime(to_date.strip(), "%d/%m/%Y")
+    return fields if (end - start).days > SHARD_MIN_DAYS else None
+
+def run_sharded_search(api_context, api_url, payload, fields, from_date, to_date, page_size, on_items,
+                       limiter=None, workers=1, check_status=None, journal=None):
+    """
+    Phase 1 over from_date..to_date as date windows searched concurrently. A window
+    whose result count is over SHARD_MAX_RESULTS is split (month -> weeks -> days)
+    before its pages are fetched. on_items(items) runs on the calling thread once per
+    finished window; with a RunJournal, finished windows are checkpointed and skipped
+    on the next run. Returns the number of windows that failed.
+    """
+    start = datetime.strptime(from_date.strip(), "%d/%m/%Y").date()
+    end = datetime.strptime(to_date.strip(), "%d/%m/%Y").date()
+
+    def search_window(window):
+        win_payload = payload_for_window(payload, fields, window)
+        first = fetch_search_page(api_context, api_url, win_payload, 0, page_size, limiter)
+        if not first:
+            return "failed", None
+        total = search_total_count(first)
+        if total is not None and total > SHARD_MAX_RESULTS and window[0] < window[1]:
+            return "split", split_window(window)
+        items = extract_search_items(first)
+        total_pages = search_page_count(first, page_size)
+        page_num = 1
+        while items and (total_pages is None or page_num < total_pages):
+            if check_status: check_status()
+            resp = fetch_search_page(api_context, api_url, win_payload, page_num, page_size, limiter)
+            if not resp:
+                return "failed", None
+            got = extract_search_items(resp)
+            if not got: break
+            items.extend(got)
+            page_num += 1
+        return "done", items
+
+    windows = month_windows(start, end)
+    failed = 0
+    while windows:
+        todo = [w for w in windows if not (journal and journal.done("window", window_label(w)))]
+        if len(todo) < len(windows):
+            print(f"  {len(windows) - len(todo)} date windows already done (checkpoint), skipped.")
+        print(f"--- Searching {len(todo)} date windows (Workers: {workers}) ---")
+        windows = []
+        for _, window, (state, result) in run_ordered_pool(search_window, todo, workers, check_status):
+            label = window_label(window)
+            if state == "failed":
+                print(f"  Window {label}: failed after retries, skipped.")
+                failed += 1
+            elif state == "split":
+                print(f"  Window {label}: over {SHARD_MAX_RESULTS} results, splitting into {len(result)}.")
+                windows.extend(result)
+            else:
+                print(f"  Window {label}: {len(result)} items.")
+                on_items(result)
+                if journal: journal.mark("window", label)
+    return failed
+
+
+# --- IB List Helpers ---
+def normalize_ib_code(code):
+    """'ib2400012345-00 ' -> 'IB2400012345' (version suffix dropped) so codes and notifyNo compare."""
+    return re.sub(r"-\d+$", "", str(code or "").strip().upper())
+
+def parse_ib_codes(ib_list):
+    """Splits a pasted/uploaded IB list (commas, semicolons, spaces, new lines) into unique codes, in order."""
+    codes = []
+    seen = set()
+    for part in re.split(r"[,;\s]+", ib_list or ""):
+        code = normalize_ib_code(part)
+        if code and code not in seen:
+            seen.add(code)
+            codes.append(code)
+    return codes
+
+
+@run_memoized(lambda token, bid_id: ("lcnt_tbmt_ttc_ldt", bid_id))
 def fetch_bid_detail(api_context, token, bid_id):
     url = f"https://muasamcong.mpi.gov.vn/o/egp-portal-contractor-selection-v2/services/lcnt_tbmt_ttc_ldt?token={token}"
     headers = {
@@ -81,7 +1957,7 @@ def fetch_bid_detail(api_context, token, bid_id):
     try:
         response = api_context.post(url, data=payload, headers=headers)
         if response.ok:
-            return response.json()
+            return response.body()
         else:
             # print(f"Detail API Error {response.status}: {response.status_text}")
             return None
@@ -131,29 +2007,10 @@ def process_online_reoffer_detail(detail_json):
     plan = detail_json.get("bidPlan", {}) or {}
     bid_detail = detail_json.get("bidDetail", {}) or {}
     
-    def get_date(iso):
-        if not iso: return ""
-        try:
-            return iso.split("T")[0]
-        except: return iso
-        
-    def get_datetime(iso):
-         if not iso: return ""
-         try:
-            return iso.replace("T", " ").split(".")[0]
-         except: return iso
-
     def map_val(val, mapping):
         s = str(val) if val is not None else ""
         return mapping.get(s, s)
         
-    def format_currency(val):
-        if val is None or val == "": return ""
-        try:
-            s = "{:,.0f}".format(float(val))
-            return s.replace(",", ".") + " VNĐ"
-        except: return str(val)
-
     unit_map = {"D": "Ngày", "M": "Tháng", "Y": "Năm", "W": "Tuần", "Q": "Quý"}
     def format_period(val, unit):
         v = str(val) if val is not None else ""
@@ -165,7 +2022,7 @@ def process_online_reoffer_detail(detail_json):
 
     return {
         "Mã TBMT": m.get("notifyNo") or m.get("reofferNo"),
-        "Ngày đăng tải": get_datetime(m.get("publicDate")),
+        "Ngày đăng tải": api_datetime(m.get("publicDate")),
         "Mã KHLCNT": m.get("planNo"),
         "Phân loại KHLCNT": map_val(m.get("planType"), {"TX": "Chi thường xuyên", "DT": "Đầu tư phát triển"}),
         "Tên dự toán mua sắm": m.get("planName") or m.get("projectName"),
@@ -184,13 +2041,13 @@ def process_online_reoffer_detail(detail_json):
         "Địa điểm phát hành e-HSMT": "",
         "Địa điểm nhận e-HSDT": "",
         "Địa điểm thực hiện gói thầu": "",
-        "Thời điểm đóng thầu": get_datetime(m.get("reofferCloseDate")),
-        "Thời điểm mở thầu": get_datetime(m.get("reofferOpenDate")),
+        "Thời điểm đóng thầu": api_datetime(m.get("reofferCloseDate")),
+        "Thời điểm mở thầu": api_datetime(m.get("reofferOpenDate")),
         "Hiệu lực hồ sơ dự thầu": format_period(m.get('bidValidityPeriod'), m.get('bidValidityPeriodUnit') or ""),
         "Số tiền bảo đảm dự thầu": "",
         "Hình thức đảm bảo dự thầu": "",
         "Số quyêt định phê duyệt": plan.get("decisionNo"),
-        "Ngày phê duyệt": get_date(plan.get("decisionDate")),
+        "Ngày phê duyệt": api_date(plan.get("decisionDate")),
         "Cơ quan ban hành quyết định": plan.get("decisionAgency")
     }
 
@@ -209,30 +2066,10 @@ def process_detail_data(detail_json):
         status_obj = detail_json.get("bidoBidStatusDTO", {}) or {}
     
     # Helpers
-    def get_date(iso):
-        if not iso: return ""
-        try:
-            return iso.split("T")[0]
-        except: return iso
-        
-    def get_datetime(iso):
-         if not iso: return ""
-         try:
-            return iso.replace("T", " ").split(".")[0]
-         except: return iso
-
     def map_val(val, mapping):
         s = str(val) if val is not None else ""
         return mapping.get(s, s)
         
-    def format_currency(val):
-        if val is None or val == "": return ""
-        try:
-            # Format: 9.422.000 VNĐ
-            s = "{:,.0f}".format(float(val))
-            return s.replace(",", ".") + " VNĐ"
-        except: return str(val)
-
     unit_map = {"D": "Ngày", "M": "Tháng", "Y": "Năm", "W": "Tuần", "Q": "Quý"}
     def format_period(val, unit):
         v = str(val) if val is not None else ""
@@ -272,7 +2109,7 @@ def process_detail_data(detail_json):
     # Mapping
     return {
         "Mã TBMT": m.get("notifyNo"),
-        "Ngày đăng tải": get_datetime(m.get("publicDate")),
+        "Ngày đăng tải": api_datetime(m.get("publicDate")),
         "Mã KHLCNT": m.get("planNo"),
         "Phân loại KHLCNT": map_val(m.get("planType"), {"TX": "Chi thường xuyên", "DT": "Đầu tư phát triển"}),
         "Tên dự toán mua sắm": m.get("planName") or m.get("projectName") or m.get("pName"),
@@ -291,13 +2128,13 @@ def process_detail_data(detail_json):
         "Địa điểm phát hành e-HSMT": m.get("issueLocation"),
         "Địa điểm nhận e-HSDT": m.get("receiveLocation"),
         "Địa điểm thực hiện gói thầu": loc_str,
-        "Thời điểm đóng thầu": get_datetime(m.get("bidCloseDate")),
-        "Thời điểm mở thầu": get_datetime(m.get("bidOpenDate")),
+        "Thời điểm đóng thầu": api_datetime(m.get("bidCloseDate")),
+        "Thời điểm mở thầu": api_datetime(m.get("bidOpenDate")),
         "Hiệu lực hồ sơ dự thầu": format_period(m.get('bidValidityPeriod'), m.get('bidValidityPeriodUnit')),
-        "Số tiền bảo đảm dự thầu": format_currency(m.get("guaranteeValue") or m.get("bidGuaranteeValue")),
+        "Số tiền bảo đảm dự thầu": api_number(m.get("guaranteeValue") or m.get("bidGuaranteeValue")),
         "Hình thức đảm bảo dự thầu": m.get("guaranteeForm") or m.get("bidGuaranteeForm"),
         "Số quyêt định phê duyệt": contractor.get("decisionNo"),
-        "Ngày phê duyệt": get_date(contractor.get("decisionDate")),
+        "Ngày phê duyệt": api_date(contractor.get("decisionDate")),
         "Cơ quan ban hành quyết định": contractor.get("decisionAgency")
     }
 
@@ -345,6 +2182,7 @@ def fetch_bid_open(api_context, token, notify_no, notify_id):
          print(f"Error fetching bid-open: {e}")
     return None
 
+@run_memoized(lambda token, bid_id: ("contractor-input-result", bid_id))
 def fetch_contractor_input_result(api_context, token, bid_id):
     url = f"https://muasamcong.mpi.gov.vn/o/egp-portal-contractor-selection-v2/services/expose/contractor-input-result/get?token={token}"
     headers = {
@@ -357,104 +2195,616 @@ def fetch_contractor_input_result(api_context, token, bid_id):
     try:
         response = api_context.post(url, data=payload, headers=headers)
         if response.ok:
-            return response.json()
+            # raw=True callers get the undecoded body, so the JSON work can happen off the download thread
+            return response.body()
     except Exception as e:
         print(f"Error fetching contractor-input-result: {e}")
     return None
 
+@run_memoized(lambda bid_id: ("bid-pack-info", bid_id))
+def fetch_bid_pack_detail(api_context, bid_id):
+    url = "https://muasamcong.mpi.gov.vn/api/unau/portal/ebid/bid-pack-info/get-detail"
+    headers = {
+        "Content-Type": "application/json",
+        "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
+    }
+    payload = {"body": {"id": bid_id}}
+    try:
+        # Note: This is a different host/endpoint structure, usually doesn't need token if unau/portal?
+        # But headers usually needed.
+        resp = api_context.post(url, data=payload, headers=headers)
+        if resp.ok:
+            return resp.body()
+    except Exception as e:
+        print(f"Error fetching bid-pack-info: {e}")
+    return None
+
+def process_bid_pack_rows(pack_json, row):
+    """Builds the "Hồ sơ mời thầu" rows (one per lot) from a bid-pack-info response and its Phase 1 row."""
+    rows = []
+    if not pack_json or "body" not in pack_json:
+        return rows
+    body = pack_json["body"]
+    notif = body.get("bidNotification", {}) or {}
+
+    # Lot List Logic
+    lots = notif.get("lotDTOList")
+    if not lots:
+        lots = body.get("detailLotList")
+
+    if lots and isinstance(lots, list):
+        for lot in lots:
+            # Data Extraction Logic with multiple fallbacks
+            # 1. Bid Name
+            b_name = notif.get("bidName")
+            if not b_name: b_name = body.get("bidName")
+            if not b_name: b_name = row.get("Tên gói thầu", "")
+
+            # 2. Dates
+            d_open = notif.get("bidOpenDate")
+            d_close = notif.get("bidCloseDate")
+
+            if not d_close: d_close = row.get("Thời điểm đóng thầu", "")
+            final_open = api_datetime(d_open)
+            final_close = api_datetime(d_close)
+            if not final_close and row.get("Thời điểm đóng thầu"):
+                 final_close = api_datetime(row.get("Thời điểm đóng thầu"))
+            if not final_open and row.get("Thời điểm mở thầu"):
+                 final_open = api_datetime(row.get("Thời điểm mở thầu"))
+
+            r2 = {
+                "Mã TBMT": notif.get("notifyNo") if notif.get("notifyNo") else (body.get("linkNotifyInfo") or {}).get("notifyNo", row.get("Mã TBMT")),
+                "Tên gói thầu": b_name,
+                "Mã phần (Lô)": lot.get("lotNo"),
+                "Mã Thuốc": lot.get("medicineCode"),
+                "Tên hoạt chất/ Tên thành phần thuốc": lot.get("lotName"),
+                "Nồng độ/ hàm lượng": lot.get("nongDo"),
+                "Đường dùng": lot.get("duongDung"),
+                "Dạng bào chế": lot.get("dangBaoChe"),
+                "Đơn vị tính": lot.get("uom"),
+                "Số lượng": api_number(lot.get("quantity")),
+                "Giá trị ước tính từng phần (VND)": api_number(lot.get("lotPrice")),
+                "Giá kế hoạch": api_number(lot.get("pricePlan")),
+                "Nhóm thuốc": lot.get("groupMedicine"),
+                "Thời điểm mở thầu": final_open,
+                "Thời điểm đóng thầu": final_close
+            }
+            rows.append(r2)
+    return rows
+
+class DetailResolver:
+    """
+    Finds which general-info endpoint serves a notice: the normal TBMT detail,
+    online-reoffer/detail or the WB/ADB variant. It counts which endpoint answered
+    per notice signature (Phase 1 fields, see signature()); once one endpoint serves
+    DOMINANT_SHARE of a signature it is called alone first. The first notices of a
+    signature race all endpoints; a signature without a dominant endpoint uses the
+    sequential chain, so mixed notices never double the request volume. The answer is
+    always picked in the original fallback order (normal > reoffer > WB/ADB).
+    workers=0 disables racing (plain sequential fallback chain).
+    """
+    KINDS = ("normal", "reoffer", "wb_adb")
+    DOMINANT_SHARE = 0.9
+
+    def __init__(self, api_context, token, workers=DEFAULT_DETAIL_WORKERS):
+        self.api_context = api_context
+        self.token = token
+        self.stats = {}
+        self.lock = threading.Lock()
+        self.executor = None
+        if workers > 0:
+            self.executor = concurrent.futures.ThreadPoolExecutor(max_workers=workers * len(self.KINDS))
+
+    @staticmethod
+    def signature(row):
+        # Every Mã TBMT starts with "IB", so its prefix tells nothing: use the invest
+        # field and whether Phase 1 gave a bid id instead
+        field = str(row.get("Lĩnh vực") or "").strip()
+        bid_id = row.get("bidID")
+        has_bid = bid_id is not None and not pd.isna(bid_id) and str(bid_id).strip() != ""
+        return f"{field}|{'bid' if has_bid else 'no-bid'}"
+
+    def _fetch(self, kind, bid_id):
+        if kind == "normal":
+            return fetch_bid_detail(self.api_context, self.token, bid_id)
+        if kind == "reoffer":
+            return fetch_online_reoffer_detail(self.api_context, bid_id)
+        return fetch_wb_adb_detail(self.api_context, self.token, bid_id)
+
+    @staticmethod
+    def _usable(kind, d_json):
+        if not d_json: return False
+        if kind == "normal":
+            # Null case: the notice lives on one of the other endpoints
+            return not (d_json.get("bidoNotifyContractorM") is None and d_json.get("statusDT") is None)
+        return True
+
+    def candidates(self, sig):
+        """(endpoints to call first for this signature in fallback order, race them?)."""
+        with self.lock:
+            counts = dict(self.stats.get(sig, {}))
+        total = sum(counts.values())
+        if total < 3:
+            return list(self.KINDS), True # Not enough history yet: try everything
+        dominant = [k for k in self.KINDS if counts.get(k, 0) >= self.DOMINANT_SHARE * total]
+        if dominant:
+            return dominant, False
+        # Mixed signature: racing would send every notice to several endpoints
+        return list(self.KINDS), False
+
+    def _first_usable(self, kinds, bid_id, results, race=False):
+        """Calls kinds (concurrently when race) and returns the first usable one in order."""
+        if race and self.executor and len(kinds) > 1:
+            futures = [(k, self.executor.submit(self._fetch, k, bid_id)) for k in kinds]
+            try:
+                for k, future in futures:
+                    results[k] = future.result()
+                    if self._usable(k, results[k]):
+                        return k
+            finally:
+                for _, future in futures:
+                    future.cancel()
+            return None
+        for k in kinds:
+            results[k] = self._fetch(k, bid_id)
+            if self._usable(k, results[k]):
+                return k
+        return None
+
+    def resolve(self, row, bid_id):
+        """Returns (detail_row, detail_json) for a Phase 1 row; detail_row is None if nothing answered."""
+        sig = self.signature(row)
+        first, race = self.candidates(sig)
+        results = {}
+        hit = self._first_usable(first, bid_id, results, race)
+        if not hit:
+            rest = [k for k in self.KINDS if k not in first]
+            hit = self._first_usable(rest, bid_id, results) if rest else None
+
+        if not hit:
+            # Keep the normal payload (if any) for the Phase 3 lookup, as before
+            return None, results.get("normal")
+
+        with self.lock:
+            counts = self.stats.setdefault(sig, {})
+            counts[hit] = counts.get(hit, 0) + 1
+        if hit != "normal":
+            print(f"  [{row.get('Mã TBMT', bid_id)}] Detail served by {hit} endpoint.")
+        d_json = results[hit]
+        if hit == "reoffer":
+            return process_online_reoffer_detail(d_json), d_json
+        return process_detail_data(d_json), d_json
+
+    def close(self):
+        if self.executor:
+            self.executor.shutdown(wait=False, cancel_futures=True)
+
+
+def fetch_phase2_row(api_context, token, row, resolver=None):
+    """
+    Phase 2 work for a single Phase 1 row: general info (through the DetailResolver,
+    sequential fallback chain when none is given) and the bid-pack lots. Safe to run
+    from worker threads when api_context is an ApiSession.
+    Returns (detail_row, pack_rows, phase3_input); pack_rows is None when the
+    bid-pack request failed (as opposed to [] for a notice without lots).
+    """
+    bid_id = row.get("id")
+    # Use bidID from Phase 1 if available?
+    # User said: "use bidID from phase 1" for the new API.
+    # Phase 1 extraction: "bidID": item.get("bidId", "")
+    phase1_bid_id = row.get("bidID")
+
+    # Check which ID to use for which API?
+    # Existing fetch_bid_detail uses 'id' (bid_id here).
+    # New fetch_bid_pack_detail uses 'bidID' (phase1_bid_id).
+    # If phase1_bid_id is missing, maybe fallback to bid_id?
+    target_pack_id = phase1_bid_id if phase1_bid_id else bid_id
+
+    # --- SHEET 1: General Info ---
+    if resolver is None:
+        resolver = DetailResolver(api_context, token, workers=0)
+    d_row, d_json = resolver.resolve(row, bid_id)
+
+    phase3_input = None
+    try:
+        plan = d_json.get("bidpPlanDetail", {}) or d_json.get("bidPlan", {}) or {}
+        link_info_str = plan.get("linkNotifyInfo")
+        if link_info_str:
+             phase3_input = link_info_str
+        elif "reofferNo" in d_json:
+             # Append anyway so Phase 3 can query lotOpenDetail
+             phase3_input = json.dumps({"notifyNo": d_json.get("reofferNo"), "notifyId": bid_id})
+    except: pass
+
+    # --- SHEET 2: Ho so moi thau ---
+    pack_rows = []
+    if target_pack_id:
+        pack_json = fetch_bid_pack_detail(api_context, target_pack_id)
+        pack_rows = process_bid_pack_rows(pack_json, row) if pack_json is not None else None
+
+    return d_row, pack_rows, phase3_input
+
+def process_bid_open_rows(notify_no, lot_details, bid_opens):
+    """Joins lotOpenDetail lots with the bid-open submissions into "Bien ban mo thau" rows."""
+    # API 1 list
+    lot_list = lot_details if isinstance(lot_details, list) else []
+
+    # API 2 Map
+    bid_map = {} # Map bid_id (id in API 2) -> object
+    if bid_opens and "bidSubmissionByContractorViewResponse" in bid_opens:
+        sub_list = bid_opens["bidSubmissionByContractorViewResponse"].get("bidSubmissionDTOList", [])
+        if sub_list:
+            for sub in sub_list:
+                if "id" in sub:
+                    bid_map[sub["id"]] = sub
+
+    # Join (amounts stay numeric; 13545000 -> 13.545.000 at export)
+    rows = []
+    for lot in lot_list:
+         # Create Row
+         bid_open_id = lot.get("bidOpenId")
+         linked_bid = bid_map.get(bid_open_id, {})
+
+         row = {
+             "Mã TBMT": notify_no,
+             "Mã phân/ lô": lot.get("lotNo"),
+             "Tên thành phần thuốc": lot.get("lotName"),
+             "Mã định danh": lot.get("contractorCode"),
+             "Tên nhà thầu": lot.get("contractorName"),
+             "Hiệu lực HSDT (Ngày)": linked_bid.get("bidValidityNum"),
+             "Bảo đảm dự thầu cho các phần tham dự (VND)": api_number(linked_bid.get("bidGuarantee")),
+             "Hiệu lực của BĐDT (Ngày)": linked_bid.get("bidGuaranteeValidity"),
+             "Giá dự thầu": api_number(lot.get("lotPrice")),
+             "Tỷ lệ phần trăm giảm giá (nếu có)": lot.get("discountPercent"),
+             "Giá dự thầu sau giảm giá (VND)": api_number(lot.get("lotFinalPrice"))
+         }
+         rows.append(row)
+    return rows
+
+def phase3_key(info_str):
+    """(notifyNo, notifyId) of a Phase 3 input, used to skip duplicate notices. None if unparsable."""
+    try:
+        info_obj = json.loads(info_str)
+        return (info_obj.get("notifyNo"), info_obj.get("notifyId"))
+    except: return None
+
+def fetch_phase3_rows(api_context, token, info_str, executor=None, limiter=None):
+    """
+    Phase 3 for one linkNotifyInfo string (JSON with notifyNo/notifyId). Returns the bid opening
+    rows ([] when the notice has none), or None when a request failed so the notice can be retried.
+    With an executor, bid-open is requested alongside lotOpenDetail instead of after it.
+    limiter (RateLimiter) is waited on once per request.
+    """
+    # Parse info
+    info_obj = json.loads(info_str)
+    notify_no = info_obj.get("notifyNo")
+    notify_id = info_obj.get("notifyId")
+
+    if not notify_no or not notify_id: return []
+
+    # Call APIs (API 2 in parallel with API 1 when possible)
+    bid_future = None
+    if executor:
+        if limiter: limiter.wait()
+        bid_future = executor.submit(fetch_bid_open, api_context, token, notify_no, notify_id)
+
+    # API 1
+    if limiter: limiter.wait()
+    lot_details = fetch_lot_open_detail(api_context, token, notify_no, notify_id)
+    if lot_details is None:
+        if bid_future: bid_future.cancel()
+        print(f"  [{notify_no}] lotOpenDetail failed, Phase 3 left for a retry.")
+        return None
+
+    # Check if array is empty
+    if not lot_details or (isinstance(lot_details, list) and len(lot_details) == 0):
+        if bid_future: bid_future.cancel()
+        print(f"  [{notify_no}] lotOpenDetail empty, skipping Phase 3 record.")
+        return []
+
+    # API 2
+    if bid_future:
+        bid_opens = bid_future.result()
+    else:
+        if limiter: limiter.wait()
+        bid_opens = fetch_bid_open(api_context, token, notify_no, notify_id)
+    if bid_opens is None:
+        print(f"  [{notify_no}] bid-open failed, Phase 3 left for a retry.")
+        return None
+    return process_bid_open_rows(notify_no, lot_details, bid_opens)
+
+def process_contractor_input_result(res):
+    """
+    Normalizes a contractor-input-result response into
+    ("Danh Sach Nha Thau" rows, "Danh Sach Hang Hoa" rows).
+    """
+    nt_rows = []
+    hh_rows = []
+    root_dto = res.get("bideContractorInputResultDTO", {})
+    if not root_dto:
+        return None
+
+    notify_no = root_dto.get("notifyNo")
+    lot_results = root_dto.get("lotResultDTO") or []
+    lot_items = root_dto.get("lotResultItems") or []
+   #  Check if lot_items is empty
+    if not lot_items:
+        d_vers = root_dto.get("decisionVersions")
+        if d_vers and isinstance(d_vers, list):
+            for v in reversed(d_vers):
+                items = v.get("lotResultItems")
+                if items:
+                    lot_items = items
+                    break
+
+    if not lot_results and not lot_items:
+        print(f"    -> [Info] {notify_no}: No lot results or items.")
+
+    # Indexes (built once, so the joins below are O(1) lookups instead of scans)
+    # formValue is parsed once per lot item; None when missing or not valid JSON
+    goods_by_item = []
+    for it in lot_items:
+        goods = None
+        fv_str = it.get("formValue")
+        if fv_str:
+            try: goods = json.loads(fv_str)
+            except: pass
+        goods_by_item.append(goods)
+
+    # contractor id -> index of its lot item (first match wins, as the old scan did)
+    item_idx_by_result = {}
+    for i, it in enumerate(lot_items):
+        item_idx_by_result.setdefault(it.get("listLotResultId"), i)
+
+    # lot result id -> lotNo
+    lot_no_by_id = {}
+    for lr in lot_results:
+        lot_no_by_id.setdefault(lr.get("id"), lr.get("lotNo"))
+
+    # 1. Process Danh Sach Nha Thau
+    # Strategy: Iterate Lots -> ContractorList -> Link to LotItems
+    for lot in lot_results:
+        l_no = lot.get("lotNo")
+        l_name = lot.get("lotName")
+        c_list = lot.get("contractorList") or []
+
+        for cntr in c_list:
+            # Link: item_result["listLotResultId"] == cntr["id"]
+            item_idx = item_idx_by_result.get(cntr.get("id"))
+
+            don_gia = None
+            qty = None
+
+            if item_idx is not None:
+                fv_json = goods_by_item[item_idx]
+                try:
+                    if fv_json and isinstance(fv_json, list):
+                         # Take first item for summary?
+                         first = fv_json[0]
+                         don_gia = first.get("donGia")
+                         if not don_gia:
+                             don_gia = first.get("unitPrice")
+                         qty = first.get("quantity")
+                except: pass
+
+            # Mapping
+            bid_res_val = cntr.get("bidResult")
+            if str(bid_res_val) == "1":
+                result_status = "Trúng thầu"
+            else:
+                result_status = "Không trúng thầu"
+
+            reason_val = cntr.get("reason")
+
+            gia_du_thau = cntr.get("lotOpenPrice")
+            if not gia_du_thau:
+                gia_du_thau = cntr.get("lotPrice")
+
+            gia_trung_thau = cntr.get("lotFinalPrice") if str(bid_res_val) == "1" else ""
+
+            row_nt = {
+                "Mã TBMT": notify_no,
+                "Mã phần (lô)": l_no,
+                "Tên hoạt chất/ Tên thành phần thuốc": l_name,
+                "Mã định danh": cntr.get("orgCode"),
+                "Mã số thuế": cntr.get("taxCode"),
+                "Tên nhà thầu": cntr.get("orgFullname"),
+                "Giá Dự thầu": api_number(gia_du_thau),
+                "Đơn giá trúng thầu (VND)": api_number(don_gia),
+                "Giá trúng thầu của từng phần đã bao gồm giảm giá (VND) (đã bao gồm các hạng mục của phần đó)": api_number(gia_trung_thau),
+                "Số lượng trúng thầu": api_number(qty),
+                "Kết quả": result_status,
+                "Lý do không đáp ứng": reason_val,
+                "Thời gian thực hiện gói thầu": cntr.get("cperiodText"),
+                "Thời gian thực hiện hợp đồng": cntr.get("bidExecutionTime")
+            }
+            nt_rows.append(row_nt)
+
+    # 2. Process Danh Sach Hang Hoa
+    # Strategy: Iterate LotItems -> formValue
+    for it, goods in zip(lot_items, goods_by_item):
+        if not goods or not isinstance(goods, list): continue
+        try:
+            it_lot_result_id = it.get("lotResultId")
+
+            for g in goods:
+                lotNo_val = g.get("lotNo")
+                if not lotNo_val and it_lot_result_id:
+                    lotNo_val = lot_no_by_id.get(it_lot_result_id, lotNo_val)
+
+                don_gia_val = g.get("donGia")
+                if not don_gia_val:
+                    don_gia_val = g.get("unitPrice")
+
+                xuat_xu_val = g.get("nuocSanXuat")
+                if not xuat_xu_val:
+                    xuat_xu_val = g.get("origin")
+
+                thanh_tien_val = g.get("subTotal")
+                if not thanh_tien_val:
+                    thanh_tien_val = g.get("amount")
+
+                row_hh = {
+                    "Mã TBMT": notify_no,
+                    "Mã Phần/lô": lotNo_val,
+                    "Mã thuốc": g.get("medicineCode"),
+                    "Tên thuốc": g.get("name"),
+                    "Tên hoạt chất/ Tên thành phần của thuốc": g.get("tenHoatChat"),
+                    "Nồng độ, hàm lượng": g.get("nongDo"),
+                    "Đường dùng": g.get("duongDung"),
+                    "Dạng bào chế": g.get("dangBaoChe"),
+                    "Quy cách": g.get("quyCach"),
+                    "Nhóm thuốc": g.get("groupMedicine"),
+                    "Hạn dùng (Tuổi thọ)": g.get("hanDung"),
+                    "GĐKLH hoặc GPNK": g.get("gdklh"),
+                    "Cơ sở sản xuất": g.get("csSanXuat"),
+                    "Xuất xứ": xuat_xu_val,
+                    "Thông số kỹ thuật": g.get("feature"),
+                    "Đơn vị tính": g.get("uom"),
+                    "Số lượng": api_number(g.get("quantity")),
+                    "Khối lượng": api_number(g.get("qty")),
+                    "Đơn giá trúng thầu (VND)": api_number(don_gia_val),
+                    "Thành tiền": api_number(thanh_tien_val),
+                    "Nhà thầu trúng thầu": g.get("contractorName") if g.get("contractorName") else it.get("contractorName"),
+                    "Tiến độ cung cấp": g.get("tienDo")
+                }
+                hh_rows.append(row_hh)
+        except: pass
+
+    return nt_rows, hh_rows
+
+def parse_phase4_rows(phase4_id, body):
+    """
+    CPU half of Phase 4: raw contractor-input-result body -> (nha_thau_rows, hang_hoa_rows).
+    None when the download failed or the body is not JSON, so the notice can be retried.
+    """
+    if body is None:
+        print(f"    -> [Failed] API returned None for {phase4_id}")
+        return None
+    try:
+        res = json.loads(body)
+    except ValueError as e:
+        print(f"Error decoding contractor-input-result: {e}")
+        return None
+    if not res:
+        print(f"    -> [Skipped] Empty result for {phase4_id}")
+        return [], []
+
+    result = process_contractor_input_result(res)
+    if result is None:
+        print(f"    -> [Skipped] No bideContractorInputResultDTO for {phase4_id}")
+        return [], []
+    return result
 
-def run_contractor_selection(output_path=None, keywords="", exclude_words="", from_date="", to_date="", ib_list="", search_type="", use_default_keywords=True, use_default_exclude=True, pause_event=None, stop_event=None):
-    """
-    Function to scrape Contractor Selection Results (Kết quả lựa chọn nhà thầu).
-    Specific logic for:
-    - URL: https://muasamcong.mpi.gov.vn/web/guest/contractor-selection?render=search
-    - Match Type: "Khớp từ hoặc một số từ"
-    - Search By: "Thông báo mời thầu thuốc, dược liệu..."
-    - Field: "Hàng hóa"
-    - Date Range: "Thời gian đăng tải"
-    """
-    
-    # 1. Setup Defaults
-    if output_path is None:
-        output_path = "contractor_results.xlsx"
-    if not output_path.endswith(".xlsx"):
-        output_path += ".xlsx"
+def fetch_phase4_rows(api_context, token, phase4_id):
+    """Phase 4 for one inputResultId. Returns (nha_thau_rows, hang_hoa_rows), None on failure."""
+    body = fetch_contractor_input_result(api_context, token, phase4_id, raw=True)
+    return parse_phase4_rows(phase4_id, body)
 
-    # Default Keywords if empty (as per user request reference)
-    default_keywords = "thuốc, generic, tân dược, biệt dược, bệnh viện, chữa bệnh, vật tư y tế, điều trị, bệnh nhân, thiết bị y tế, khám chữa bệnh, khám bệnh, chữa bệnh, dược liệu, dược"
-    # Note: "Thông báo mời thầu thuốc..." is a Search By option, not a keyword.
-    
-    default_exclude = "linh kiện, xây dựng, cải tạo, lắp đặt, thi công"
+
+def process_contractor_search_item(item):
+    """Maps one smart/search result item to a "Kết quả tìm kiếm" (Phase 1) row."""
+    # Mapping
+    # Mã TBMT = notifyNo
+    # Tên gói thầu = bidName (can be array or string)
+    # Chủ đầu tư = investorName
+    # Ngày đăng tải thông báo = originalPublicDate
+    # Lĩnh vực = investField (Array)
+    # Địa điểm = locations (Array of objects? subagent said distName + provName)
+    # Thời điểm đóng thầu = bidCloseDate
+    # Hình thức dự thầu = isInternet (1=QM)
+    # Trạng thái = status
     
-    # Only use defaults if allowed by use_default flags
-    if use_default_keywords and not keywords:
-        keywords = default_keywords
-    if use_default_exclude and not exclude_words:
-        exclude_words = default_exclude
+    # Bid Name
+    bid_name = item.get("bidName", "")
+    if isinstance(bid_name, list):
+        bid_name = "; ".join(bid_name)
+
+    # Invest Field
+    inv_field = item.get("investField", "")
+    if isinstance(inv_field, list):
+        inv_field = ", ".join(inv_field)
+    if inv_field == "HH": inv_field = "Hàng hóa"
+    elif inv_field == "XL": inv_field = "Xây lắp"
+    elif inv_field == "PTV": inv_field = "Phi tư vấn"
 
-    print(f"--- Starting Contractor Selection Scrape ---")
-    print(f"File: {output_path}")
-    print(f"Search Type: {search_type if search_type else 'Mặc định'}")
-    print(f"Keywords: {keywords[:50]}..." if keywords else "Keywords: (Để trống)")
-    print(f"Exclude: {exclude_words[:50]}..." if exclude_words else "Exclude: (Để trống)")
-    if from_date or to_date:
-        print(f"Date Range: {from_date} - {to_date}")
+    # Location
+    loc_str = ""
+    locs = item.get("locations", [])
+    if locs and isinstance(locs, list):
+        # Assuming objects with distName, provName or just strings
+        l_parts = []
+        for l in locs:
+            if isinstance(l, dict):
+                d = l.get("districtName", "")
+                p = l.get("provName", "")
+                l_parts.append(f"{d} - {p}")
+            else:
+                l_parts.append(str(l))
+        loc_str = "; ".join(l_parts)
 
-    # 2. Check Existing Data
-    # 2. Check Existing Data
-    processed_items = set()
-    all_data = []
-    
-    # Temp Directory Setup
-    try:
-        temp_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), "temp")
-        os.makedirs(temp_dir, exist_ok=True)
-    except:
-        temp_dir = os.path.dirname(output_path) # Fallback
+    # Internet
+    # isInternet can be 1 or 0
+    is_net = item.get("isInternet", 0)
+    hinh_thuc = "Qua mạng" if str(is_net) == "1" else "Không qua mạng"
+
+    # Status
+    st_code = item.get("statusForNotify", "")
+    st_map = {
+        "DXT": "Đang xét thầu",
+        "CNTTT": "Có nhà thầu trúng thầu",
+        "DHTBMT": "Đã hủy TBMT", 
+        "DHT": "Đã hủy thầu",
+        "KCNTTT": "Không có nhà thầu trúng thầu"
+    }
 
-    csv_name = os.path.basename(output_path).replace(".xlsx", ".csv")
-    csv_path_p1 = os.path.join(temp_dir, csv_name)
-    
-    load_source = None
-    read_func = None
-    
-    if os.path.exists(csv_path_p1):
-        load_source = csv_path_p1
-        read_func = pd.read_csv
-    elif os.path.exists(output_path):
-        load_source = output_path
-        read_func = pd.read_excel
-        
-    if load_source:
-        try:
-            df = read_func(load_source)
-            # Use 'Mã TBMT/Gói thầu' or check col "Số TBMT"
-            check_col = "Số TBMT"
-            if check_col not in df.columns:
-                 # Try to find a unique column
-                 possible_cols = ["Mã KQLCNT", "Số TBMT", "Tên gói thầu", "Mã TBMT"]
-                 for c in possible_cols:
-                     if c in df.columns:
-                         check_col = c
-                         break
-            
-            if check_col in df.columns:
-                processed_items = set(df[check_col].dropna().astype(str).str.strip())
-                all_data = df.to_dict('records')
-            print(f"Loaded {len(processed_items)} existing items from {load_source} (Check col: {check_col}).")
-        except Exception as e:
-            print(f"Warning: Could not read existing file: {e}")
+    if not st_code:
+        bid_close_str = item.get("bidCloseDate")
+        if bid_close_str:
+            try:
+                # Parse ISO date to datetime (e.g. 2026-07-13T10:00:00)
+                close_dt_str = str(bid_close_str)[:19].replace("T", " ")
+                close_dt = datetime.strptime(close_dt_str, "%Y-%m-%d %H:%M:%S")
+                if close_dt > datetime.now():
+                    trang_thai = "Chưa đóng thầu"
+                else:
+                    if str(item.get("isInternet", "1")) == "0":
+                        trang_thai = "Đang xét thầu"
+                    else:
+                        trang_thai = "Chưa mở thầu"
+            except:
+                trang_thai = "Chưa đóng thầu"
+        else:
+            trang_thai = "Chưa đóng thầu"
+    else:
+        trang_thai = st_map.get(str(st_code), str(st_code))
+
+    row = {
+        "Mã TBMT": item.get("notifyNo", ""),
+        "Tên gói thầu": bid_name,
+        "Lĩnh vực": inv_field,
+        "Chủ đầu tư": item.get("investorName", ""),
+        "Địa điểm": loc_str,
+        "Thời điểm đóng thầu": api_datetime(item.get("bidCloseDate")),
+        "Thời điểm mở thầu": api_datetime(item.get("bidOpenDate")), # Added for Phase 2 Fallback
+        "Trạng thái": trang_thai,
+        "Giá trúng thầu (VND)": api_number(item.get("bidWinningPrice")),
+        "Ngày phê duyệt KQLCNT": api_date(item.get("publicDateKqlcnt")),
+        "id": item.get("id", ""),
+        "bidID": item.get("bidId", ""), 
+        "inputResultId": item.get("inputResultId", "") 
+    }
+    return row
 
-    # 3. Helpers
-    def check_status():
-        if stop_event and stop_event.is_set():
-            raise InterruptedError("Stopped by user.")
-        if pause_event and not pause_event.is_set():
-            print(">>> PAUSED...")
-            pause_event.wait()
-            if stop_event and stop_event.is_set():
-                 raise InterruptedError("Stopped by user.")
-            print(">>> RESUMED.")
+
+def capture_contractor_search(keywords="", exclude_words="", from_date="", to_date="", ib_list="", search_type="", check_status=None, headless=False):
+    """
+    Opens the contractor-selection search page, fills the Ant Design form and sniffs
+    the services/smart/search request. Returns a search session
+    {"api_url", "payload", "cookies"} or None; the browser is closed either way.
+    """
+    if check_status is None:
+        check_status = lambda: None
 
     def wait_for_internet(page):
         while True:
@@ -464,17 +2814,16 @@ def run_contractor_selection(output_path=None, keywords="", exclude_words="", fr
             print("Waiting for internet...")
             time.sleep(5)
 
-    # 4. Playwright Execution
     with sync_playwright() as p:
         # Browser Launch
         browser = None
         try:
-            browser = p.chromium.launch(headless=False, channel="chrome")
+            browser = p.chromium.launch(headless=headless, channel="chrome")
         except:
             try:
-                browser = p.chromium.launch(headless=False, channel="msedge")
+                browser = p.chromium.launch(headless=headless, channel="msedge")
             except:
-                 browser = p.chromium.launch(headless=False)
+                 browser = p.chromium.launch(headless=headless)
         
         context = browser.new_context(viewport={"width": 1366, "height": 768}, ignore_https_errors=True)
         page = context.new_page()
@@ -635,15 +2984,14 @@ def run_contractor_selection(output_path=None, keywords="", exclude_words="", fr
         except Exception as e:
                 print(f"Error setting up search (Form Fill): {e}")
                 browser.close()
-                return
+                return None
             
-        # 6. API Scraping Loop
+        # 6. Capture API
         # We need to capture the API token and the base payload from the initial search
         # The easiest way is to wait for the request after clicking search
         
         api_url = None
         base_payload = None
-        token = None
         
         try:
              # Wait for the specific API request
@@ -654,10 +3002,6 @@ def run_contractor_selection(output_path=None, keywords="", exclude_words="", fr
              api_url = first_req.value.url
              base_payload = first_req.value.post_data_json
              print(f"Captured API URL: {api_url}")
-             try:
-                 token = api_url.split("token=")[1]
-             except:
-                 token = None
              
         except:
              # If we missed the event (because it happened too fast), try to search again or just look at last requests
@@ -668,776 +3012,697 @@ def run_contractor_selection(output_path=None, keywords="", exclude_words="", fr
                      pass
                  api_url = first_req.value.url
                  base_payload = first_req.value.post_data_json
-                 try:
-                     token = api_url.split("token=")[1]
-                 except:
-                     token = None
              except Exception as e:
                  print(f"Could not capture API: {e}")
                  browser.close()
-                 return
+                 return None
 
         if not api_url or not base_payload:
             print("Failed to configure API scraper.")
             browser.close()
-            return
+            return None
+
+        # The browser is only needed for the token; everything after this goes over plain HTTP
+        session = {"api_url": api_url, "payload": base_payload, "cookies": context.cookies()}
+        browser.close()
+        return session
+
+def run_contractor_selection(output_path=None, keywords="", exclude_words="", from_date="", to_date="", ib_list="", search_type="", use_default_keywords=True, use_default_exclude=True, pause_event=None, stop_event=None, detail_workers=DEFAULT_DETAIL_WORKERS, reuse_session=True, headless=False, page_workers=DEFAULT_PAGE_WORKERS, search_rate=DEFAULT_SEARCH_RATE, incremental=False, refresh=False, phase3_workers=DEFAULT_PHASE3_WORKERS, phase3_rate=DEFAULT_PHASE3_RATE, phase4_workers=DEFAULT_PHASE4_WORKERS, phase4_rate=DEFAULT_PHASE4_RATE, parse_workers=DEFAULT_PARSE_WORKERS, shard_dates=True, queries=None, output_format="xlsx", export_excel=None, db_path=None):
+    """
+    Function to scrape Contractor Selection Results (Kết quả lựa chọn nhà thầu).
+    Specific logic for:
+    - URL: https://muasamcong.mpi.gov.vn/web/guest/contractor-selection?render=search
+    - Match Type: "Khớp từ hoặc một số từ"
+    - Search By: "Thông báo mời thầu thuốc, dược liệu..."
+    - Field: "Hàng hóa"
+    - Date Range: "Thời gian đăng tải"
+    detail_workers: number of concurrent Phase 2 detail fetches (1 = sequential).
+    reuse_session: POST directly with the saved token/payload for this search and only
+                   open the browser when the server rejects it.
+    headless: launch the capture browser without a window (servers without a display).
+    page_workers: number of concurrent Phase 1 search page requests (1 = sequential).
+    search_rate: max Phase 1 search requests per second across all page workers.
+    incremental: only keep notices published after the last finished sync of the same
+                 keywords/filters (date range ignored) and stop paging once known notices
+                 are reached, so Phases 2-4 run for the new ones only.
+    refresh: re-run the search over an existing output and re-fetch Phases 2-4 only for
+             stored notices whose status is not final (see TERMINAL_STATUSES); final
+             ones keep their stored rows.
+    phase3_workers: number of notices whose bid opening (Phase 3) is fetched at once.
+    phase3_rate: max Phase 3 requests per second across all Phase 3 workers.
+    phase4_workers / phase4_rate: same for the Phase 4 contractor-input-result downloads.
+    parse_workers: threads that decode Phase 4 responses into rows, apart from the downloads.
+    shard_dates: search date ranges longer than a month as concurrent month/week/day
+                 windows, each checkpointed when done (see run_sharded_search).
+    queries: batch mode, a list of {"keywords", "exclude_words", "search_type", "label"}
+             searched concurrently in one job (keywords/exclude_words/search_type above
+             are then ignored). Notices are deduped across searches before Phases 2-4
+             and tagged with the label of the search that found them first.
+    """
+    watch_stop(stop_event)
+
+    # 1. Setup Defaults
+    if output_path is None:
+        output_path = "contractor_results.xlsx"
+    if not output_path.endswith(".xlsx"):
+        output_path += ".xlsx"
+
+    # Default Keywords if empty (as per user request reference)
+    default_keywords = "thuốc, generic, tân dược, biệt dược, bệnh viện, chữa bệnh, vật tư y tế, điều trị, bệnh nhân, thiết bị y tế, khám chữa bệnh, khám bệnh, chữa bệnh, dược liệu, dược"
+    # Note: "Thông báo mời thầu thuốc..." is a Search By option, not a keyword.
+    
+    default_exclude = "linh kiện, xây dựng, cải tạo, lắp đặt, thi công"
+    
+    # Only use defaults if allowed by use_default flags
+    if use_default_keywords and not keywords:
+        keywords = default_keywords
+    if use_default_exclude and not exclude_words:
+        exclude_words = default_exclude
+
+    print(f"--- Starting Contractor Selection Scrape ---")
+    print(f"File: {output_path}")
+    print(f"Search Type: {search_type if search_type else 'Mặc định'}")
+    print(f"Keywords: {keywords[:50]}..." if keywords else "Keywords: (Để trống)")
+    print(f"Exclude: {exclude_words[:50]}..." if exclude_words else "Exclude: (Để trống)")
+    if from_date or to_date:
+        print(f"Date Range: {from_date} - {to_date}")
+
+    # 2. Check Existing Data
+    # 2. Check Existing Data
+    processed_items = set()
+    all_data = []
+    
+    # Temp Directory Setup
+    try:
+        temp_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), "temp")
+        os.makedirs(temp_dir, exist_ok=True)
+    except:
+        temp_dir = os.path.dirname(output_path) # Fallback
+
+    csv_name = os.path.basename(output_path).replace(".xlsx", ".csv")
+    csv_path_p1 = os.path.join(temp_dir, csv_name)
+    
+    load_source = None
+    read_func = None
+    
+    if os.path.exists(csv_path_p1):
+        load_source = csv_path_p1
+        read_func = pd.read_csv
+    elif os.path.exists(output_path):
+        load_source = output_path
+        read_func = pd.read_excel
+        
+    if load_source:
+        try:
+            df = read_func(load_source)
+            # Use 'Mã TBMT/Gói thầu' or check col "Số TBMT"
+            check_col = "Số TBMT"
+            if check_col not in df.columns:
+                 # Try to find a unique column
+                 possible_cols = ["Mã TBMT", "Mã KQLCNT", "Số TBMT", "Tên gói thầu"]
+                 for c in possible_cols:
+                     if c in df.columns:
+                         check_col = c
+                         break
             
+            if check_col in df.columns:
+                processed_items = set(df[check_col].dropna().astype(str).str.strip())
+                all_data = df.to_dict('records')
+            print(f"Loaded {len(processed_items)} existing items from {load_source} (Check col: {check_col}).")
+        except Exception as e:
+            print(f"Warning: Could not read existing file: {e}")
+
+    # Resume journal: which notices already finished which phase (survives crash/stop)
+    journal = RunJournal(os.path.join(temp_dir, csv_name.replace(".csv", ".journal.jsonl")))
+    if journal.entries:
+        print(f"Resume journal: detail {journal.count('detail')}, bid opening {journal.count('bid_open')}, contractor input {journal.count('contractor')} notices already done.")
+    journal.remove("run", "finished") # Re-added with the unfinished count if this run gets to the end
+
+    # 3. Helpers
+    pause_lock = threading.Lock() # Pipeline workers check too: one of them reports the pause
+    def check_status():
+        if stop_event and stop_event.is_set():
+            raise InterruptedError("Stopped by user.")
+        if pause_event and not pause_event.is_set():
+            with pause_lock:
+                if not pause_event.is_set():
+                    print(">>> PAUSED...")
+                    pause_event.wait()
+                    if stop_event and stop_event.is_set():
+                         raise InterruptedError("Stopped by user.")
+                    print(">>> RESUMED.")
+            if stop_event and stop_event.is_set():
+                 raise InterruptedError("Stopped by user.")
+
+    # IB list: unique codes, searched in chunks that all reuse one captured payload
+    ib_codes = parse_ib_codes(ib_list) if ib_list else []
+    ib_chunks = [ib_codes[i:i + IB_CHUNK_SIZE] for i in range(0, len(ib_codes), IB_CHUNK_SIZE)]
+    if ib_codes:
+        print(f"IB list: {len(ib_codes)} unique codes in {len(ib_chunks)} chunks of up to {IB_CHUNK_SIZE}.")
+
+    # Batch mode: several keyword sets / search types in one job, deduped before Phases 2-4
+    batch = []
+    for q in queries or []:
+        batch.append({
+            "keywords": q.get("keywords", ""),
+            "exclude_words": q.get("exclude_words", ""),
+            "search_type": q.get("search_type", ""),
+            "label": q.get("label") or q.get("keywords", "")[:50],
+        })
+    if batch:
+        print(f"Batch mode: {len(batch)} searches.")
+
+    # 4. Search Session: reuse a saved token/payload when the server still accepts it, else capture via browser
+    if ib_codes:
+        # The codes are swapped into the payload, so one session serves every IB list
+        search_key = search_session_key("contractor_ib", search_type=search_type)
+    else:
+        search_key = search_session_key(
+            "contractor", keywords=keywords, exclude_words=exclude_words, from_date=from_date,
+            to_date=to_date, ib_list=ib_list, search_type=search_type
+        )
+
+    def open_search_session(key, kw, ex, st, ib_text="", template=None):
+        """Saved session if still accepted, else the template with other words swapped in, else the browser."""
+        session = load_search_session(key) if reuse_session else None
+        if session:
+            if probe_search_session(session):
+                print("Reusing saved search session (browserless).")
+            else:
+                print("Saved search token was rejected. Re-capturing with browser...")
+                session = None
+
+        if not session and template:
+            # Same search form with other words: reuse the captured payload and token
+            payload, found = replace_payload_text(template["payload"], template.get("query_text"), kw)
+            if found and ex != (template.get("exclude_text") or ""):
+                payload, found = replace_payload_text(payload, template.get("exclude_text"), ex)
+            if found:
+                session = dict(template, payload=payload, query_text=kw, exclude_text=ex)
+
+        if not session:
+            session = capture_contractor_search(
+                keywords=kw, exclude_words=ex, from_date=from_date, to_date=to_date,
+                ib_list=ib_text, search_type=st, check_status=check_status, headless=headless
+            )
+            if not session:
+                return None
+            session["query_text"] = ib_text or kw
+            session["exclude_text"] = ex
+        save_search_session(key, session)
+        return session
+
+    if batch:
+        # Batch mode: one session per search; searches of the same type share one capture
+        templates = {}
+        for q in batch:
+            q_key = search_session_key(
+                "contractor", keywords=q["keywords"], exclude_words=q["exclude_words"], from_date=from_date,
+                to_date=to_date, ib_list="", search_type=q["search_type"]
+            )
+            q["session"] = open_search_session(
+                q_key, q["keywords"], q["exclude_words"], q["search_type"], template=templates.get(q["search_type"])
+            )
+            if q["session"]:
+                templates.setdefault(q["search_type"], q["session"])
+            else:
+                print(f"Warning: search '{q['label']}' could not be prepared, skipped.")
+        batch = [q for q in batch if q["session"]]
+        if not batch:
+            return
+        session = batch[0]["session"]
+    else:
+        session = open_search_session(
+            search_key, keywords, exclude_words, search_type, ", ".join(ib_chunks[0]) if ib_codes else ib_list
+        )
+        if not session:
+            return
+
+    if ib_chunks and not replace_payload_text(session["payload"], session.get("query_text"), "")[1]:
+        # Payload can't be re-targeted: fall back to one query holding the whole list
+        if session.get("query_text") != ", ".join(ib_codes):
+            print("Warning: IB codes not found in the captured payload. Searching the whole list in one query...")
+            session = capture_contractor_search(
+                ib_list=", ".join(ib_codes), search_type=search_type, check_status=check_status, headless=headless
+            )
+            if not session:
+                return
+        ib_chunks = [ib_codes]
+
+    api_url = session["api_url"]
+    base_payload = session["payload"]
+
+    # Incremental sync: the watermark belongs to the search filters, not to the date range
+    sync_key = search_session_key(
+        "contractor_sync", keywords=keywords, exclude_words=exclude_words,
+        ib_list=ib_list, search_type=search_type,
+        queries=[[q["keywords"], q["exclude_words"], q["search_type"]] for q in batch]
+    )
+    watermark = load_sync_watermark(sync_key) if incremental else None
+    if watermark:
+        print(f"Incremental sync: only notices published after {watermark['public_date']}.")
+    sync_state = {"reached": False, "watermark": watermark or {}, "seen_dates": {}}
+
+    # Long date ranges are searched window by window (not for IB lists or incremental sync)
+    shard_fields = None
+    if shard_dates and not ib_codes and not watermark and not batch:
+        shard_fields = plan_date_shards(base_payload, from_date, to_date)
+
+    def reharvest_token():
+        """Same search captured again in the browser; only its token and cookies are used."""
+        text = session.get("query_text") or ""
+        fresh = capture_contractor_search(
+            keywords="" if ib_codes else text, exclude_words=session.get("exclude_text") or "",
+            from_date=from_date, to_date=to_date, ib_list=text if ib_codes else "",
+            search_type=batch[0]["search_type"] if batch else search_type,
+            check_status=check_status, headless=headless
+        )
+        if fresh and not batch:
+            # Next run starts from the fresh token as well
+            save_search_session(search_key, dict(session, api_url=fresh["api_url"], cookies=fresh["cookies"]))
+        return fresh
+
+    # Thread-safe HTTP session seeded with the browser cookies (Phase 1 + pipeline workers);
+    # an expired token is re-harvested mid-run and the failed requests replayed
+    api_context = ApiSession(
+        session.get("cookies"),
+        pool_size=max(detail_workers * len(DetailResolver.KINDS) + phase3_workers * 2 + phase4_workers, page_workers) + 4,
+        token_manager=TokenManager(url_token(api_url), reharvest_token) if url_token(api_url) else None
+    )
+    for q in batch[1:]:
+        api_context.update_cookies(q["session"].get("cookies"))
+
+    try:
         print("API Scraper Configured. Starting batch processing...")
         
-        # Override page number and size
-        
         # Modify payload for high volume
         # The payload is typically a List: [{"pageSize": 10, "pageNumber": 0, "query": [...]}]
-        
-        current_payload_obj = base_payload[0] if isinstance(base_payload, list) else base_payload
-        current_payload_obj["pageSize"] = 200
-        
-        page_num = 0
+        page_size = 200
+        limiter = RateLimiter(search_rate)
         total_fetched = 0
-        
-        # Setup API Context
-        api_context = context.request
-        
-        while True:
-            check_status() # Pause/Stop support
-            
-            # Update Page Number
-            current_payload_obj["pageNumber"] = page_num
-            final_payload = [current_payload_obj] if isinstance(base_payload, list) else current_payload_obj
-            
-            print(f"--- Fetching API Page {page_num} (Size: 200) ---")
-            
-            retry = 0
-            response_json = None
-            
-            while retry < 3:
-                try:
-                    # POST request
-                    resp = api_context.post(api_url, data=final_payload)
-                    if resp.ok:
-                        response_json = resp.json()
-                        break
-                    else:
-                        print(f"API Error {resp.status}: {resp.status_text}")
-                        time.sleep(2)
-                        retry += 1
-                except Exception as e:
-                     print(f"Request failed: {e}")
-                     time.sleep(2)
-                     retry += 1
-            
-            if not response_json:
-                print("Failed to get response after retries. Stop.")
-                break
-            
-            # Extract Items
-            items = []
-            try:
-                # Handle possible structures
-                if "page" in response_json and "content" in response_json["page"]:
-                    items = response_json["page"]["content"]
-                elif "content" in response_json:
-                    items = response_json["content"]
-                elif isinstance(response_json, list):
-                     items = response_json
-            except: pass
-            
-            if not items:
-                print("No items in response. End of items.")
-                break
-                
-            print(f"  Got {len(items)} items from API.")
-            
-            # Process Items
+
+        def save_page(page_num, response_json):
+            items = extract_search_items(response_json)
+            print(f"  Page {page_num}: got {len(items)} items from API.")
+            return save_items(items)
+
+        def save_items(items, label=None):
+            if incremental:
+                sync_state["watermark"] = advance_watermark(sync_state["watermark"], items)
+                for item in items:
+                    if item.get("notifyNo"):
+                        sync_state["seen_dates"][item.get("notifyNo")] = item_public_date(item)
+
+            # Process Items (skip notices already saved by an earlier run)
             batch_data = []
             for item in items:
-                # Mapping
-                # Mã TBMT = notifyNo
-                # Tên gói thầu = bidName (can be array or string)
-                # Chủ đầu tư = investorName
-                # Ngày đăng tải thông báo = originalPublicDate
-                # Lĩnh vực = investField (Array)
-                # Địa điểm = locations (Array of objects? subagent said distName + provName)
-                # Thời điểm đóng thầu = bidCloseDate
-                # Hình thức dự thầu = isInternet (1=QM)
-                # Trạng thái = status
-                
+                if watermark and not is_new_since(item, watermark):
+                    sync_state["reached"] = True
+                    continue
                 try:
-                    # Bid Name
-                    bid_name = item.get("bidName", "")
-                    if isinstance(bid_name, list):
-                        bid_name = "; ".join(bid_name)
-                    
-                    # Invest Field
-                    inv_field = item.get("investField", "")
-                    if isinstance(inv_field, list):
-                        inv_field = ", ".join(inv_field)
-                    if inv_field == "HH": inv_field = "Hàng hóa"
-                    elif inv_field == "XL": inv_field = "Xây lắp"
-                    elif inv_field == "PTV": inv_field = "Phi tư vấn"
-                    
-                    # Location
-                    loc_str = ""
-                    locs = item.get("locations", [])
-                    if locs and isinstance(locs, list):
-                        # Assuming objects with distName, provName or just strings
-                        l_parts = []
-                        for l in locs:
-                            if isinstance(l, dict):
-                                d = l.get("districtName", "")
-                                p = l.get("provName", "")
-                                l_parts.append(f"{d} - {p}")
-                            else:
-                                l_parts.append(str(l))
-                        loc_str = "; ".join(l_parts)
-                    
-                    # Internet
-                    # isInternet can be 1 or 0
-                    is_net = item.get("isInternet", 0)
-                    hinh_thuc = "Qua mạng" if str(is_net) == "1" else "Không qua mạng"
-                    
-                    # Status
-                    st_code = item.get("statusForNotify", "")
-                    st_map = {
-                        "DXT": "Đang xét thầu",
-                        "CNTTT": "Có nhà thầu trúng thầu",
-                        "DHTBMT": "Đã hủy TBMT", 
-                        "DHT": "Đã hủy thầu",
-                        "KCNTTT": "Không có nhà thầu trúng thầu"
-                    }
-                    
-                    if not st_code:
-                        bid_close_str = item.get("bidCloseDate")
-                        if bid_close_str:
-                            try:
-                                # Parse ISO date to datetime (e.g. 2026-07-13T10:00:00)
-                                close_dt_str = str(bid_close_str)[:19].replace("T", " ")
-                                close_dt = datetime.strptime(close_dt_str, "%Y-%m-%d %H:%M:%S")
-                                if close_dt > datetime.now():
-                                    trang_thai = "Chưa đóng thầu"
-                                else:
-                                    if str(item.get("isInternet", "1")) == "0":
-                                        trang_thai = "Đang xét thầu"
-                                    else:
-                                        trang_thai = "Chưa mở thầu"
-                            except:
-                                trang_thai = "Chưa đóng thầu"
-                        else:
-                            trang_thai = "Chưa đóng thầu"
-                    else:
-                        trang_thai = st_map.get(str(st_code), str(st_code))
-
-                    # Date Formatting
-                    def format_date_str(iso_str):
-                        if not iso_str: return ""
-                        try:
-                            
-                            if "T" in iso_str:
-                                p1, p2 = iso_str.split("T")
-                                y, m, d = p1.split("-")
-                                # p2 is HH:MM:SS.ms
-                                time_part = p2.split(".")[0]
-                                h, mi = time_part.split(":")[:2]
-                                return f"{d}/{m}/{y} {h}:{mi}"
-                            return iso_str
-                        except:
-                            return iso_str
-
-                    def fmt_num(v): 
-                        if v is None or v == "": return ""
-                        if isinstance(v, list): 
-                            if len(v) > 0: 
-                                try:
-                                    v = sum(float(x) for x in v if x is not None and str(x).strip() != "")
-                                except:
-                                    v = v[0]
-                            else: return ""
-                        try: return "{:,.0f}".format(float(v)).replace(",", ".")
-                        except: return str(v)
-                        
-                    def format_only_date(iso_str):
-                        if not iso_str: return ""
-                        try:
-                            if "T" in str(iso_str):
-                                y, m, d = str(iso_str).split("T")[0].split("-")
-                                return f"{d}/{m}/{y}"
-                            elif " " in str(iso_str):
-                                y, m, d = str(iso_str).split(" ")[0].split("-")
-                                return f"{d}/{m}/{y}"
-                            elif "-" in str(iso_str):
-                                y, m, d = str(iso_str).split("-")
-                                return f"{d}/{m}/{y}"
-                            return str(iso_str)
-                        except:
-                            return str(iso_str)
-
-                    win_price = fmt_num(item.get("bidWinningPrice"))
-                    approve_date = format_only_date(item.get("publicDateKqlcnt"))
-
-                    row = {
-                        "Mã TBMT": item.get("notifyNo", ""),
-                        "Tên gói thầu": bid_name,
-                        "Lĩnh vực": inv_field,
-                        "Chủ đầu tư": item.get("investorName", ""),
-                        "Địa điểm": loc_str,
-                        "Thời điểm đóng thầu": format_date_str(item.get("bidCloseDate", "")),
-                        "Thời điểm mở thầu": format_date_str(item.get("bidOpenDate", "")), # Added for Phase 2 Fallback
-                        "Trạng thái": trang_thai,
-                        "Giá trúng thầu (VND)": fmt_num(item.get("bidWinningPrice")),
-                        "Ngày phê duyệt KQLCNT": format_only_date(item.get("publicDateKqlcnt")),
-                        "id": item.get("id", ""),
-                        "bidID": item.get("bidId", ""), 
-                        "inputResultId": item.get("inputResultId", "") 
-                    }
-                    batch_data.append(row)
+                    row = process_contractor_search_item(item)
                 except Exception as e:
                     print(f"Error parse item: {e}")
-            
+                    continue
+                key = notice_key(row)
+                if key in processed_items:
+                    idx = row_index.get(key)
+                    if idx is not None and str(all_data[idx].get("Trạng thái", "")).strip() not in TERMINAL_STATUSES:
+                        all_data[idx] = row
+                        refresh_keys.add(key)
+                    continue
+                processed_items.add(key)
+                if label:
+                    row["Nhóm tìm kiếm"] = label
+                batch_data.append(row)
+
             # Save Batch
             if batch_data:
                 all_data.extend(batch_data)
                 save_batch_csv(batch_data, csv_path_p1)
                 print(f"  Saved {len(batch_data)} API items to CSV.")
+            return len(items)
 
-            total_fetched += len(items)
-            
-            # Next Page
-            page_num += 1
-            time.sleep(1) # Gentle rate limit
+        def fetch_page(page_num):
+            return fetch_search_page(api_context, api_url, base_payload, page_num, page_size, limiter)
+
+        def fetch_ib_chunk(chunk):
+            payload, _ = replace_payload_text(base_payload, session.get("query_text"), ", ".join(chunk))
+            return fetch_search_all(api_context, api_url, payload, page_size, limiter)
+
+        # Refresh: stored notices that may still change get their Phase 1 row replaced
+        row_index = {notice_key(r): i for i, r in enumerate(all_data)} if refresh else {}
+        refresh_keys = set()
+
+        # Page 0 tells us how many pages there are; the rest are fetched concurrently
+        check_status()
+        search_complete = journal.done("search", "complete") and not refresh
+        first_page = None
+        failed_pages = 0
+        if search_complete:
+            print(f"Phase 1 already completed (resume journal). Using {len(all_data)} saved items.")
+        elif ib_chunks:
+            # IB list: chunks are resolved concurrently; only exact code matches are kept
+            print(f"--- Resolving {len(ib_chunks)} IB chunks (Workers: {page_workers}, Rate: {search_rate}/s) ---")
+            for idx, chunk, items in run_ordered_pool(fetch_ib_chunk, ib_chunks, page_workers, check_status):
+                if items is None:
+                    print(f"  IB chunk {idx+1}/{len(ib_chunks)}: failed after retries, skipped.")
+                    failed_pages += 1
+                    continue
+                wanted = set(chunk)
+                matched = [it for it in items if normalize_ib_code(it.get("notifyNo")) in wanted]
+                print(f"  IB chunk {idx+1}/{len(ib_chunks)}: {len(matched)} notices for {len(chunk)} codes.")
+                total_fetched += save_items(matched)
+        elif batch:
+            # Searches run concurrently on the shared pool; a notice found twice is kept once
+            print(f"--- Running {len(batch)} searches (Workers: {page_workers}, Rate: {search_rate}/s) ---")
+            def fetch_query(q):
+                return fetch_search_all(api_context, q["session"]["api_url"], q["session"]["payload"], page_size, limiter)
+            for _, q, items in run_ordered_pool(fetch_query, batch, page_workers, check_status):
+                if items is None:
+                    print(f"  Search '{q['label']}': failed after retries, skipped.")
+                    failed_pages += 1
+                    continue
+                before = len(all_data)
+                total_fetched += save_items(items, q["label"])
+                print(f"  Search '{q['label']}': {len(items)} items, {len(all_data) - before} new after dedupe.")
+        elif shard_fields:
+            # Date windows: concurrent, checkpointed, merged through processed_items
+            window_counts = []
+            failed_pages += run_sharded_search(
+                api_context, api_url, base_payload, shard_fields, from_date, to_date, page_size,
+                lambda items: window_counts.append(save_items(items)),
+                limiter, page_workers, check_status, None if refresh else journal
+            )
+            total_fetched += sum(window_counts)
+        else:
+            print(f"--- Fetching API Page 0 (Size: {page_size}) ---")
+            first_page = fetch_page(0)
+        first_count = save_page(0, first_page) if first_page and not ib_chunks else 0
+        if search_complete or ib_chunks or batch or shard_fields:
+            pass
+        elif not first_page:
+            print("Failed to get response after retries. Stop.")
+        elif first_count:
+            total_fetched += first_count
+            total_pages = search_page_count(first_page, page_size)
+
+            if sync_state["reached"]:
+                print("Reached notices from the last sync. Stop paging.")
+            elif total_pages is not None and not watermark:
+                print(f"--- Total pages: {total_pages} (Workers: {page_workers}, Rate: {search_rate}/s) ---")
+                # Pages come back in page order so the CSV keeps the server's ordering
+                for _, page_num, response_json in run_ordered_pool(fetch_page, range(1, total_pages), page_workers, check_status):
+                    if not response_json:
+                        print(f"  Page {page_num}: failed after retries, skipped.")
+                        failed_pages += 1
+                        continue
+                    total_fetched += save_page(page_num, response_json)
+            else:
+                # No paging metadata (or incremental sync): walk pages until the first
+                # empty one, the last page, or the first page holding known notices
+                page_num = 1
+                while total_pages is None or page_num < total_pages:
+                    check_status() # Pause/Stop support
+                    print(f"--- Fetching API Page {page_num} (Size: {page_size}) ---")
+                    response_json = fetch_page(page_num)
+                    if not response_json:
+                        print("Failed to get response after retries. Stop.")
+                        failed_pages += 1
+                        break
+                    got = save_page(page_num, response_json)
+                    if not got:
+                        print("No items in response. End of items.")
+                        break
+                    total_fetched += got
+                    if sync_state["reached"]:
+                        print("Reached notices from the last sync. Stop paging.")
+                        break
+                    page_num += 1
+        else:
+            print("No items in response. End of items.")
+
+        # A restart may skip the search only when every page made it to the CSV
+        searched = not search_complete and (ib_chunks or batch or shard_fields or first_page)
+        if searched and not failed_pages:
+            journal.mark("search", "complete", sync_state["watermark"] if incremental else None)
+        elif search_complete and incremental:
+            sync_state["watermark"] = journal.get("search", "complete") or {}
+
+        if refresh_keys:
+            print(f"Refresh: {len(refresh_keys)} open notices will be re-fetched, {len(all_data) - len(refresh_keys)} kept from stored data.")
+            rewrite_csv(all_data, csv_path_p1)
+
+        # IB list: report codes that matched no notice
+        if ib_codes:
+            found = {normalize_ib_code(r.get("Mã TBMT")) for r in all_data}
+            unmatched = [c for c in ib_codes if c not in found]
+            print(f"IB list: {len(ib_codes) - len(unmatched)}/{len(ib_codes)} codes matched.")
+            if unmatched:
+                unmatched_path = output_path.replace(".xlsx", " IB khong tim thay.xlsx")
+                print(f"  {len(unmatched)} codes not found: {', '.join(unmatched[:20])}{' ...' if len(unmatched) > 20 else ''}")
+                try:
+                    pd.DataFrame({"IB": unmatched}).to_excel(unmatched_path, index=False)
+                    print(f"  Saved unmatched codes to {unmatched_path}")
+                except Exception as e:
+                    print(f"Error saving unmatched IB list: {e}")
             
         print(f"Scraping completed. Total items: {total_fetched}")
         
         # Finalize Phase 1 Excel
-        finalize_excel({"Kết quả tìm kiếm": csv_path_p1}, output_path)
+        export_outputs({"Kết quả tìm kiếm": csv_path_p1}, output_path, output_format, export_excel, db_path)
         
-        # --- PHASE 2: Fetch Details ---
+        # --- PHASE 2-4: Details, Bid Opening, Contractor Input (streaming) ---
         token = None
         if api_url:
              try:
                  parsed = urllib.parse.urlparse(api_url)
                  token = urllib.parse.parse_qs(parsed.query).get('token', [None])[0]
              except: pass
-        
-        # Define New API Helper for Sheet 2
-        def fetch_bid_pack_detail(api_context, bid_id):
-            url = "https://muasamcong.mpi.gov.vn/api/unau/portal/ebid/bid-pack-info/get-detail"
-            headers = {
-                "Content-Type": "application/json",
-                "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/133.0.0.0 Safari/537.36",
-            }
-            payload = {"body": {"id": bid_id}}
-            try:
-                # Note: This is a different host/endpoint structure, usually doesn't need token if unau/portal?
-                # But headers usually needed.
-                resp = api_context.post(url, data=payload, headers=headers)
-                if resp.ok:
-                    return resp.json()
-            except Exception as e:
-                print(f"Error fetching bid-pack-info: {e}")
-            return None
 
-        phase3_inputs = []
-        if token and all_data:
-            print(f"--- Starting Detail Scraping (Token: {token[:10]}...) ---")
-            detail_output_path = output_path.replace(".xlsx", " Detail.xlsx")
-            d_name = os.path.basename(detail_output_path)
-            csv_d_s1 = os.path.join(temp_dir, d_name.replace(".xlsx", "_Sheet1.csv"))
-            csv_d_s2 = os.path.join(temp_dir, d_name.replace(".xlsx", "_Sheet2.csv"))
-            
-            detail_buffer = [] 
-            hsmtt_buffer = [] 
-            
-            total_d = len(all_data)
-            print(f"Total items to detail: {total_d}")
-            
-            for idx, row in enumerate(all_data):
-                bid_id = row.get("id")
-                # Use bidID from Phase 1 if available? 
-                # User said: "use bidID from phase 1" for the new API.
-                # Phase 1 extraction: "bidID": item.get("bidId", "")
-                phase1_bid_id = row.get("bidID") 
-                
-                # Check which ID to use for which API?
-                # Existing fetch_bid_detail uses 'id' (bid_id here).
-                # New fetch_bid_pack_detail uses 'bidID' (phase1_bid_id).
-                # If phase1_bid_id is missing, maybe fallback to bid_id?
-                target_pack_id = phase1_bid_id if phase1_bid_id else bid_id
-                
-                check_status()
-                print(f"  Fetching detail {idx+1}/{total_d}: {row.get('Mã TBMT', bid_id)}")
-                
-                # --- SHEET 1: General Info ---
-                d_json = fetch_bid_detail(api_context, token, bid_id)
-                d_row = None
-                
-                # Check for null case
-                if d_json and d_json.get("bidoNotifyContractorM") is None and d_json.get("statusDT") is None:
-                    print("  Fallback: using online-reoffer/detail...")
-                    d_json_fallback = fetch_online_reoffer_detail(api_context, bid_id)
-                    if d_json_fallback:
-                        d_row = process_online_reoffer_detail(d_json_fallback)
-                        d_json = d_json_fallback # use fallback as d_json for the next steps
+        # Output paths
+        detail_output_path = output_path.replace(".xlsx", " Detail.xlsx")
+        d_name = os.path.basename(detail_output_path)
+        csv_d_s1 = os.path.join(temp_dir, d_name.replace(".xlsx", "_Sheet1.csv"))
+        csv_d_s2 = os.path.join(temp_dir, d_name.replace(".xlsx", "_Sheet2.csv"))
+
+        dir_name = os.path.dirname(output_path)
+        phase3_output_path = os.path.join(dir_name, "Bien ban mo thau detail.xlsx")
+        csv_p3 = os.path.join(temp_dir, os.path.basename(phase3_output_path).replace(".xlsx", ".csv"))
+
+        nha_thau_path = os.path.join(dir_name, "Danh Sach Nha Thau.xlsx")
+        hang_hoa_path = os.path.join(dir_name, "Danh Sach Hang Hoa.xlsx")
+        csv_nt = os.path.join(temp_dir, os.path.basename(nha_thau_path).replace(".xlsx", ".csv"))
+        csv_hh = os.path.join(temp_dir, os.path.basename(hang_hoa_path).replace(".xlsx", ".csv"))
+
+        phases = ("detail", "bid_open", "contractor")
+        if refresh_keys:
+            # Forget the old results first: a crash in between re-fetches instead of losing rows
+            for ph in phases:
+                journal.remove_many(ph, refresh_keys)
+            for csv_f in (csv_d_s1, csv_d_s2, csv_p3, csv_nt, csv_hh):
+                drop_csv_rows(csv_f, "Mã TBMT", refresh_keys)
+
+        pending = [r for r in all_data if not all(journal.done(ph, notice_key(r)) for ph in phases)]
+        if len(pending) < len(all_data):
+            print(f"Resume: {len(all_data) - len(pending)} notices already completed all phases, skipped.")
+
+        if token and pending:
+            print(f"--- Starting Detail Pipeline (Token: {token[:10]}...) ---")
+            total_d = len(pending)
+            print(f"Total items to detail: {total_d} (Detail workers: {detail_workers})")
+
+            # Stage workers share the thread-safe cookie-seeded session
+            pipe_client = api_context
+            resolver = DetailResolver(pipe_client, token, workers=detail_workers)
+            # Phase 3: paired lotOpenDetail/bid-open calls under one request budget
+            phase3_executor = concurrent.futures.ThreadPoolExecutor(max_workers=max(1, phase3_workers))
+            phase3_limiter = RateLimiter(phase3_rate)
+            phase3_seen = set()
+            phase3_lock = threading.Lock()
+            phase4_limiter = RateLimiter(phase4_rate)
+
+            # Stage functions: payload in -> (outputs, payload for the next stage)
+            # Outputs of None mean "nothing to save for this notice": it is already in the
+            # journal, or a request failed and it stays out of the journal for a restart.
+            def detail_stage(row):
+                key = notice_key(row)
+                if journal.done("detail", key):
+                    return None, (row, journal.get("detail", key), True)
+                d_row, pack_rows, phase3_input = fetch_phase2_row(pipe_client, token, row, resolver)
+                return (d_row, pack_rows, phase3_input), (row, phase3_input, bool(d_row))
+
+            def bid_open_stage(payload):
+                row, phase3_input, detail_ok = payload
+                if not detail_ok:
+                    # No detail means no Phase 3 link yet: retried together with the detail
+                    return None, row
+                if journal.done("bid_open", notice_key(row)):
+                    return None, row
+                rows = []
+                if phase3_input:
+                    # Several notices can point at the same (notifyNo, notifyId): fetch it once
+                    key = phase3_key(phase3_input)
+                    with phase3_lock:
+                        duplicate = key is not None and key in phase3_seen
+                        phase3_seen.add(key)
+                    if not duplicate:
+                        rows = fetch_phase3_rows(pipe_client, token, phase3_input, phase3_executor, phase3_limiter)
+                        if rows is None:
+                            # Let a later notice with the same link try again
+                            with phase3_lock:
+                                phase3_seen.discard(key)
+                return rows, row
+
+            # Phase 4 is split: downloads (I/O pool) hand raw bodies to the parse pool
+            def contractor_fetch_stage(row):
+                if journal.done("contractor", notice_key(row)):
+                    return None, None
+                # Phase 4 ID Logic
+                phase4_id = row.get("inputResultId")
+                if not phase4_id or pd.isna(phase4_id):
+                    return None, (phase4_id, None, False)
+                phase4_limiter.wait()
+                body = fetch_contractor_input_result(pipe_client, token, phase4_id, raw=True)
+                return None, (phase4_id, body, True)
+
+            def contractor_stage(payload):
+                if payload is None:
+                    return None, None
+                phase4_id, body, fetched = payload
+                if not fetched:
+                    return ([], []), None
+                return parse_phase4_rows(phase4_id, body), None
+
+            # Sinks: buffered CSV writers, flushed every 200 notices so records land on disk early.
+            # A notice is journaled for a stage only after that stage's rows are flushed.
+            buffers = {"s1": [], "s2": [], "p3": [], "nt": [], "hh": []}
+            buffer_paths = {"s1": csv_d_s1, "s2": csv_d_s2, "p3": csv_p3, "nt": csv_nt, "hh": csv_hh}
+            stage_buffers = {"detail": ("s1", "s2"), "bid_open": ("p3",), "contractor": ("nt", "hh")}
+            journal_pending = {"detail": [], "bid_open": [], "contractor": []}
+            done_count = {"detail": 0, "bid_open": 0, "contractor": 0}
+
+            def flush_stage(stage):
+                for k in stage_buffers[stage]:
+                    save_batch_csv(buffers[k], buffer_paths[k])
+                    buffers[k] = []
+                journal.mark_many(stage, journal_pending[stage])
+                journal_pending[stage] = []
+
+            def on_output(stage, idx, outputs):
+                done_count[stage] += 1
+                key = notice_key(pending[idx])
+                if stage == "detail":
+                    d_row, pack_rows, phase3_input = outputs
+                    if d_row and pack_rows is not None:
+                        buffers["s1"].append(d_row)
+                        # Bid-pack rows go with the detail, so a retried notice doesn't write them twice
+                        buffers["s2"].extend(pack_rows)
+                        journal_pending[stage].append((key, phase3_input))
+                        print(f"  [Detail] {idx+1}/{total_d}: {pending[idx].get('Mã TBMT', pending[idx].get('id'))}")
+                    elif d_row:
+                        # Lots request failed: the detail waits too, so the retry writes both once
+                        print(f"  [Detail] {idx+1}/{total_d}: bid-pack lots failed for {pending[idx].get('Mã TBMT', pending[idx].get('id'))}, left for a retry.")
                     else:
-                        print("  Fallback (online-reoffer) failed (e.g. 500 error). Trying lcnt_tbmt_ttc_vk_adb...")
-                        d_json_wb = fetch_wb_adb_detail(api_context, token, bid_id)
-                        if d_json_wb:
-                             d_row = process_detail_data(d_json_wb)
-                             d_json = d_json_wb
+                        # Failed detail lookups stay out of the journal so a restart retries them
+                        print(f"  [Detail] {idx+1}/{total_d}: no detail for {pending[idx].get('Mã TBMT', pending[idx].get('id'))}, left for a retry.")
+                elif stage == "bid_open":
+                    buffers["p3"].extend(outputs)
+                    journal_pending[stage].append((key, None))
+                    if outputs:
+                        print(f"  [Bid Opening] {idx+1}/{total_d}: {len(outputs)} rows")
                 else:
-                    d_row = process_detail_data(d_json)
+                    nt_rows, hh_rows = outputs
+                    buffers["nt"].extend(nt_rows)
+                    buffers["hh"].extend(hh_rows)
+                    journal_pending[stage].append((key, None))
+                    if nt_rows or hh_rows:
+                        print(f"  [Contractor Input] {idx+1}/{total_d}: {len(nt_rows)} contractors, {len(hh_rows)} goods")
+                if done_count[stage] % 200 == 0:
+                    flush_stage(stage)
+                    print(f"  [Auto-Save CSV] Saved '{stage}' batch ({done_count[stage]}/{total_d}).")
+
+            pipeline = StagePipeline([
+                ("detail", detail_stage, detail_workers),
+                ("bid_open", bid_open_stage, phase3_workers),
+                ("contractor_fetch", contractor_fetch_stage, phase4_workers),
+                ("contractor", contractor_stage, parse_workers),
+            ], queue_size=max(20, detail_workers * 4, phase3_workers * 4, phase4_workers * 4))
 
-                if d_row:
-                    detail_buffer.append(d_row)
-                
-                try:
-                    plan = d_json.get("bidpPlanDetail", {}) or d_json.get("bidPlan", {}) or {}
-                    link_info_str = plan.get("linkNotifyInfo")
-                    if link_info_str:
-                         phase3_inputs.append(link_info_str)
-                    elif "reofferNo" in d_json:
-                         # Append anyway so Phase 3 can query lotOpenDetail
-                         phase3_inputs.append(json.dumps({"notifyNo": d_json.get("reofferNo"), "notifyId": bid_id}))
-                except: pass
-                
-                # --- SHEET 2: Ho so moi thau ---
-                if target_pack_id:
-                    pack_json = fetch_bid_pack_detail(api_context, target_pack_id)
-                    if pack_json and "body" in pack_json:
-                        body = pack_json["body"]
-                        notif = body.get("bidNotification", {}) or {}
-                        
-                        # Formatting helpers
-                        def fmt_ts(iso):
-                            if not iso: return ""
-                            try:
-                                # 2026-01-15T15:05:00 -> dd/mm/yyyy HH:MM:SS
-                                # Simple string replace
-                                T_split = iso.split("T")
-                                date_part = T_split[0]
-                                time_part = T_split[1] if len(T_split) > 1 else ""
-                                y, m, d = date_part.split("-")
-                                return f"{d}/{m}/{y} {time_part.split('.')[0]}"
-                            except: return iso
-                        
-                        def fmt_num(v): 
-                             if v is None or v == "": return ""
-                             try: return "{:,.0f}".format(float(v)).replace(",", ".")
-                             except: return str(v)
-
-                        # Lot List Logic
-                        lots = notif.get("lotDTOList")
-                        if not lots:
-                            lots = body.get("detailLotList")
-                        
-                        if lots and isinstance(lots, list):
-                            for lot in lots:
-                                # Data Extraction Logic with multiple fallbacks
-                                # 1. Bid Name
-                                b_name = notif.get("bidName")
-                                if not b_name: b_name = body.get("bidName")
-                                if not b_name: b_name = row.get("Tên gói thầu", "")
-                                
-                                # 2. Dates
-                                d_open = notif.get("bidOpenDate")
-                                d_close = notif.get("bidCloseDate")
-                                
-                                if not d_close: d_close = row.get("Thời điểm đóng thầu", "")
-                                final_open = fmt_ts(d_open)
-                                final_close = fmt_ts(d_close) 
-                                if not final_close and row.get("Thời điểm đóng thầu"):
-                                     final_close = row.get("Thời điểm đóng thầu")
-                                if not final_open and row.get("Thời điểm mở thầu"):
-                                     final_open = row.get("Thời điểm mở thầu")
-
-                                r2 = {
-                                    "Mã TBMT": notif.get("notifyNo") if notif.get("notifyNo") else (body.get("linkNotifyInfo") or {}).get("notifyNo", row.get("Mã TBMT")),
-                                    "Tên gói thầu": b_name,
-                                    "Mã phần (Lô)": lot.get("lotNo"), 
-                                    "Mã Thuốc": lot.get("medicineCode"),
-                                    "Tên hoạt chất/ Tên thành phần thuốc": lot.get("lotName"),
-                                    "Nồng độ/ hàm lượng": lot.get("nongDo"),
-                                    "Đường dùng": lot.get("duongDung"),
-                                    "Dạng bào chế": lot.get("dangBaoChe"),
-                                    "Đơn vị tính": lot.get("uom"),
-                                    "Số lượng": fmt_num(lot.get("quantity")),
-                                    "Giá trị ước tính từng phần (VND)": fmt_num(lot.get("lotPrice")),
-                                    "Giá kế hoạch": fmt_num(lot.get("pricePlan")),
-                                    "Nhóm thuốc": lot.get("groupMedicine"),
-                                    "Thời điểm mở thầu": final_open,
-                                    "Thời điểm đóng thầu": final_close
-                                }
-                                hsmtt_buffer.append(r2)
-                
-                # Auto-Save (CSV)
-                if (idx + 1) % 200 == 0:
-                    save_batch_csv(detail_buffer, csv_d_s1)
-                    save_batch_csv(hsmtt_buffer, csv_d_s2)
-                    detail_buffer = []
-                    hsmtt_buffer = []
-                    print(f"  [Auto-Save CSV] Saved batch.")
-            
-            # Flush Remaining
-            save_batch_csv(detail_buffer, csv_d_s1)
-            save_batch_csv(hsmtt_buffer, csv_d_s2)
-            
-            # Finalize Excel
-            finalize_excel(
-                {"Thông tin chung": csv_d_s1, "Hồ sơ mời thầu": csv_d_s2}, 
-                detail_output_path
-            )
-        else:
+            try:
+                pipeline.run(pending, on_output, check_status)
+            finally:
+                # Flush Remaining (also on stop, so partial results are kept)
+                for stage in phases:
+                    flush_stage(stage)
+                resolver.close()
+                phase3_executor.shutdown(wait=False, cancel_futures=True)
+        elif not token or not all_data:
             print("Skipping details: No token found or no data.")
 
-        # --- PHASE 3: Bid Opening Details ---
-        # --- PHASE 3: Bid Opening Details ---
-        if token and phase3_inputs:
-             print(f"--- Starting Phase 3: Bid Opening Details (Count: {len(phase3_inputs)}) ---")
-             
-             # Save to same directory as output_path
-             dir_name = os.path.dirname(output_path)
-             phase3_output_path = os.path.join(dir_name, "Bien ban mo thau detail.xlsx")
-             p3_name = os.path.basename(phase3_output_path)
-             csv_p3 = os.path.join(temp_dir, p3_name.replace(".xlsx", ".csv"))
-
-             phase3_buffer = []
-             
-             for i, info_str in enumerate(phase3_inputs):
-                 check_status()
-                 try:
-                     # Parse info
-                     info_obj = json.loads(info_str)
-                     notify_no = info_obj.get("notifyNo")
-                     notify_id = info_obj.get("notifyId")
-                     
-                     if not notify_no or not notify_id: continue
-                     
-                     print(f"  Phase 3 Processing {i+1}/{len(phase3_inputs)}: {notify_no}")
-                     
-                     # Call APIs
-                     # API 1
-                     lot_details = fetch_lot_open_detail(api_context, token, notify_no, notify_id)
-                     
-                     # Check if array is empty
-                     if not lot_details or (isinstance(lot_details, list) and len(lot_details) == 0):
-                         print("  lotOpenDetail empty, skipping Phase 3 record.")
-                         continue
-                     
-                     # API 2
-                     bid_opens = fetch_bid_open(api_context, token, notify_no, notify_id)
-
-                     # Process & Join
-                     # API 1 list
-                     lot_list = lot_details if isinstance(lot_details, list) else []
-                     
-                     # API 2 Map
-                     bid_map = {} # Map bid_id (id in API 2) -> object
-                     if bid_opens and "bidSubmissionByContractorViewResponse" in bid_opens:
-                         sub_list = bid_opens["bidSubmissionByContractorViewResponse"].get("bidSubmissionDTOList", [])
-                         if sub_list:
-                             for sub in sub_list:
-                                 if "id" in sub:
-                                     bid_map[sub["id"]] = sub
-                     
-                     # Join
-                     # Helper for formatting: 13545000 -> 13.545.000
-                     def fmt_val(v):
-                        if v is None or v == "": return ""
-                        try:
-                            return "{:,.0f}".format(float(v)).replace(",", ".")
-                        except:
-                            return str(v)
-
-                     for lot in lot_list:
-                          # Create Row
-                          bid_open_id = lot.get("bidOpenId")
-                          linked_bid = bid_map.get(bid_open_id, {})
-                          
-                          row = {
-                              "Mã TBMT": notify_no,
-                              "Mã phân/ lô": lot.get("lotNo"),
-                              "Tên thành phần thuốc": lot.get("lotName"),
-                              "Mã định danh": lot.get("contractorCode"),
-                              "Tên nhà thầu": lot.get("contractorName"),
-                              "Hiệu lực HSDT (Ngày)": linked_bid.get("bidValidityNum"),
-                              "Bảo đảm dự thầu cho các phần tham dự (VND)": fmt_val(linked_bid.get("bidGuarantee")),
-                              "Hiệu lực của BĐDT (Ngày)": linked_bid.get("bidGuaranteeValidity"),
-                              "Giá dự thầu": fmt_val(lot.get("lotPrice")),
-                              "Tỷ lệ phần trăm giảm giá (nếu có)": lot.get("discountPercent"),
-                              "Giá dự thầu sau giảm giá (VND)": fmt_val(lot.get("lotFinalPrice"))
-                          }
-                          phase3_buffer.append(row)
-                     
-                     time.sleep(0.5)
-                     if len(phase3_buffer) >= 200:
-                        save_batch_csv(phase3_buffer, csv_p3)
-                        phase3_buffer = []
-
-                 except Exception as e:
-                     print(f"  Error Phase 3 item: {e}")
-             
-             # Save
-             save_batch_csv(phase3_buffer, csv_p3)
-             finalize_excel({"Sheet1": csv_p3}, phase3_output_path)
-
-        # --- PHASE 4: Contractor Input Result (Danh Sach Nha Thau & Hang Hoa) ---
         if token and all_data:
-             print(f"--- Starting Phase 4: Contractor & Goods Lists ---")
-             dir_name = os.path.dirname(output_path)
-             nha_thau_path = os.path.join(dir_name, "Danh Sach Nha Thau.xlsx")
-             hang_hoa_path = os.path.join(dir_name, "Danh Sach Hang Hoa.xlsx")
-             
-             nt_name = os.path.basename(nha_thau_path)
-             hh_name = os.path.basename(hang_hoa_path)
-             csv_nt = os.path.join(temp_dir, nt_name.replace(".xlsx", ".csv"))
-             csv_hh = os.path.join(temp_dir, hh_name.replace(".xlsx", ".csv"))
-             
-             nt_buffer = []
-             hh_buffer = []
-             
-             total_p4 = len(all_data)
-             
-             for i, row in enumerate(all_data):
-
-                 # Phase 4 ID Logic
-                 phase4_id = row.get("inputResultId")
-                 if not phase4_id: 
-                     # print(f"  Phase 4: Skipping {row.get('Mã TBMT')} (No inputResultId)")
-                     continue
-                 
-                 check_status()
-                 print(f"  Phase 4: Processing {i+1}/{total_p4} | InputResultID: {phase4_id}...")
-             
-                 try:
-                     res = fetch_contractor_input_result(api_context, token, phase4_id)
-                     if not res: 
-                         print(f"    -> [Skipped] API returned None for {phase4_id}")
-                         continue
-                 
-                     root_dto = res.get("bideContractorInputResultDTO", {})
-                     if not root_dto: 
-                         print(f"    -> [Skipped] No bideContractorInputResultDTO for {bid_id}")
-                         continue
-                 
-                     notify_no = root_dto.get("notifyNo")
-                     lot_results = root_dto.get("lotResultDTO") or []
-                     lot_items = root_dto.get("lotResultItems") or []
-                    #  Check if lot_items is empty
-                     if not lot_items:
-                         d_vers = root_dto.get("decisionVersions")
-                         if d_vers and isinstance(d_vers, list):
-                             for v in reversed(d_vers):
-                                 items = v.get("lotResultItems")
-                                 if items:
-                                     lot_items = items
-                                     break
-                     
-                     if not lot_results and not lot_items:
-                         print(f"    -> [Info] No lot results or items.")
-                     
-                     # 1. Process Danh Sach Nha Thau
-                     # Strategy: Iterate Lots -> ContractorList -> Link to LotItems
-                     for lot in lot_results:
-                         l_no = lot.get("lotNo")
-                         l_name = lot.get("lotName")
-                         c_list = lot.get("contractorList") or []
-                         
-                         for cntr in c_list:
-                             # Link: item_result["listLotResultId"] == cntr["id"]
-                             cntr_id = cntr.get("id")
-                             linked_item = None
-                             for it in lot_items:
-                                 if it.get("listLotResultId") == cntr_id:
-                                     linked_item = it
-                                     break
-                            
-                             don_gia = None
-                             qty = None
-                             
-                             if linked_item:
-                                 fv_str = linked_item.get("formValue")
-                                 if fv_str:
-                                     try:
-                                         fv_json = json.loads(fv_str)
-                                         if fv_json and isinstance(fv_json, list):
-                                              # Take first item for summary?
-                                              first = fv_json[0]
-                                              don_gia = first.get("donGia")
-                                              if not don_gia:
-                                                  don_gia = first.get("unitPrice")
-                                              qty = first.get("quantity")
-                                     except: pass
-                             
-                             # Mapping
-                             bid_res_val = cntr.get("bidResult")
-                             if str(bid_res_val) == "1":
-                                 result_status = "Trúng thầu"
-                             else:
-                                 result_status = "Không trúng thầu"
-                             
-                             reason_val = cntr.get("reason")
-                             
-                             gia_du_thau = cntr.get("lotOpenPrice")
-                             if not gia_du_thau:
-                                 gia_du_thau = cntr.get("lotPrice")
-                                 
-                             gia_trung_thau = cntr.get("lotFinalPrice") if str(bid_res_val) == "1" else ""
-                             
-                             # Formatting
-                             def fmt(x):
-                                 if x is None or x == "": return ""
-                                 try: return "{:,.0f}".format(float(x)).replace(",", ".")
-                                 except: return str(x)
-
-                             row_nt = {
-                                 "Mã TBMT": notify_no,
-                                 "Mã phần (lô)": l_no,
-                                 "Tên hoạt chất/ Tên thành phần thuốc": l_name,
-                                 "Mã định danh": cntr.get("orgCode"),
-                                 "Mã số thuế": cntr.get("taxCode"),
-                                 "Tên nhà thầu": cntr.get("orgFullname"),
-                                 "Giá Dự thầu": fmt(gia_du_thau),
-                                 "Đơn giá trúng thầu (VND)": fmt(don_gia),
-                                 "Giá trúng thầu của từng phần đã bao gồm giảm giá (VND) (đã bao gồm các hạng mục của phần đó)": fmt(gia_trung_thau),
-                                 "Số lượng trúng thầu": fmt(qty),
-                                 "Kết quả": result_status,
-                                 "Lý do không đáp ứng": reason_val,
-                                 "Thời gian thực hiện gói thầu": cntr.get("cperiodText"),
-                                 "Thời gian thực hiện hợp đồng": cntr.get("bidExecutionTime")
-                             }
-                             nt_buffer.append(row_nt)
-
-                     # 2. Process Danh Sach Hang Hoa
-                     # Strategy: Iterate LotItems -> formValue
-                     for it in lot_items:
-                         fv_str = it.get("formValue")
-                         if not fv_str: continue
-                         try:
-                             goods = json.loads(fv_str)
-                             if not goods or not isinstance(goods, list): continue
-                             
-                             it_lot_result_id = it.get("lotResultId")
-                             
-                             for g in goods:
-                                 def fmt(x):
-                                     if x is None or x == "": return ""
-                                     try: return "{:,.0f}".format(float(x)).replace(",", ".")
-                                     except: return str(x)
-
-                                 lotNo_val = g.get("lotNo")
-                                 if not lotNo_val and it_lot_result_id:
-                                     for lr in lot_results:
-                                         if lr.get("id") == it_lot_result_id:
-                                             lotNo_val = lr.get("lotNo")
-                                             break
-
-                                 don_gia_val = g.get("donGia")
-                                 if not don_gia_val:
-                                     don_gia_val = g.get("unitPrice")
-                                     
-                                 xuat_xu_val = g.get("nuocSanXuat")
-                                 if not xuat_xu_val:
-                                     xuat_xu_val = g.get("origin")
-                                     
-                                 thanh_tien_val = g.get("subTotal")
-                                 if not thanh_tien_val:
-                                     thanh_tien_val = g.get("amount")
-
-                                 row_hh = {
-                                     "Mã TBMT": notify_no,
-                                     "Mã Phần/lô": lotNo_val,
-                                     "Mã thuốc": g.get("medicineCode"),
-                                     "Tên thuốc": g.get("name"),
-                                     "Tên hoạt chất/ Tên thành phần của thuốc": g.get("tenHoatChat"),
-                                     "Nồng độ, hàm lượng": g.get("nongDo"),
-                                     "Đường dùng": g.get("duongDung"),
-                                     "Dạng bào chế": g.get("dangBaoChe"),
-                                     "Quy cách": g.get("quyCach"),
-                                     "Nhóm thuốc": g.get("groupMedicine"),
-                                     "Hạn dùng (Tuổi thọ)": g.get("hanDung"),
-                                     "GĐKLH hoặc GPNK": g.get("gdklh"),
-                                     "Cơ sở sản xuất": g.get("csSanXuat"),
-                                     "Xuất xứ": xuat_xu_val,
-                                     "Thông số kỹ thuật": g.get("feature"),
-                                     "Đơn vị tính": g.get("uom"),
-                                     "Số lượng": fmt(g.get("quantity")),
-                                     "Khối lượng": fmt(g.get("qty")),
-                                     "Đơn giá trúng thầu (VND)": fmt(don_gia_val),
-                                     "Thành tiền": fmt(thanh_tien_val),
-                                     "Nhà thầu trúng thầu": g.get("contractorName") if g.get("contractorName") else it.get("contractorName"),
-                                     "Tiến độ cung cấp": g.get("tienDo")
-                                 }
-                                 hh_buffer.append(row_hh)
-                         except: pass
-
-                     time.sleep(0.3)
-                     if (i + 1) % 200 == 0:
-                        save_batch_csv(nt_buffer, csv_nt)
-                        save_batch_csv(hh_buffer, csv_hh)
-                        nt_buffer = []
-                        hh_buffer = []
-                 
-                 except Exception as e:
-                     print(f"  Error Phase 4 {bid_id}: {e}")
-             
-             # Save Files
-             save_batch_csv(nt_buffer, csv_nt)
-             save_batch_csv(hh_buffer, csv_hh)
-             
-             if os.path.exists(csv_nt):
-                 finalize_excel({"Danh Sach Nha Thau": csv_nt}, nha_thau_path)
-             if os.path.exists(csv_hh):
-                 finalize_excel({"Danh Sach Hang Hoa": csv_hh}, hang_hoa_path)
-
-        browser.close()
+            # Finished: the next run searches again (new notices) instead of reusing this Phase 1
+            journal.remove("search", "complete")
+            journal.remove_many("window", list(journal.entries.get("window", {})))
 
+            # Finalize Excel
+            export_outputs(
+                {"Thông tin chung": csv_d_s1, "Hồ sơ mời thầu": csv_d_s2}, 
+                detail_output_path, output_format, export_excel, db_path
+            )
+            if os.path.exists(csv_p3):
+                export_outputs({"Sheet1": csv_p3}, phase3_output_path, output_format, export_excel, db_path)
+            if os.path.exists(csv_nt):
+                export_outputs({"Danh Sach Nha Thau": csv_nt}, nha_thau_path, output_format, export_excel, db_path)
+            if os.path.exists(csv_hh):
+                export_outputs({"Danh Sach Hang Hoa": csv_hh}, hang_hoa_path, output_format, export_excel, db_path)
+
+        unfinished = {
+            r.get("Mã TBMT") or notice_key(r) for r in all_data
+            if not (token and all(journal.done(ph, notice_key(r)) for ph in phases))
+        }
+        # Got to the end (see contractor_run_pending): value = notices left for a retry
+        journal.mark("run", "finished", len(unfinished) + failed_pages)
+
+        # Move the watermark only after a complete Phase 1 and a finished pipeline, and
+        # no further than the oldest notice whose Phases 2-4 did not all succeed
+        if incremental and sync_state["watermark"].get("public_date") and (search_complete or (searched and not failed_pages)):
+            # Misses are counted per notice, so one that never resolves can't freeze the sync
+            misses = [(k, (journal.get("sync_miss", k) or 0) + 1) for k in unfinished]
+            journal.mark_many("sync_miss", misses)
+            journal.remove_many("sync_miss", [k for k in list(journal.entries.get("sync_miss", {})) if k not in unfinished])
+            given_up = {k for k, n in misses if n > SYNC_MAX_HOLDS}
+            if given_up:
+                print(f"{len(given_up)} notices failed {SYNC_MAX_HOLDS} syncs in a row: they no longer hold the watermark back (still retried in this folder).")
+            unfinished -= given_up
+            new_mark = hold_watermark(sync_state["watermark"], sync_state["seen_dates"], unfinished)
+            if new_mark is None:
+                print(f"Sync watermark kept: {len(unfinished)} notices unfinished and their dates are unknown.")
+            else:
+                if unfinished:
+                    print(f"{len(unfinished)} notices unfinished: the next sync fetches them again.")
+                save_sync_watermark(sync_key, new_mark)
+                print(f"Sync watermark: {new_mark['public_date']}")
+    finally:
+        if api_context.memo.hits:
+            print(f"Duplicate detail requests answered from this run's memo: {api_context.memo.hits}")
+        api_context.close()
 
-def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords="", from_date="", to_date=""):
-    print(f"--- Bắt đầu cào Yêu cầu báo giá ---")
-    if output_path is None:
-        output_path = "YeuCauBaoGia.xlsx"
-    if not output_path.endswith(".xlsx"):
-        output_path += ".xlsx"
-    
-    print(f"File: {output_path}")
-    print(f"Keywords: {keywords[:50] if keywords else 'N/A'}...")
-    if from_date or to_date:
-        print(f"Date Range: {from_date} - {to_date}")
-        
-    try:
-        temp_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), "temp")
-        os.makedirs(temp_dir, exist_ok=True)
-    except:
-        temp_dir = os.path.dirname(output_path)
-        
-    csv_name = os.path.basename(output_path).replace(".xlsx", ".csv")
-    csv_path = os.path.join(temp_dir, csv_name)
-    
-    def check_status():
-        if stop_event and stop_event.is_set():
-            raise InterruptedError("Stopped by user.")
-        if pause_event and not pause_event.is_set():
-            print(">>> PAUSED...")
-            pause_event.wait()
-            if stop_event and stop_event.is_set():
-                 raise InterruptedError("Stopped by user.")
-            print(">>> RESUMED.")
 
-    def format_datetime(iso):
-        if not iso: return ""
-        try:
-            # Format: dd/mm/yyyy hh:mm
-            import datetime
-            d = datetime.datetime.fromisoformat(iso.replace("Z", "+00:00").replace("T", " "))
-            return d.strftime("%d/%m/%Y %H:%M")
-        except:
-            return str(iso)
+def capture_rfq_search(keywords="", from_date="", to_date="", check_status=None, headless=False):
+    """
+    Same as capture_contractor_search, for the "Yêu cầu báo giá" search form.
+    Returns {"api_url", "payload", "cookies"} or None.
+    """
+    if check_status is None:
+        check_status = lambda: None
 
     with sync_playwright() as p:
         browser = None
-        try: browser = p.chromium.launch(headless=False, channel="chrome")
+        try: browser = p.chromium.launch(headless=headless, channel="chrome")
         except:
-            try: browser = p.chromium.launch(headless=False, channel="msedge")
-            except: browser = p.chromium.launch(headless=False)
+            try: browser = p.chromium.launch(headless=headless, channel="msedge")
+            except: browser = p.chromium.launch(headless=headless)
             
         context = browser.new_context(viewport={"width": 1366, "height": 768}, ignore_https_errors=True)
         page = context.new_page()
@@ -1518,46 +3783,168 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
         except Exception as e:
             print(f"Lỗi khởi tạo UI: {e}")
             browser.close()
-            return
+            return None
             
         if not api_url or not base_payload:
             print("Failed to capture API request.")
             browser.close()
+            return None
+
+        session = {"api_url": api_url, "payload": base_payload, "cookies": context.cookies()}
+        browser.close()
+        return session
+
+
+def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords="", from_date="", to_date="", reuse_session=True, headless=False, detail_workers=DEFAULT_DETAIL_WORKERS, page_workers=DEFAULT_PAGE_WORKERS, search_rate=DEFAULT_SEARCH_RATE, shard_dates=True, output_format="xlsx", export_excel=None, db_path=None):
+    print(f"--- Bắt đầu cào Yêu cầu báo giá ---")
+    watch_stop(stop_event)
+    if output_path is None:
+        output_path = "YeuCauBaoGia.xlsx"
+    if not output_path.endswith(".xlsx"):
+        output_path += ".xlsx"
+    
+    print(f"File: {output_path}")
+    print(f"Keywords: {keywords[:50] if keywords else 'N/A'}...")
+    if from_date or to_date:
+        print(f"Date Range: {from_date} - {to_date}")
+        
+    try:
+        temp_dir = os.path.join(os.path.dirname(os.path.abspath(output_path)), "temp")
+        os.makedirs(temp_dir, exist_ok=True)
+    except:
+        temp_dir = os.path.dirname(output_path)
+        
+    csv_name = os.path.basename(output_path).replace(".xlsx", ".csv")
+    csv_path = os.path.join(temp_dir, csv_name)
+    
+    def check_status():
+        if stop_event and stop_event.is_set():
+            raise InterruptedError("Stopped by user.")
+        if pause_event and not pause_event.is_set():
+            print(">>> PAUSED...")
+            pause_event.wait()
+            if stop_event and stop_event.is_set():
+                 raise InterruptedError("Stopped by user.")
+            print(">>> RESUMED.")
+
+    def format_datetime(iso):
+        if not iso: return ""
+        try:
+            # Format: dd/mm/yyyy hh:mm
+            import datetime
+            d = datetime.datetime.fromisoformat(iso.replace("Z", "+00:00").replace("T", " "))
+            return d.strftime("%d/%m/%Y %H:%M")
+        except:
+            return str(iso)
+
+    # Search Session: saved token/payload first, browser only when the server rejects it
+    search_key = search_session_key("rfq", keywords=keywords, from_date=from_date, to_date=to_date)
+    session = load_search_session(search_key) if reuse_session else None
+    if session:
+        if probe_search_session(session):
+            print("Reusing saved search session (browserless).")
+        else:
+            print("Saved search token was rejected. Re-capturing with browser...")
+            session = None
+
+    if not session:
+        session = capture_rfq_search(keywords=keywords, from_date=from_date, to_date=to_date, check_status=check_status, headless=headless)
+        if not session:
             return
-            
+        save_search_session(search_key, session)
+
+    api_url = session["api_url"]
+    base_payload = session["payload"]
+    def reharvest_token():
+        fresh = capture_rfq_search(keywords=keywords, from_date=from_date, to_date=to_date, check_status=check_status, headless=headless)
+        if fresh:
+            save_search_session(search_key, fresh)
+        return fresh
+
+    api_context = ApiSession(
+        session.get("cookies"), pool_size=max(detail_workers, page_workers),
+        token_manager=TokenManager(url_token(api_url), reharvest_token) if url_token(api_url) else None
+    )
+
+    # Long date ranges: concurrent date windows, checkpointed in the run journal
+    shard_fields = plan_date_shards(base_payload, from_date, to_date) if shard_dates else None
+    journal = RunJournal(os.path.join(temp_dir, csv_name.replace(".csv", ".journal.jsonl")))
+
+    try:
         print("API Scraper Configured. Starting batch processing...")
-        current_payload_obj = base_payload[0] if isinstance(base_payload, list) else base_payload
+        # Copy: the date windows below still need the untouched template
+        current_payload_obj = copy.deepcopy(base_payload[0] if isinstance(base_payload, list) else base_payload)
         current_payload_obj["pageSize"] = 50
         
         page_num = 0
         total_fetched = 0
-        api_context = context.request
         item_buffer = []
 
         import datetime
         current_dt = datetime.datetime.now()
+
+        def map_rfq_item(item):
+            # Dates stay datetimes; dd/mm/yyyy hh:mm at export
+            pub_date = api_datetime(item.get("publicDate"))
+            dec_date = api_datetime(item.get("decisionDate"))
+            
+            # Check status
+            status_text = "Chưa hết hạn nhận báo giá"
+            close_dt_iso = item.get("recceiveCloseDate") or item.get("bidCloseDate")
+            if close_dt_iso:
+                try:
+                    c_dt = datetime.datetime.fromisoformat(close_dt_iso.split(".")[0].replace("Z", "+00:00").replace("T", " "))
+                    if c_dt.replace(tzinfo=None) < current_dt:
+                        status_text = "Đã hết hạn nhận báo giá"
+                except: pass
+            
+            return {
+                "Mã YCBG": item.get("notifyNo"),
+                "Tên": item.get("name") or item.get("bidName"),
+                "Chủ Đầu tư": item.get("investorName"),
+                "Ngày đăng tải": pub_date,
+                "Ngày phê duyệt": dec_date,
+                "Trạng thái": status_text,
+                "Id": item.get("id")
+            }
+
+        if shard_fields:
+            # Windows are disjoint, but a notice on a window edge can come back twice: dedupe on Id
+            seen_ids = set()
+            if os.path.exists(csv_path):
+                try: seen_ids = set(pd.read_csv(csv_path)["Id"].dropna().astype(str).str.strip())
+                except Exception as e: print(f"Warning: Could not read existing file: {e}")
+
+            def save_window(items):
+                rows = []
+                for item in items:
+                    rq_id = str(item.get("id") or item.get("notifyNo") or "").strip()
+                    if rq_id in seen_ids: continue
+                    seen_ids.add(rq_id)
+                    rows.append(map_rfq_item(item))
+                save_batch_csv(rows, csv_path)
+                print(f"  Saved {len(rows)} items to CSV.")
+
+            run_sharded_search(
+                api_context, api_url, base_payload, shard_fields, from_date, to_date, 50, save_window,
+                RateLimiter(search_rate), page_workers, check_status, journal
+            )
         
-        while True:
+        while not shard_fields:
             check_status()
             current_payload_obj["pageNumber"] = page_num
             final_payload = [current_payload_obj] if isinstance(base_payload, list) else current_payload_obj
             
             print(f"--- Fetching API Page {page_num} (Size: 50) ---")
             
-            retry = 0
+            # Retries and backoff happen inside the session
             response_json = None
-            while retry < 3:
-                try:
-                    resp = api_context.post(api_url, data=final_payload)
-                    if resp.ok:
-                        response_json = resp.json()
-                        break
-                    else:
-                        time.sleep(2)
-                        retry += 1
-                except:
-                     time.sleep(2)
-                     retry += 1
+            try:
+                resp = api_context.post(api_url, data=final_payload)
+                if resp.ok:
+                    response_json = resp.json()
+            except Exception as e:
+                print(f"Request failed (page {page_num}): {e}")
             
             if not response_json:
                 print("Failed to get response after retries.")
@@ -1577,33 +3964,7 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                 print("No items in response. End of items.")
                 break
                 
-            df_new = []
-            
-            for item in items:
-                # Format Date
-                pub_date = format_datetime(item.get("publicDate"))
-                dec_date = format_datetime(item.get("decisionDate"))
-                
-                # Check status
-                status_text = "Chưa hết hạn nhận báo giá"
-                close_dt_iso = item.get("recceiveCloseDate") or item.get("bidCloseDate")
-                if close_dt_iso:
-                    try:
-                        c_dt = datetime.datetime.fromisoformat(close_dt_iso.split(".")[0].replace("Z", "+00:00").replace("T", " "))
-                        if c_dt.replace(tzinfo=None) < current_dt:
-                            status_text = "Đã hết hạn nhận báo giá"
-                    except: pass
-                
-                row = {
-                    "Mã YCBG": item.get("notifyNo"),
-                    "Tên": item.get("name") or item.get("bidName"),
-                    "Chủ Đầu tư": item.get("investorName"),
-                    "Ngày đăng tải": pub_date,
-                    "Ngày phê duyệt": dec_date,
-                    "Trạng thái": status_text,
-                    "Id": item.get("id")
-                }
-                df_new.append(row)
+            df_new = [map_rfq_item(item) for item in items]
                 
             item_buffer.extend(df_new)
             total_fetched += len(df_new)
@@ -1614,11 +3975,10 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                 item_buffer = []
                 
             page_num += 1
-            time.sleep(1)
 
         save_batch_csv(item_buffer, csv_path)
         if os.path.exists(csv_path):
-            finalize_excel({"YeuCauBaoGia": csv_path}, output_path)
+            export_outputs({"YeuCauBaoGia": csv_path}, output_path, output_format, export_excel, db_path)
         print(f"Completed Phase 1! Data saved to {output_path}")
 
         # --- Phase 2: Details ---
@@ -1631,9 +3991,6 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
         
         detail_endpoint = "https://muasamcong.mpi.gov.vn/o/egp-portal-contractor-selection-v2/services/get-request-quote"
         
-        import pandas as pd
-        import json
-        
         try:
             df_p1 = pd.read_csv(csv_path)
             ids_to_fetch = df_p1["Id"].dropna().astype(str).str.strip().tolist()
@@ -1649,43 +4006,27 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
         def fmt_dt(iso_str):
             return format_datetime(iso_str)
             
-        def fmt_num(x):
-            if x is None or x == "": return ""
-            try: return "{:,.0f}".format(float(x)).replace(",", ".")
-            except: return str(x)
-            
-        for idx, rq_id in enumerate(ids_to_fetch):
-            check_status()
-            print(f"  [{idx+1}/{len(ids_to_fetch)}] Fetching detail for ID: {rq_id}")
-            
+        def fetch_rfq_detail(rq_id):
+            """Fetches and maps one YCBG. Returns (detail row, "Nội dung YCBG" rows) or None."""
             payload_detail = {"id": rq_id}
             
-            retry = 0
             detail_data = None
-            while retry < 3:
-                try:
-                    resp = api_context.post(detail_endpoint, data=payload_detail)
-                    if resp.ok:
-                        detail_data = resp.json()
-                        break
-                    else:
-                        print(f"      Code {resp.status} - retrying...")
-                        time.sleep(1)
-                        retry += 1
-                except Exception as e:
-                    print(f"      API exception: {e}")
-                    time.sleep(1)
-                    retry += 1
-                    time.sleep(1)
-                    retry += 1
+            try:
+                resp = api_context.post(detail_endpoint, data=payload_detail)
+                if resp.ok:
+                    detail_data = resp.json()
+                else:
+                    print(f"      Code {resp.status} (ID {rq_id})")
+            except Exception as e:
+                print(f"      API exception: {e}")
                     
             if not detail_data:
                 print(f"    -> Lỗi kết nối lấy detail ID: {rq_id}")
-                continue
+                return None
                 
             try:
                 rq_obj = detail_data.get("bidoRequestQuote", {})
-                if not rq_obj: continue
+                if not rq_obj: return None
                 
                 # Trạng thái yêu cầu báo giá
                 st_val = rq_obj.get("status", "")
@@ -1735,20 +4076,12 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                 
                 th_hieu_luc = f"{val_per} {val_unit} kể từ ngày {rf_to}" if val_per else ""
                 
-                # Ngày đăng tải
-                pub_d = rq_obj.get("publicDate")
-                pub_d_str = ""
-                if pub_d:
-                    pub_fmt = fmt_dt(pub_d)
-                    if pub_fmt:
-                        pub_d_str = pub_fmt.split(" ")[0]
-                
                 row_detail = {
                     "Mã YCBG": rq_obj.get("requestQuoteNo"),
                     "Tên Yêu Cầu Báo Giá": rq_obj.get("requestQuoteName"),
                     "Tên dự án/ dự toán mua sắm": rq_obj.get("pName"),
                     "Tên gói thầu": rq_obj.get("bidName"),
-                    "Ngày đăng tải": pub_d_str,
+                    "Ngày đăng tải": api_date(rq_obj.get("publicDate")),
                     "Trạng thái yêu cầu báo giá": st_text,
                     "Đơn vị yêu cầu báo giá": rq_obj.get("investorName"),
                     "Phân loại báo giá": rq_type_txt,
@@ -1763,7 +4096,7 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                     "Thời hạn tiếp nhận báo giá": th_tiep_nhan,
                     "Thời hạn có hiệu lực của báo giá": th_hieu_luc
                 }
-                detail_buffer.append(row_detail)
+                rows_n = []
                 
                 # Nội dung
                 fv_str = rq_obj.get("formValue", "")
@@ -1782,7 +4115,7 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                                 "Đường dùng": it.get("duongDung"),
                                 "Dạng bào chế": it.get("dangBaoChe"),
                                 "Đơn vị tính": it.get("uom"),
-                                "Số lượng": fmt_num(it.get("quantity")),
+                                "Số lượng": api_number(it.get("quantity")),
                                 "Khối lượng": it.get("qty"),
                                 "Đơn vị tính": it.get("unit"),
                                 "Mô tả chi tiết": it.get("description"),
@@ -1790,19 +4123,28 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
                                 "Quy cách": it.get("specification"),
                                 "Ghi chú": it.get("note")
                             }
-                            noidung_buffer.append(row_n)
+                            rows_n.append(row_n)
                 except: pass
                     
-                if (idx + 1) % 100 == 0:
-                    save_batch_csv(detail_buffer, csv_detail_path)
-                    save_batch_csv(noidung_buffer, csv_noidung_path)
-                    detail_buffer = []
-                    noidung_buffer = []
+                return row_detail, rows_n
                     
             except Exception as e:
                 print(f"    -> Lỗi parse detail ID {rq_id}: {e}")
-                
-            time.sleep(0.3)
+                return None
+
+        # Details are fetched concurrently on the shared session; results arrive in ids_to_fetch order
+        for idx, rq_id, result in run_ordered_pool(fetch_rfq_detail, ids_to_fetch, detail_workers, check_status):
+            print(f"  [{idx+1}/{len(ids_to_fetch)}] Fetched detail for ID: {rq_id}")
+            if result:
+                row_detail, rows_n = result
+                detail_buffer.append(row_detail)
+                noidung_buffer.extend(rows_n)
+
+            if (idx + 1) % 100 == 0:
+                save_batch_csv(detail_buffer, csv_detail_path)
+                save_batch_csv(noidung_buffer, csv_noidung_path)
+                detail_buffer = []
+                noidung_buffer = []
 
         save_batch_csv(detail_buffer, csv_detail_path)
         save_batch_csv(noidung_buffer, csv_noidung_path)
@@ -1815,14 +4157,19 @@ def run_rfq_scrape(output_path=None, pause_event=None, stop_event=None, keywords
             
         if detail_files_to_pack:
             try:
-                finalize_excel(detail_files_to_pack, detail_path)
+                export_outputs(detail_files_to_pack, detail_path, output_format, export_excel, db_path)
                 print(f"Completed Phase 2! Detail Data saved to {detail_path}")
             except Exception as e:
                 print(f"Lỗi lưu file chi tiết: {e}")
-        browser.close()
 
+        # Run finished: the next run searches every date window again
+        journal.remove_many("window", list(journal.entries.get("window", {})))
+    finally:
+        api_context.close()
 
-def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
+
+def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None, output_format="xlsx", export_excel=None, db_path=None):
+    watch_stop(stop_event)
     if output_path is None:
         output_path = "CongBoGiaThuoc.xlsx"
     if not output_path.endswith(".xlsx"):
@@ -1890,16 +4237,7 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
     processed_count = 0
     last_save_count = 0
 
-    # formatting helper
-    def format_money(val):
-        if val is None or val == "":
-            return ""
-        try:
-             # 999900.0 -> 999,900
-            return "{:,.0f}".format(float(val))
-        except:
-            return str(val)
-
+    # formatting helper (Văn Bản Kiến Nghị is composed text, so its date is formatted here)
     def format_date(iso_str):
         if not iso_str: return ""
         s = str(iso_str)
@@ -1924,16 +4262,22 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
 
     import concurrent.futures
 
+    # One keep-alive pool shared by all page workers; the host pacer decides how many
+    # of them actually hit the server at once
+    page_workers = HOST_PACING["dichvucong.dav.gov.vn"]["max_concurrency"]
+    client = ApiSession(pool_size=page_workers)
+
     # Cào TotalCount trước để tính toán lượng chia trang
     try:
         payload["skipCount"] = 0
-        r_init = requests.post(url, json=payload, headers=headers, timeout=30)
+        r_init = client.post(url, data=payload, headers=headers, timeout=30)
         data_init = r_init.json()
         result_init = data_init.get("result", {})
         total_count = result_init.get("totalCount", 0)
         print(f"Total items found: {total_count}")
     except Exception as e:
         print(f"Lỗi khởi tạo API lấy số lượng: {e}")
+        client.close()
         return
 
     def fetch_page(skip):
@@ -1942,24 +4286,20 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
         page_payload = payload.copy()
         page_payload["skipCount"] = skip
         
-        retry = 0
-        while retry < 3:
-            try:
-                r = requests.post(url, json=page_payload, headers=headers, timeout=30)
-                if r.status_code == 200:
-                    return r.json().get("result", {}).get("items", [])
-                retry += 1
-                time.sleep(2)
-            except:
-                retry += 1
-                time.sleep(2)
+        # client.post đã tự retry (backoff + circuit breaker)
+        try:
+            r = client.post(url, data=page_payload, headers=headers, timeout=30)
+            if r.status == 200:
+                return r.json().get("result", {}).get("items", [])
+        except Exception:
+            pass
         return None # Return None strictly to indicate network failure
 
     # Chia nhỏ request theo bước nhảy (maxResultCount = 50)
     page_skips = list(range(0, total_count, payload["maxResultCount"]))
     
-    # max_workers = 8 để tránh server block do gọi quá nhiều request cùng lúc dẫn đến Failed
-    with concurrent.futures.ThreadPoolExecutor(max_workers=8) as executor:
+    # Số request đồng thời do HostPacer điều chỉnh (giảm khi server báo 429/5xx)
+    with concurrent.futures.ThreadPoolExecutor(max_workers=page_workers) as executor:
         future_to_skip = {executor.submit(fetch_page, s): s for s in page_skips}
         
         while future_to_skip:
@@ -2012,7 +4352,7 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
                                 vb_kien_nghi = f"{s1}{s2}"
 
                         row = {
-                            "Ngày Công bố": format_date(item.get("ngayTiepNhan")),
+                            "Ngày Công bố": api_date(item.get("ngayTiepNhan")),
                             "Trạng thái": trang_thai_text,
                             "Văn Bản Kiến Nghị": vb_kien_nghi,
                             "Tên thuốc": item.get("tenThuoc"),
@@ -2022,13 +4362,14 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
                             "Dạng bào chế": item.get("dangBaoChe"),
                             "Quy Cách Đóng gói": item.get("quyCachDongGoi"),
                             "ĐVT": item.get("donViTinh"),
-                            "Giá Bán Buôn Dự Kiến (VNĐ) (VAT)": format_money(item.get("giaBanBuonDuKien")),
+                            "Giá Bán Buôn Dự Kiến (VNĐ) (VAT)": api_number(item.get("giaBanBuonDuKien")),
                             "Cơ sở SX": item.get("doanhNghiepSanXuat"),
                             "Nước Sản Xuất": item.get("nuocSanXuat"),
                             "Đối tượng thực hiện công bố": item.get("donViKeKhai"),
                             "id": item_id
                         }
-                        row = {k: ("" if v is None else str(v).strip()) for k, v in row.items()}
+                        # Giá/ngày giữ kiểu số/ngày (định dạng khi xuất Excel), chỉ strip chuỗi
+                        row = {k: ("" if v is None else v.strip() if isinstance(v, str) else v) for k, v in row.items()}
                         
                         if item_id not in all_data_dict:
                             all_data_dict[item_id] = row
@@ -2037,7 +4378,8 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
                             old_row = all_data_dict[item_id]
                             changed = False
                             for k, v in row.items():
-                                if old_row.get(k, "") != v:
+                                # Rows loaded from disk are strings: compare as text
+                                if str(old_row.get(k, "")) != str(v):
                                     changed = True
                                     break
                             if changed:
@@ -2057,14 +4399,16 @@ def run_drug_price_scrape(output_path=None, pause_event=None, stop_event=None):
                     new_f = executor.submit(fetch_page, skip)
                     future_to_skip[new_f] = skip
 
+    client.close()
+
     # Cập nhật file cuối cùng
     df_final = pd.DataFrame(list(all_data_dict.values()))
     df_final.to_csv(csv_path, index=False, encoding='utf-8-sig')
     if os.path.exists(csv_path):
-        finalize_excel({"CongBoGiaThuoc": csv_path}, output_path)
+        export_outputs({"CongBoGiaThuoc": csv_path}, output_path, output_format, export_excel, db_path)
     print(f"Completed! Data saved to {output_path}")
 
-def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, ministries=None, from_date_str="", to_date_str=""):
+def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, ministries=None, from_date_str="", to_date_str="", output_format="xlsx", export_excel=None, db_path=None):
     """
     New API-based scanning for Investors.
     Modes:
@@ -2075,6 +4419,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
          - For others: Target "" (all) with agencyName filter.
     """
     print("--- Starting API-based Investor Scan ---")
+    watch_stop(stop_event)
     
     if output_path is None:
         output_path = "investors_data_api.xlsx"
@@ -2189,7 +4534,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
             "User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/120.0.0.0 Safari/537.36"
         }
         # Use session
-        resp = session.post(url_bt, json=payload_bt, headers=headers, timeout=10)
+        resp = send_with_retry(session, "POST", url_bt, json=payload_bt, headers=headers, timeout=10)
         if resp.ok:
             bt_list = resp.json()
             for item in bt_list:
@@ -2224,7 +4569,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
         url = "https://muasamcong.mpi.gov.vn/o/egp-portal-investor-approved-v2/services/get-area-by-code"
         payload = {"queryParams":{"code":{"equals": code}}}
         try:
-            r = session.post(url, json=payload, headers=headers, timeout=10)
+            r = send_with_retry(session, "POST", url, json=payload, headers=headers, timeout=10)
             if r.ok:
                 data = r.json()
                 if data and isinstance(data, list) and len(data) > 0:
@@ -2370,19 +4715,11 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
             
             try:
                 print(f"  Fetching page {page_idx + 1}...")
-                resp = session.post(url_1, json=payload_1, headers=headers, timeout=30)
+                resp = send_with_retry(session, "POST", url_1, json=payload_1, headers=headers, timeout=30)
                 if not resp.ok:
-                    print(f"  Error fetching page {page_idx}: {resp.status_code}. Retrying...")
-                    time.sleep(5)
-                    # Simple retry once
-                    try:
-                        resp = session.post(url_1, json=payload_1, headers=headers, timeout=30)
-                    except: pass
-                    
-                    if not resp.ok:
-                         print("  Skip this page due to error.")
-                         page_idx += 1
-                         continue
+                    print(f"  Error fetching page {page_idx}: {resp.status_code}. Skip this page.")
+                    page_idx += 1
+                    continue
 
                 data = resp.json()
                 content_obj = data.get("ebidOrgInfos", {})
@@ -2417,7 +4754,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
                     
                     detail_info = {}
                     try:
-                        r2 = session.post(url_2, json=payload_2, headers=headers, timeout=10)
+                        r2 = send_with_retry(session, "POST", url_2, json=payload_2, headers=headers, timeout=10)
                         if r2.ok:
                             detail_json = r2.json()
                             detail_info = detail_json.get("orgInfo", {})
@@ -2434,19 +4771,6 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
                         if key == "repName": return item.get("repFullname")
                         return item.get(key, default)
                     
-                    def fmt_date_arr(arr):
-                        if not arr or not isinstance(arr, list) or len(arr) < 3: return ""
-                        # Adjust for year, month, day. Usually [y, m, d, h, m, s]
-                        return f"{arr[2]:02}/{arr[1]:02}/{arr[0]}" 
-                    
-                    def fmt_timestamp(ts):
-                        if not ts: return ""
-                        try:
-                            if isinstance(ts, str): return ts # already string?
-                            dt = datetime.fromtimestamp(int(ts) / 1000)
-                            return dt.strftime("%d/%m/%Y")
-                        except: return str(ts)
-                    
                     row = {}
                     row["Tên đơn vị (đầy đủ)"] = get_d("orgFullName")
                     row["Tên đơn vị (Tiếng Anh)"] = get_d("orgEnName")
@@ -2458,7 +4782,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
                     row["Mã số thuế"] = get_d("taxCode")
                     
                     tax_date = detail_info.get("taxDate")
-                    row["Ngày cấp"] = fmt_timestamp(tax_date)
+                    row["Ngày cấp"] = api_date(tax_date)
                     
                     # Tax nation: API 2 often has it, or API 1
                     tax_nation = detail_info.get("taxNation") 
@@ -2466,7 +4790,7 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
                     row["Quốc gia cấp"] = country_map.get(tax_nation, tax_nation)
                     
                     eff_date = item.get("effRoleDate")
-                    row["Ngày phê duyệt yêu cầu đăng ký"] = fmt_date_arr(eff_date)
+                    row["Ngày phê duyệt yêu cầu đăng ký"] = api_date(eff_date)
                     
                     st = item.get("status")
                     row["Trạng thái vai trò"] = "Đang hoạt động" if str(st) == "1" else str(st)
@@ -2510,13 +4834,12 @@ def run_investor_scan_api(output_path=None, pause_event=None, stop_event=None, m
                 print(f"  Page error: {e}")
                 
             page_idx += 1
-            time.sleep(1)
 
     # Final Save
     save_batch_csv(item_buffer, csv_path)
     if os.path.exists(csv_path):
         target_sheet = "Thông Tin Nhà Đầu Tư"
-        finalize_excel({target_sheet: csv_path}, output_path)
+        export_outputs({target_sheet: csv_path}, output_path, output_format, export_excel, db_path)
 
 
 # ═══════════════════════════════════════════════════════════════
@@ -2542,13 +4865,14 @@ def _get_total_pages(soup):
         return 1
 
 
-def run_hospital_scrape(output_folder, pause_event=None, stop_event=None):
+def run_hospital_scrape(output_folder, pause_event=None, stop_event=None, output_format="xlsx", export_excel=None, db_path=None):
     """
     Cào danh sách bệnh viện từ https://benhandientu.moh.gov.vn/danh-sach-benh-vien
     - output_folder: thư mục gốc user chọn
     - Tạo temp/ bên trong chứa CSV tạm
     - Khi hoàn thành convert sang Excel: Benh_AN_Dien_TU_<timestamp>.xlsx
     """
+    watch_stop(stop_event)
 
     base_url = "https://benhandientu.moh.gov.vn/danh-sach-benh-vien"
     headers = {
@@ -2589,12 +4913,14 @@ def run_hospital_scrape(output_folder, pause_event=None, stop_event=None):
     print("Đang kiểm tra tổng số trang...")
     check_status()
 
+    client = ApiSession(pool_size=4)
     try:
-        first_res = requests.get(base_url, headers=headers, timeout=15)
-        first_soup = BeautifulSoup(first_res.content, 'html.parser')
+        first_res = client.get(base_url, headers=headers, timeout=15)
+        first_soup = BeautifulSoup(first_res.body(), 'html.parser')
         total_pages = _get_total_pages(first_soup)
     except Exception as e:
         print(f"Lỗi khi truy cập trang đầu: {e}")
+        client.close()
         return
 
     print(f"Phát hiện hệ thống có tổng cộng: {total_pages} trang.")
@@ -2609,8 +4935,8 @@ def run_hospital_scrape(output_folder, pause_event=None, stop_event=None):
 
         print(f"Đang lấy dữ liệu trang {page}/{total_pages}...")
         try:
-            res = requests.get(f"{base_url}?page={page}", headers=headers, timeout=15)
-            soup = BeautifulSoup(res.content, 'html.parser')
+            res = client.get(f"{base_url}?page={page}", headers=headers, timeout=15)
+            soup = BeautifulSoup(res.body(), 'html.parser')
             cards = soup.select('.product-card')
 
             for card in cards:
@@ -2659,13 +4985,14 @@ def run_hospital_scrape(output_folder, pause_event=None, stop_event=None):
                 print(f"  >> Đã lưu batch {len(batch_buffer)} records vào CSV tạm.")
                 batch_buffer = []
 
-            time.sleep(0.3)  # Nghỉ ngắn tránh quá tải server
 
         except InterruptedError:
             raise
         except Exception as e:
             print(f"Lỗi tại trang {page}: {e}")
 
+    client.close()
+
     # --- Lưu batch cuối ---
     if batch_buffer:
         save_batch_csv(batch_buffer, csv_path)
@@ -2675,7 +5002,7 @@ def run_hospital_scrape(output_folder, pause_event=None, stop_event=None):
 
     # --- Convert CSV → Excel ---
     if os.path.exists(csv_path):
-        finalize_excel({"Danh Sách Bệnh Viện": csv_path}, excel_path)
+        export_outputs({"Danh Sách Bệnh Viện": csv_path}, excel_path, output_format, export_excel, db_path)
         print(f"✓ Đã lưu thành công vào: {excel_path}")
     else:
         print("Không có dữ liệu CSV để chuyển đổi.")
@@ -0,0 +1,69 @@
+import os
+import sys
+
+import pandas as pd
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import scrape_muasamcong as sm  # noqa: E402
+
+
+def test_convert_columnar_chunk_mixed_date_styles():
+    # Resumed/synced output: old dd/mm text rows followed by new typed ISO rows
+    chunk = pd.DataFrame({"Ngày đăng tải": [
+        "05/01/2024", "05/01/2024 10:30", "05/01/2024 10:30:15",
+        "2024-01-05", "2024-01-05 10:30:15", "2024-01-05T10:30:15", "",
+    ]})
+    typed = sm.convert_columnar_chunk(chunk, {"Ngày đăng tải": "date"})
+    assert typed["Ngày đăng tải"].tolist()[:6] == [
+        pd.Timestamp("2024-01-05"), pd.Timestamp("2024-01-05 10:30"), pd.Timestamp("2024-01-05 10:30:15"),
+        pd.Timestamp("2024-01-05"), pd.Timestamp("2024-01-05 10:30:15"), pd.Timestamp("2024-01-05 10:30:15"),
+    ]
+    assert pd.isna(typed["Ngày đăng tải"].iloc[6])
+
+
+class CountingResolver(sm.DetailResolver):
+    """DetailResolver whose endpoints are a dict: bid_id -> kind that answers."""
+    def __init__(self, serves):
+        super().__init__(None, "token", workers=2)
+        self.serves = serves
+        self.calls = []
+
+    def _fetch(self, kind, bid_id):
+        self.calls.append((kind, bid_id))
+        return {"statusDT": "ok"} if self.serves[bid_id] == kind else {"bidoNotifyContractorM": None, "statusDT": None}
+
+
+def test_detail_resolver_signature_is_not_the_notice_prefix():
+    goods = {"Mã TBMT": "IB2400123456-00", "Lĩnh vực": "Hàng hóa", "bidID": "a1"}
+    works = {"Mã TBMT": "IB2400654321-01", "Lĩnh vực": "Xây lắp", "bidID": "b2"}
+    no_bid = {"Mã TBMT": "IB2500000777-00", "Lĩnh vực": "Hàng hóa", "bidID": ""}
+    signatures = {sm.DetailResolver.signature(r) for r in (goods, works, no_bid)}
+    assert len(signatures) == 3
+
+
+def test_detail_resolver_mixed_signature_uses_sequential_chain():
+    # One signature, a quarter of the notices on the reoffer endpoint: no dominant route
+    serves = {f"id{i}": "reoffer" if i % 4 == 0 else "normal" for i in range(40)}
+    resolver = CountingResolver(serves)
+    try:
+        for i in range(40):
+            row = {"Mã TBMT": f"IB24{i:08d}-00", "Lĩnh vực": "Hàng hóa", "bidID": f"b{i}"}
+            resolver.resolve(row, f"id{i}")
+    finally:
+        resolver.close()
+    assert resolver.candidates(sm.DetailResolver.signature(row)) == (list(sm.DetailResolver.KINDS), False)
+    # After the 3 racing warm-up notices: 1 call for "normal" notices, 2 for "reoffer" ones
+    late = [c for c in resolver.calls if int(c[1][2:]) >= 3]
+    assert len(late) == sum(1 if serves[f"id{i}"] == "normal" else 2 for i in range(3, 40))
+    assert not any(kind == "wb_adb" for kind, _ in late)
+
+
+def test_detail_resolver_dominant_route_is_called_alone():
+    serves = {f"id{i}": "reoffer" for i in range(10)}
+    resolver = CountingResolver(serves)
+    try:
+        for i in range(10):
+            resolver.resolve({"Mã TBMT": f"IB25{i:08d}-00", "Lĩnh vực": "Hàng hóa", "bidID": ""}, f"id{i}")
+    finally:
+        resolver.close()
+    assert [c for c in resolver.calls if int(c[1][2:]) >= 3] == [("reoffer", f"id{i}") for i in range(3, 10)]